@@ -36,15 +36,16 @@ class Address:
 
     @classmethod
     def new(cls, kp: KeyPair, prefix="0x"):
-        if hasattr(kp, "pub"):
-            cls.pubkey = kp.pub
+        """New address of a KeyPair, or of a PubKey or hex pubkey `str`"""
+        address = cls()
+        address.pubkey = kp.pub if hasattr(kp, "pub") else kp
 
-        pub = chicken_hash(cls.pubkey.data.encode("utf-8")).hex()
+        pub = chicken_hash(str(address.pubkey).encode("utf-8")).hex()
 
-        cls.prefix = prefix
-        cls.addr = pub[38:]
-        cls.checksum = b58encode(cls.addr.encode())[:4].decode().lower()
-        return cls()
+        address.prefix = prefix
+        address.addr = pub[38:]
+        address.checksum = b58encode(address.addr.encode())[:4].decode().lower()
+        return address
 
 
 if __name__ == "__main__":
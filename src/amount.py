@@ -0,0 +1,100 @@
+"""ChickenTicket coin amounts
+
+Amounts are integers of base units, COIN base units make one coin. Sums and
+comparisons are plain int arithmetic, Decimal is only used to parse and display
+amounts in coins. Coins are only ever read through `Amount.from_coins`, anything
+else is base units so `to_amount(str(amount)) == amount`.
+"""
+from decimal import Decimal, InvalidOperation
+
+DECIMALS = 8
+COIN = 10**DECIMALS  # base units per coin
+MAX_AMOUNT = 2**63 - 1  # fits a signed 64 bit column
+
+
+class AmountException(Exception):
+    """Base class for amount related exceptions"""
+
+
+class Amount(int):
+    """A non-negative number of base units
+
+    `str()` gives the base units, which is what amounts serialize to. Use
+    `coins()` or `format()` to display an amount in coins.
+    """
+
+    def __new__(cls, units=0):
+        value = super().__new__(cls, units)
+        if not 0 <= value <= MAX_AMOUNT:
+            raise AmountException(f"amount {units} is out of range")
+        return value
+
+    @classmethod
+    def from_coins(cls, coins):
+        """Parse an amount in coins, i.e. `Decimal("1.5")` or `"0.001"`"""
+        try:
+            units = Decimal(coins).scaleb(DECIMALS)
+        except (InvalidOperation, TypeError, ValueError):
+            raise AmountException(f"{coins!r} is not an amount")
+        if units != units.to_integral_value():
+            raise AmountException(f"{coins} has more than {DECIMALS} decimals")
+        return cls(int(units))
+
+    def coins(self) -> Decimal:
+        return Decimal(int(self)).scaleb(-DECIMALS)
+
+    def format(self) -> str:
+        """Display string in coins, i.e. "1.50000000" """
+        whole, frac = divmod(int(self), COIN)
+        return f"{whole}.{frac:0{DECIMALS}d}"
+
+    def __str__(self):
+        return str(int(self))
+
+    def __repr__(self):
+        return f"Amount({int(self)})"
+
+
+def to_amount(value) -> Amount:
+    """Coerce `value` to an Amount
+
+    ints and integer strings are base units, coins need `Amount.from_coins`.
+    """
+    if isinstance(value, Amount):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        return Amount(value)
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        return Amount(int(value))
+    raise AmountException(
+        f"{value!r} is not an amount in base units, use Amount.from_coins for coins"
+    )
+
+
+def sum_amounts(amounts) -> Amount:
+    return Amount(sum(amounts))
+
+
+if __name__ == "__main__":
+    assert Amount.from_coins(Decimal("1.5")) == 150000000
+    assert Amount.from_coins("0.00000001") == 1
+    assert to_amount(7) == 7 and to_amount("150000000") == 150000000
+    assert to_amount(str(Amount(123))) == 123
+    assert Amount(150000000).format() == "1.50000000"
+    assert Amount(150000000).coins() == Decimal("1.5")
+    assert str(Amount(5)) == "5"
+    for bad in ("0.000000001", "-1", "x"):
+        try:
+            Amount.from_coins(bad)
+        except AmountException:
+            pass
+        else:
+            raise AssertionError(bad)
+    for bad in ("1.5", "-1", "", Decimal("1"), 0.1, True):
+        try:
+            to_amount(bad)
+        except AmountException:
+            pass
+        else:
+            raise AssertionError(bad)
+    print("Tests done!")
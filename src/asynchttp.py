@@ -0,0 +1,368 @@
+"""ChickenTicket asyncio HTTP server
+
+A small HTTP/1.1 server for the node's `/api/*` endpoints. Every connection is a
+coroutine on one event loop, so thousands of idle keep-alive peers cost little.
+Handlers that may block (disk, SQLite, hashing) run on a thread pool and every
+request gets its own Request and Response objects.
+
+Endpoints are registered like with Flask:
+
+    server.add_endpoint("/api/get_height", "get_height", handler)
+
+where `handler(request)` returns a Response, str, bytes or a JSON-able dict. A
+Response with a `stream` iterator of bytes is sent with chunked encoding as the
+iterator produces it, so large bodies are never held in memory.
+"""
+
+import asyncio
+import json
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from typing import Callable, Dict, Iterator, Optional
+from urllib.parse import parse_qs, urlsplit
+
+MAX_HEADER_SIZE = 16 * 2**10  # request line and headers
+MAX_BODY_SIZE = 2**20
+KEEPALIVE_TIMEOUT = 15  # seconds an idle connection is kept open
+EXECUTOR_WORKERS = 16  # threads for blocking handlers
+BACKLOG = 1024
+
+
+class HTTPException(Exception):
+    """Raised to answer a request with an error status"""
+
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+
+class Args(dict):
+    """Query arguments, the first value of each like Flask's `request.args`"""
+
+    def get(self, key, default=None, type=None):
+        value = super().get(key, default)
+        if type is not None and value is not default:
+            try:
+                return type(value)
+            except ValueError:
+                return default
+        return value
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    args: Args
+    headers: Dict[str, str]  # lowercased names
+    body: bytes
+    remote_addr: str
+    version: str = "HTTP/1.1"
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def json(self):
+        return json.loads(self.body)
+
+
+@dataclass
+class Response:
+    body: bytes = b""
+    status: int = 200
+    mimetype: str = "application/json"
+    headers: Dict[str, str] = field(default_factory=dict)
+    stream: Optional[Iterator[bytes]] = None  # body chunks, replaces `body`
+
+    @classmethod
+    def make(cls, result, mimetype: str = "application/json"):
+        """Response for a handler's return value"""
+        if isinstance(result, Response):
+            return result
+        if isinstance(result, str):
+            return cls(result.encode(), mimetype=mimetype)
+        if isinstance(result, (bytes, bytearray, memoryview)):
+            return cls(bytes(result), mimetype=mimetype)
+        return cls(json.dumps(result).encode(), mimetype=mimetype)
+
+    @classmethod
+    def error(cls, status: int, message: str = ""):
+        message = message or HTTPStatus(status).phrase
+        return cls(json.dumps({"error": message}).encode(), status)
+
+    def head(self, keep_alive: bool) -> bytes:
+        lines = [
+            f"HTTP/1.1 {self.status} {HTTPStatus(self.status).phrase}",
+            f"Content-Type: {self.mimetype}",
+            (
+                "Transfer-Encoding: chunked"
+                if self.stream is not None
+                else f"Content-Length: {len(self.body)}"
+            ),
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{k}: {v}" for k, v in self.headers.items())
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+@dataclass
+class Endpoint:
+    name: str
+    handler: Callable[[Request], object]
+    blocking: bool  # run on the executor instead of the event loop
+    methods: tuple
+    mimetype: str
+
+
+class AsyncHTTPServer:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        executor: Executor = None,
+        keepalive_timeout: float = KEEPALIVE_TIMEOUT,
+    ):
+        self.host = host
+        self.port = port
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=EXECUTOR_WORKERS, thread_name_prefix="http"
+        )
+        self.keepalive_timeout = keepalive_timeout
+        self.endpoints: Dict[str, Endpoint] = {}
+        self.connections = 0  # open connections
+        self._writers = set()  # writers of the open connections, closed by `stop`
+        self.requests = 0  # requests served
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def add_endpoint(
+        self,
+        endpoint=None,
+        endpoint_name=None,
+        handler=None,
+        blocking: bool = True,
+        methods=("GET",),
+        mimetype: str = "application/json",
+    ):
+        """Route `endpoint` to `handler(request)`
+
+        Coroutine handlers are awaited on the event loop, others run on the
+        executor unless `blocking` is False, meaning they are cheap enough to
+        call on the loop directly.
+        """
+        self.endpoints[endpoint] = Endpoint(
+            endpoint_name or endpoint, handler, blocking, tuple(methods), mimetype
+        )
+
+    async def _read_request(self, reader: asyncio.StreamReader, peer) -> Request:
+        head = await reader.readuntil(b"\r\n\r\n")
+        try:
+            lines = head.decode("latin-1").split("\r\n")
+            method, target, version = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                if line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            raise HTTPException(400, "malformed request")
+
+        body = b""
+        length = headers.get("content-length") or "0"
+        if not (length.isascii() and length.isdigit()):
+            raise HTTPException(400, "malformed content-length")
+        length = int(length)
+        # checked before reading, a huge length must not be buffered
+        if length > MAX_BODY_SIZE:
+            raise HTTPException(413)
+        if length:
+            body = await reader.readexactly(length)
+
+        url = urlsplit(target)
+        args = Args((k, v[0]) for k, v in parse_qs(url.query).items())
+        return Request(method, url.path, args, headers, body, peer, version)
+
+    async def dispatch(self, request: Request) -> Response:
+        endpoint = self.endpoints.get(request.path)
+        if endpoint is None:
+            return Response.error(404)
+        if request.method not in endpoint.methods:
+            return Response.error(405)
+
+        try:
+            if asyncio.iscoroutinefunction(endpoint.handler):
+                result = await endpoint.handler(request)
+            elif endpoint.blocking:
+                result = await self.loop.run_in_executor(
+                    self.executor, endpoint.handler, request
+                )
+            else:
+                result = endpoint.handler(request)
+        except HTTPException as e:
+            return Response.error(e.status, str(e))
+        except Exception as e:
+            print(f"{request.path} handler failed:", type(e), str(e))
+            return Response.error(500)
+        return Response.make(result, endpoint.mimetype)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        remote_addr = peer[0] if peer else ""
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(
+                        self._read_request(reader, remote_addr), self.keepalive_timeout
+                    )
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    break  # closed by the peer or idle
+                except asyncio.LimitOverrunError:
+                    writer.write(self._error_bytes(431))
+                    break
+                except HTTPException as e:
+                    writer.write(self._error_bytes(e.status, str(e)))
+                    break
+
+                response = await self.dispatch(request)
+                keep_alive = request.keep_alive
+                writer.write(response.head(keep_alive))
+                if response.stream is not None:
+                    if not await self._write_stream(writer, response.stream):
+                        break
+                else:
+                    writer.write(response.body)
+                await writer.drain()  # backpressure on slow readers
+                self.requests += 1
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.connections -= 1
+            self._writers.discard(writer)
+            writer.close()
+
+    async def _write_stream(self, writer: asyncio.StreamWriter, stream) -> bool:
+        """Send a body iterator as chunks, pulling each on the executor
+
+        Returns False if the iterator failed, the response is then cut short
+        without its last chunk so the client sees an incomplete body.
+        """
+        while True:
+            try:
+                chunk = await self.loop.run_in_executor(self.executor, next, stream, None)
+            except Exception as e:
+                print("Streaming response failed:", type(e), str(e))
+                return False
+            if chunk is None:
+                writer.write(b"0\r\n\r\n")
+                return True
+            if chunk:
+                writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+                await writer.drain()
+
+    @staticmethod
+    def _error_bytes(status: int, message: str = "") -> bytes:
+        response = Response.error(status, message)
+        return response.head(False) + response.body
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(
+            self._handle,
+            self.host,
+            self.port,
+            limit=MAX_HEADER_SIZE,
+            backlog=BACKLOG,
+            reuse_address=True,
+        )
+        return self._server
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass  # closed by `stop`
+
+    def run(self):
+        """Serve until interrupted, blocking the calling thread"""
+        try:
+            asyncio.run(self.serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def _close(self):
+        self._server.close()
+        # idle keep-alive connections see EOF and their handlers return, instead
+        # of being cancelled when the loop shuts down
+        for writer in list(self._writers):
+            writer.close()
+
+    def stop(self):
+        """Stop serving, safe to call from another thread"""
+        if self.loop is not None and self._server is not None:
+            self.loop.call_soon_threadsafe(self._close)
+
+
+if __name__ == "__main__":
+    import threading
+
+    CONNECTIONS = 1000
+    REQUESTS = 20  # per connection, over keep-alive
+
+    server = AsyncHTTPServer("127.0.0.1", 0)
+    server.add_endpoint(
+        "/api/get_height", "get_height", lambda req: {"height": 1}, blocking=False
+    )
+    server.add_endpoint(
+        "/api/get_block", "get_block", lambda req: {"h": req.args.get("h", type=int)}
+    )
+
+    started = threading.Event()
+
+    async def serve():
+        srv = await server.start()
+        server.port = srv.sockets[0].getsockname()[1]
+        started.set()
+        async with srv:
+            await srv.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    started.wait()
+
+    async def client(n):
+        reader, writer = await asyncio.open_connection(server.host, server.port)
+        for i in range(REQUESTS):
+            path = "/api/get_height" if i % 2 else f"/api/get_block?h={n}"
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+            head = await reader.readuntil(b"\r\n\r\n")
+            assert head.startswith(b"HTTP/1.1 200"), head
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            body = json.loads(await reader.readexactly(length))
+            assert body == ({"height": 1} if i % 2 else {"h": n})
+        writer.close()
+
+    async def load():
+        began = time.perf_counter()
+        await asyncio.gather(*(client(n) for n in range(CONNECTIONS)))
+        return time.perf_counter() - began
+
+    elapsed = asyncio.run(load())
+    total = CONNECTIONS * REQUESTS
+    print(
+        f"{total} requests over {CONNECTIONS} concurrent keep-alive connections "
+        f"in {elapsed:.2f}s ({total / elapsed:.0f} req/s)"
+    )
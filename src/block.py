@@ -1,8 +1,8 @@
 from dataclasses import dataclass
-from decimal import Decimal
 from typing import List
 
-from crypto.chicken import chicken_hash
+from address import Address
+from crypto.chicken import chicken_hash, chicken_hash_many
 from utils.merkle import MerkleTree
 from utils.time_tools import get_timestamp
 
@@ -15,6 +15,11 @@ except ImportError:
 
     USING_UJSON = False
 
+NONCE_PLACEHOLDER = "__nonce__"
+TXS_PLACEHOLDER = "__txs__"
+# separators of the json module in use, to splice in cached serializations
+ITEM_SEPARATOR = json.dumps([0, 0])[2:-2]
+
 
 class BlockException(Exception):
     """Base class for block related exceptions"""
@@ -37,9 +42,36 @@ class BlockHeader:
             "nonce": self.nonce,
         }
 
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(
+            data.get("ver"),
+            data.get("prev_proof"),
+            data.get("merkle"),
+            data.get("time"),
+            data.get("nonce"),
+        )
+
     def json(self):
         return json.dumps(self.to_dict(), sort_keys=True)
 
+    def hash(self):
+        """Proof-of-work hash of the header, this is what miners search nonces for"""
+        return chicken_hash(self.json().encode())
+
+    def nonce_template(self):
+        """Split the serialized header around the nonce
+
+        Returns a (prefix, suffix) pair of bytes such that
+        `prefix + str(nonce).encode() + suffix == header.json().encode()`
+        for any integer nonce, so miners only need to re-encode the nonce.
+        """
+        data = self.to_dict()
+        data["nonce"] = NONCE_PLACEHOLDER
+        serialized = json.dumps(data, sort_keys=True).encode()
+        prefix, suffix = serialized.split(json.dumps(NONCE_PLACEHOLDER).encode())
+        return prefix, suffix
+
     def __str__(self):
         return self.json()
 
@@ -58,39 +90,51 @@ class Block:
         self.last_block = kwargs.get("last_block")
         self.nonce = kwargs.get("nonce")
         self.timestamp = kwargs.get("timestamp") or get_timestamp()
-        self.tree = MerkleTree()  # sha256 hashed merkle tree
+        self.tree = MerkleTree(incremental=True)  # sha256 hashed merkle tree
         self.previous_proof = kwargs.get("previous_proof")
         self.merkle_root = kwargs.get("merkle_root")
         self.proof = None
         self.difficulty = self.calculate_difficulty()
         self.reward = None
         self.transactions = kwargs.get("transactions") or kwargs.get("txs") or []
+        self._tx_hashes = {getattr(tx, "proof", None) for tx in self.transactions}
+        self._lazy_tree = False  # transactions not in `tree` yet, see `load_transactions`
 
         if hasattr(self.last_block, "proof"):
             self.previous_proof = last_block.proof
 
-    def to_dict(self):
+    def _dict(self, txs):
         return {
             "idx": self.idx,
             "header": self.header.to_dict(),
             "last_block": self.last_block,
             "reward": self.reward,
-            "txs": [tx.to_dict() for tx in self.transactions]
-            if self.transactions
-            else None,
+            "txs": txs if self.transactions else None,
             "hash": self.proof,
             "difficulty": self.difficulty,
         }
 
+    def to_dict(self):
+        return self._dict([tx.to_dict() for tx in self.transactions])
+
+    def _splice_txs(self, serialized, fragments):
+        """Replace TXS_PLACEHOLDER with the transactions' cached serializations"""
+        if not self.transactions:
+            return serialized
+        return serialized.replace(
+            json.dumps(TXS_PLACEHOLDER), "[" + ITEM_SEPARATOR.join(fragments) + "]", 1
+        )
+
     def json(self):
-        return json.dumps(self.to_dict(), sort_keys=True)
+        serialized = json.dumps(self._dict(TXS_PLACEHOLDER), sort_keys=True)
+        return self._splice_txs(serialized, [tx.json() for tx in self.transactions])
 
     @property
     def header(self):
-        if not self.tree.is_ready and self.merkle_root is None:
-            self.tree.make_tree()
-
-        self.merkle_root = self.tree.get_merkle_root()
+        if not self._lazy_tree:
+            if not self.tree.is_ready and self.merkle_root is None:
+                self.tree.make_tree()
+            self.merkle_root = self.tree.get_merkle_root()
         return BlockHeader(
             self.version,
             self.previous_proof,
@@ -99,11 +143,59 @@ class Block:
             self.nonce,
         )
 
+    def load_transactions(self, txs, merkle_root: str):
+        """Set the transactions of a decoded block and the merkle root it claims
+
+        Building the tree hashes every transaction's JSON, it is put off until
+        the block gets another transaction. The claimed root is checked by
+        `validate`.
+        """
+        from transaction import hash_transactions
+
+        unhashed = [tx for tx in txs if tx.proof is None]
+        if unhashed:
+            hash_transactions(unhashed)
+        self.transactions = list(txs)
+        self._tx_hashes = {tx.proof for tx in self.transactions}
+        if len(self._tx_hashes) != len(self.transactions):
+            raise BlockException(f"block {self.idx} has duplicate transactions")
+        self.tree.reset_tree()
+        self.merkle_root = merkle_root
+        self._lazy_tree = True
+
+    def _build_tree(self):
+        """Add the transactions set by `load_transactions` to the tree"""
+        if self._lazy_tree:
+            self._lazy_tree = False
+            self.tree.add_leaf([tx.json() for tx in self.transactions], True)
+
     def add_transaction(self, tx):
-        if self.transactions is not None and tx not in self.transactions:
+        self._build_tree()
+        if tx.proof is None:
+            tx.hash()
+        if self.transactions is not None and tx.proof not in self._tx_hashes:
             self.transactions.append(tx)
+            self._tx_hashes.add(tx.proof)
             self.tree.add_leaf(tx.json(), True)
 
+    def add_transactions(self, txs):
+        """Add many transactions at once, hashing the unhashed ones in one batch"""
+        from transaction import hash_transactions
+
+        if self.transactions is None:
+            return
+        self._build_tree()
+        unhashed = [tx for tx in txs if tx.proof is None]
+        if unhashed:
+            hash_transactions(unhashed)
+        new = []
+        for tx in txs:
+            if tx.proof not in self._tx_hashes:
+                new.append(tx)
+                self._tx_hashes.add(tx.proof)
+        self.transactions.extend(new)
+        self.tree.add_leaf([tx.json() for tx in new], True)
+
     def calculate_difficulty(self):
         if isinstance(self.last_block, Block):
             last_diff = self.last_block.difficulty
@@ -133,27 +225,124 @@ class Block:
         return self.difficulty
 
     def hash(self):
-        data = self.to_dict()
+        data = self._dict(TXS_PLACEHOLDER)
         # header contains the miner rewardee's address and
         # can't be included in the process that validates the block
         del data["header"]
         del data["hash"]
-        self.proof = chicken_hash(json.dumps(data).encode()).hex()
+        serialized = self._splice_txs(
+            json.dumps(data), [tx.fragment() for tx in self.transactions]
+        )
+        self.proof = chicken_hash(serialized.encode()).hex()
         return self.proof
 
     @classmethod
-    def from_dict(cls, data):
-        try:
-            return cls(**data)
-        except:
-            raise
-
-    def validate(self):
+    def from_dict(cls, data: dict):
+        """Rebuild a block from its `to_dict()` form
+
+        Raises BlockException if the transactions don't match the header's
+        merkle root. The block proof is taken as is, see `validate`.
+        """
+        from transaction import Transaction
+
+        header = data.get("header") or {}
+        block = cls(
+            idx=data.get("idx"),
+            ver=header.get("ver"),
+            timestamp=header.get("time"),
+            nonce=header.get("nonce"),
+            previous_proof=header.get("prev_proof"),
+        )
+        block.reward = data.get("reward")
+        block.difficulty = data.get("difficulty")
+        block.add_transactions(
+            [Transaction.from_dict(tx) for tx in data.get("txs") or []]
+        )
+        if block.header.merkle_root != header.get("merkle"):
+            raise BlockException(f"block {block.idx} merkle root doesn't match its txs")
+        block.proof = data.get("hash")
+        return block
+
+    def validate(self, verifier=None, utxos=None):
+        """Check the block's proof, merkle root and transaction signatures
+
+        `verifier` is a SignatureVerifier to check signatures on, pass a shared
+        one to reuse its process pool across blocks. With the `utxos` the block
+        is applied to, every input must also be signed by the owner of the coin
+        it spends.
+        """
         # TODO
         # check height
-        # check proof
-        # check transactions
-        raise NotImplementedError
+        claimed = self.proof
+        if claimed is None:
+            raise BlockException(f"block {self.idx} has no proof")
+        if self.hash() != claimed:
+            self.proof = claimed
+            raise BlockException(f"block {self.idx} proof {claimed} is invalid")
+
+        # transaction hashes come from the wire, the merkle root and signatures
+        # commit to them, recomputed in one batch without touching `tx.proof`
+        digests = chicken_hash_many([tx.hash_payload() for tx in self.transactions])
+        for tx, digest in zip(self.transactions, digests):
+            if digest.hex() != tx.proof:
+                raise BlockException(
+                    f"block {self.idx} transaction {tx.proof} has the wrong hash"
+                )
+
+        tree = MerkleTree()
+        tree.add_leaf([tx.json() for tx in self.transactions], True)
+        tree.make_tree()
+        if tree.get_merkle_root() != self.header.merkle_root:
+            raise BlockException(f"block {self.idx} merkle root is invalid")
+
+        # the first transaction is the coinbase, it has no inputs to authorize
+        txs = self.transactions[1:]
+        if txs:
+            if verifier is not None:
+                results = verifier.verify_transactions(txs)
+            else:
+                from sigverify import SignatureVerifier
+
+                with SignatureVerifier() as verifier:
+                    results = verifier.verify_transactions(txs)
+            invalid = [tx.proof for tx, ok in zip(txs, results) if not ok]
+            if invalid:
+                raise BlockException(
+                    f"block {self.idx} has invalid signatures: {', '.join(invalid)}"
+                )
+
+        if utxos is not None:
+            self._check_owners(utxos)
+        return True
+
+    def _check_owners(self, utxos):
+        """Check that every input is signed by the owner of the coin it spends"""
+        created = {}  # (tx hash, output index) -> recipient, outputs of this block
+        for n, tx in enumerate(self.transactions):
+            # the first transaction is the coinbase, its inputs don't spend coins
+            if n > 0:
+                signer = str(Address.new(tx.pubkey)) if tx.pubkey else None
+                for inp in tx.inputs:
+                    outpoint = (inp.tx_hash, inp.output_id)
+                    owner = created.get(outpoint)
+                    if owner is None:
+                        try:
+                            coin = utxos.get(*outpoint)
+                        except ValueError:  # malformed tx hash
+                            coin = None
+                        if coin is None:
+                            raise BlockException(
+                                f"block {self.idx} spends missing coin "
+                                f"{inp.tx_hash}:{inp.output_id}"
+                            )
+                        owner = coin.recipient
+                    if owner != signer:
+                        raise BlockException(
+                            f"block {self.idx} transaction {tx.proof} spends "
+                            f"{inp.tx_hash}:{inp.output_id} of {owner}, not its own"
+                        )
+            for i, output in enumerate(tx.outputs):
+                created[(tx.proof, i)] = str(output.recipient)
 
     def __str__(self):
         return self.json()
@@ -165,19 +354,20 @@ if __name__ == "__main__":
     genesis = "genesis"
     block.previous_proof = chicken_hash((genesis + "previous_proof").encode()).hex()
 
+    from amount import Amount
     from transaction import Input, Output, Transaction, TXVersion
 
     tx = Transaction()
     tx.idx = 0
     tx.ver = TXVersion.ver1
-    tx.fee = Decimal("1.0")
+    tx.fee = Amount.from_coins("1.0")
 
     # genesis input and output
     genesis = "genesis"
     ipt = Input(chicken_hash((genesis + "input").encode()).hex(), 0)
     tx.add_input(ipt)
 
-    opt = Output("0x0", Decimal("1.0"))
+    opt = Output("0x0", Amount.from_coins("1.0"))
     tx.add_output(opt)
 
     # create a key just to sign the tx
@@ -0,0 +1,241 @@
+"""ChickenTicket append-only block storage
+
+Serialized blocks are appended to numbered segment files (blk00000.dat, ...). A
+fixed width index file holds one record per height, mapping it to the block hash
+and the (segment, offset, length) of the block's bytes. Reads go through `mmap`
+so blocks are returned as stored, without deserializing them. A store is shared
+by the node's server threads, appends and remaps happen under a lock.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+INDEX_RECORD = struct.Struct("<32sIQI")  # block hash, segment, offset, length
+SEGMENT_SIZE = 128 * 2**20  # start a new segment file past this size
+
+
+class BlockStoreException(Exception):
+    """Base class for block store related exceptions"""
+
+
+class BlockStore:
+    def __init__(self, path: Path, segment_size: int = SEGMENT_SIZE, sync: bool = False):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.sync = sync  # fsync every append
+
+        self._index = bytearray()  # raw index records, record n is height n
+        self._heights: Dict[bytes, int] = {}  # block hash -> height
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._segment = 0  # segment currently appended to
+        self._segment_end = 0  # bytes used in the current segment
+        # held while appending and while reading through a map, a map is only
+        # closed and replaced when nobody is slicing it
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._load()
+        self._index_f = open(self._index_fp, "ab")
+        self._segment_f = open(self._segment_fp(self._segment), "ab")
+
+    @property
+    def _index_fp(self):
+        return self.path / "index.dat"
+
+    def _segment_fp(self, segment):
+        return self.path / f"blk{segment:05d}.dat"
+
+    def _load(self):
+        """Load the index, dropping any records or bytes of an interrupted append"""
+        if self._index_fp.exists():
+            data = self._index_fp.read_bytes()
+        else:
+            data = b""
+        stored = len(data)
+        data = data[: len(data) - len(data) % INDEX_RECORD.size]
+
+        # drop trailing records whose block bytes never made it to disk
+        while data:
+            _, segment, offset, length = INDEX_RECORD.unpack_from(
+                data, len(data) - INDEX_RECORD.size
+            )
+            fp = self._segment_fp(segment)
+            if fp.exists() and fp.stat().st_size >= offset + length:
+                self._segment, self._segment_end = segment, offset + length
+                break
+            data = data[: -INDEX_RECORD.size]
+
+        if len(data) < stored:
+            # cut only the torn tail, the records before it are never rewritten
+            os.truncate(self._index_fp, len(data))
+
+        # truncate bytes past the last indexed block
+        fp = self._segment_fp(self._segment)
+        if fp.exists() and fp.stat().st_size > self._segment_end:
+            os.truncate(fp, self._segment_end)
+
+        self._index = bytearray(data)
+        for height in range(len(data) // INDEX_RECORD.size):
+            block_hash = INDEX_RECORD.unpack_from(data, height * INDEX_RECORD.size)[0]
+            self._heights[block_hash] = height
+
+    def __len__(self):
+        return len(self._index) // INDEX_RECORD.size
+
+    @property
+    def height(self):
+        """Height of the last stored block, -1 if empty"""
+        return len(self) - 1
+
+    def __contains__(self, block_hash: bytes):
+        return block_hash in self._heights
+
+    def append(self, block_hash: bytes, data: bytes) -> int:
+        """Append a serialized block, returns its height"""
+        if len(block_hash) != 32:
+            raise BlockStoreException(
+                f"block hash must be 32 bytes, not {len(block_hash)}"
+            )
+        with self._lock:
+            if self._closed:
+                raise BlockStoreException("block store is closed")
+            if block_hash in self._heights:
+                raise BlockStoreException(f"block {block_hash.hex()} is already stored")
+            return self._append(block_hash, data)
+
+    def _append(self, block_hash: bytes, data: bytes) -> int:
+        if self._segment_end > 0 and self._segment_end + len(data) > self.segment_size:
+            self._segment_f.close()
+            self._segment += 1
+            self._segment_end = 0
+            # truncates leftovers of an append interrupted right after a rollover
+            self._segment_f = open(self._segment_fp(self._segment), "wb")
+
+        # block bytes first, so the index never points at missing data
+        offset = self._segment_end
+        self._segment_f.write(data)
+        self._segment_f.flush()
+        if self.sync:
+            os.fsync(self._segment_f.fileno())
+
+        record = INDEX_RECORD.pack(block_hash, self._segment, offset, len(data))
+        self._index_f.write(record)
+        self._index_f.flush()
+        if self.sync:
+            os.fsync(self._index_f.fileno())
+
+        self._segment_end += len(data)
+        self._index += record
+        height = len(self) - 1
+        self._heights[block_hash] = height
+        return height
+
+    def _locate(self, height: int):
+        if not 0 <= height < len(self):
+            raise IndexError(f"no block at height {height}")
+        return INDEX_RECORD.unpack_from(self._index, height * INDEX_RECORD.size)
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        """Map of `segment` covering `end`, the caller holds the lock"""
+        mm = self._maps.get(segment)
+        if mm is None or len(mm) < end:
+            # the current segment grows after being mapped, map it again
+            if mm is not None:
+                mm.close()
+            with open(self._segment_fp(segment), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mm
+        return mm
+
+    def get_hash(self, height: int) -> bytes:
+        return self._locate(height)[0]
+
+    def get_height(self, block_hash: bytes) -> Optional[int]:
+        return self._heights.get(block_hash)
+
+    def get_block(self, height: int) -> bytes:
+        """Get the serialized block at `height`"""
+        with self._lock:
+            if self._closed:
+                raise BlockStoreException("block store is closed")
+            _, segment, offset, length = self._locate(height)
+            # slicing copies, the bytes stay valid once the map is replaced
+            return self._map(segment, offset + length)[offset : offset + length]
+
+    def get_block_by_hash(self, block_hash: bytes) -> Optional[bytes]:
+        height = self._heights.get(block_hash)
+        if height is None:
+            return None
+        return self.get_block(height)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+            self._segment_f.close()
+            self._index_f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with BlockStore(tmp, segment_size=64) as store:
+            for i in range(10):
+                store.append(bytes([i]) * 32, f"block {i}".encode() * 4)
+            assert store.get_block(3) == b"block 3" * 4
+            assert store.get_height(bytes([7]) * 32) == 7
+
+        # simulate an append interrupted before its index record was written
+        with open(Path(tmp) / "blk00009.dat", "ab") as f:
+            f.write(b"partial")
+
+        with BlockStore(tmp, segment_size=64) as store:
+            assert store.height == 9
+            assert store.get_block_by_hash(bytes([9]) * 32) == b"block 9" * 4
+            store.append(bytes([10]) * 32, b"block 10")
+            assert store.get_block(10) == b"block 10"
+
+        # a reader still slicing a map while another one replaces it
+        import time
+
+        class SlowStore(BlockStore):
+            def _map(self, segment, end):
+                mm = super()._map(segment, end)
+                time.sleep(0.01)
+                return mm
+
+        with SlowStore(Path(tmp) / "race") as store:
+            store.append(bytes(32), b"first")
+            failures = []
+
+            def read(height):
+                try:
+                    store.get_block(height)
+                except Exception as e:
+                    failures.append(e)
+
+            reader = threading.Thread(target=read, args=(0,))
+            reader.start()
+            time.sleep(0.002)
+            store.append(bytes([1]) * 32, b"second")
+            read(1)  # remaps the grown segment
+            reader.join()
+            assert not failures, failures
+
+        print("Tests done!")
@@ -0,0 +1,269 @@
+"""ChickenTicket SQLite chain index
+
+Maps transaction hashes to their (height, position) in the chain, and addresses
+to the outputs paid to them and the inputs spending those outputs. Blocks are
+written in batched transactions as they connect, a lookup writes the pending
+ones first so it sees every connected block. The database runs in WAL mode so
+any number of readers can query it while the node writes.
+
+Rebuild the index from the block store with:
+    $ python3 src/chainindex.py rebuild
+"""
+import argparse
+import sqlite3
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from amount import Amount
+
+try:
+    import ujson as json
+
+    USING_UJSON = True
+except ImportError:
+    import json
+
+    USING_UJSON = False
+
+SRC_PATH = Path(__file__).parent
+DEFAULT_INDEX_FP = SRC_PATH.parent / "chain" / "index.sqlite"
+BATCH_SIZE = 500  # blocks per write transaction
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS txs (
+    hash BLOB PRIMARY KEY,
+    height INTEGER NOT NULL,
+    pos INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS txs_height ON txs (height);
+CREATE TABLE IF NOT EXISTS outputs (
+    tx_hash BLOB NOT NULL,
+    idx INTEGER NOT NULL,
+    address TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, idx)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS outputs_address ON outputs (address);
+CREATE INDEX IF NOT EXISTS outputs_height ON outputs (height);
+CREATE TABLE IF NOT EXISTS spends (
+    tx_hash BLOB NOT NULL,
+    idx INTEGER NOT NULL,
+    spent_by BLOB NOT NULL,
+    height INTEGER NOT NULL,
+    PRIMARY KEY (tx_hash, idx)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS spends_height ON spends (height);
+"""
+
+
+class ChainIndexException(Exception):
+    """Base class for chain index related exceptions"""
+
+
+def _hash_key(tx_hash: str) -> Optional[bytes]:
+    """Raw 32 byte key of a hex tx hash, None if it doesn't reference a tx"""
+    if not isinstance(tx_hash, str) or len(tx_hash) != 64:
+        return None  # i.e. the genesis input
+    try:
+        return bytes.fromhex(tx_hash)
+    except ValueError:
+        return None
+
+
+class ChainIndex:
+    def __init__(self, path: Path = DEFAULT_INDEX_FP, batch_size: int = BATCH_SIZE):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = batch_size
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        self._lock = threading.RLock()  # pending blocks are flushed by readers too
+        self._local = threading.local()  # per thread reader connections
+        self._readers: List[sqlite3.Connection] = []
+        self._pending = 0  # blocks waiting to be committed
+        self._txs: List[Tuple] = []
+        self._outputs: List[Tuple] = []
+        self._spends: List[Tuple] = []
+
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'height'").fetchone()
+        self.height = row[0] if row is not None else -1  # last indexed height
+
+    def reader(self) -> sqlite3.Connection:
+        """Read-only connection for the calling thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+            self._local.conn = conn
+            with self._lock:
+                self._readers.append(conn)
+        return conn
+
+    def _query(self, query: str, params: Tuple) -> sqlite3.Cursor:
+        """Run a read query, committing the pending blocks first"""
+        if self._pending:
+            self.flush()
+        return self.reader().execute(query, params)
+
+    def connect_block(self, block: dict, height: int = None):
+        """Queue a block (as from `Block.to_dict()`) to be indexed at `height`
+
+        Pending blocks are written in one transaction every `batch_size` blocks,
+        call `flush()` to write them sooner.
+        """
+        height = block["idx"] if height is None else height
+        txs, outputs, spends = [], [], []
+        for pos, tx in enumerate(block.get("txs") or []):
+            tx_key = _hash_key(tx["hash"])
+            if tx_key is None:
+                raise ChainIndexException(
+                    f"transaction {pos} of block {height} is unhashed"
+                )
+            txs.append((tx_key, height, pos))
+            for i, out in enumerate(tx["out"]):
+                amount = int(out["amount"])  # base units
+                outputs.append((tx_key, i, out["recipient"], amount, height))
+            for inp in tx["in"]:
+                spent = _hash_key(inp["tx"])
+                if spent is not None:
+                    spends.append((spent, inp["idx"], tx_key, height))
+
+        with self._lock:
+            if height != self.height + 1:
+                raise ChainIndexException(
+                    f"can't index block at height {height}, index is at {self.height}"
+                )
+            self._txs += txs
+            self._outputs += outputs
+            self._spends += spends
+            self.height = height
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Write all pending blocks in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return
+            with self.conn:
+                self.conn.executemany("INSERT INTO txs VALUES (?, ?, ?)", self._txs)
+                self.conn.executemany(
+                    "INSERT INTO outputs VALUES (?, ?, ?, ?, ?)", self._outputs
+                )
+                self.conn.executemany(
+                    "INSERT INTO spends VALUES (?, ?, ?, ?)", self._spends
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('height', ?)", (self.height,)
+                )
+            self._txs, self._outputs, self._spends = [], [], []
+            self._pending = 0
+
+    def disconnect_from(self, height: int):
+        """Remove every block from `height` up, i.e. on a reorg"""
+        with self._lock:
+            self.flush()
+            with self.conn:
+                for table in ("txs", "outputs", "spends"):
+                    self.conn.execute(f"DELETE FROM {table} WHERE height >= ?", (height,))
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('height', ?)", (height - 1,)
+                )
+            self.height = min(self.height, height - 1)
+
+    def sync(self, store):
+        """Index blocks of a BlockStore past the indexed height"""
+        for height in range(self.height + 1, len(store)):
+            self.connect_block(json.loads(bytes(store.get_block(height))), height)
+        self.flush()
+
+    def rebuild(self, store):
+        """Drop the index and reindex every block of a BlockStore"""
+        self.disconnect_from(0)
+        self.sync(store)
+
+    def find_tx(self, tx_hash: str) -> Optional[Tuple[int, int]]:
+        """(height, position) of a transaction, None if it isn't indexed"""
+        key = _hash_key(tx_hash)
+        if key is None:
+            return None
+        return self._query(
+            "SELECT height, pos FROM txs WHERE hash = ?", (key,)
+        ).fetchone()
+
+    def get_outputs(self, address: str, unspent_only: bool = False) -> List[dict]:
+        """Outputs paid to `address`, with the spending tx if they are spent"""
+        query = (
+            "SELECT o.tx_hash, o.idx, o.amount, o.height, s.spent_by, s.height "
+            "FROM outputs o LEFT JOIN spends s ON o.tx_hash = s.tx_hash AND o.idx = s.idx "
+            "WHERE o.address = ?"
+        )
+        if unspent_only:
+            query += " AND s.spent_by IS NULL"
+        rows = self._query(query + " ORDER BY o.height", (str(address),))
+        return [
+            {
+                "tx": tx_hash.hex(),
+                "idx": idx,
+                "amount": Amount(amount),
+                "height": height,
+                "spent_by": spent_by.hex() if spent_by is not None else None,
+                "spent_height": spent_height,
+            }
+            for tx_hash, idx, amount, height, spent_by, spent_height in rows
+        ]
+
+    def get_spends(self, address: str) -> List[dict]:
+        """Inputs spending outputs paid to `address`"""
+        rows = self._query(
+            "SELECT s.tx_hash, s.idx, s.spent_by, s.height "
+            "FROM spends s JOIN outputs o ON o.tx_hash = s.tx_hash AND o.idx = s.idx "
+            "WHERE o.address = ? ORDER BY s.height",
+            (str(address),),
+        )
+        return [
+            {
+                "tx": tx_hash.hex(),
+                "idx": idx,
+                "spent_by": spent_by.hex(),
+                "height": height,
+            }
+            for tx_hash, idx, spent_by, height in rows
+        ]
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            for conn in self._readers:
+                conn.close()
+            self._readers.clear()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    from blockstore import BlockStore
+
+    parser = argparse.ArgumentParser(description="ChickenTicket chain index")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--chain", type=Path, default=SRC_PATH.parent / "chain")
+    parser.add_argument("--db", type=Path, default=DEFAULT_INDEX_FP)
+    args = parser.parse_args()
+
+    with BlockStore(args.chain) as store:
+        index = ChainIndex(args.db)
+        index.rebuild(store)
+        print(f"Indexed {index.height + 1} blocks into {args.db}")
+        index.close()
@@ -0,0 +1,379 @@
+"""ChickenTicket compact transaction representations
+
+`Transaction`, `Input` and `Output` carry a per-instance `__dict__` and hex
+string hashes, which adds up to kilobytes per transaction. The slotted classes
+here store hashes, signatures and keys as raw bytes. `TransactionBatch` goes
+further and stores a whole block's transactions column-wise in `array`s and byte
+strings, with no object per transaction at all.
+"""
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from amount import Amount
+from transaction import Input, Output, Transaction
+
+HASH_SIZE = 32
+NO_IDX = -1  # stands in for a missing idx, ver or fee in integer columns
+
+
+def hash_to_bytes(tx_hash) -> bytes:
+    """Raw bytes of a hex hash, references that aren't hashes are kept as text"""
+    if tx_hash is None:
+        return b""
+    try:
+        raw = bytes.fromhex(tx_hash)
+    except ValueError:
+        raw = b""
+    return raw if len(raw) == HASH_SIZE else str(tx_hash).encode()
+
+
+def hash_from_bytes(raw: bytes) -> Optional[str]:
+    if not raw:
+        return None
+    return raw.hex() if len(raw) == HASH_SIZE else raw.decode()
+
+
+class CompactInput:
+    __slots__ = ("tx_hash", "output_id")
+
+    def __init__(self, tx_hash: bytes, output_id: int):
+        self.tx_hash = tx_hash
+        self.output_id = output_id
+
+    @classmethod
+    def from_input(cls, inp: Input):
+        return cls(hash_to_bytes(inp.tx_hash), inp.output_id)
+
+    def to_input(self) -> Input:
+        return Input(hash_from_bytes(self.tx_hash), self.output_id)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, CompactInput)
+            and self.tx_hash == other.tx_hash
+            and self.output_id == other.output_id
+        )
+
+    def __repr__(self):
+        return f"CompactInput({self.tx_hash.hex()}, {self.output_id})"
+
+
+class CompactOutput:
+    __slots__ = ("recipient", "amount")
+
+    def __init__(self, recipient: str, amount: int):
+        self.recipient = recipient
+        self.amount = amount  # base units
+
+    @classmethod
+    def from_output(cls, output: Output):
+        return cls(str(output.recipient), int(output.amount))
+
+    def to_output(self) -> Output:
+        return Output(self.recipient, Amount(self.amount))
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, CompactOutput)
+            and self.recipient == other.recipient
+            and self.amount == other.amount
+        )
+
+    def __repr__(self):
+        return f"CompactOutput({self.recipient}, {self.amount})"
+
+
+class CompactTransaction:
+    """Slotted, byte-oriented form of a Transaction
+
+    Hashes, the signature and the public key are raw bytes (empty when unset),
+    `fee` and output amounts are base units, `fee` is None when missing.
+    """
+
+    __slots__ = (
+        "idx",
+        "ver",
+        "timestamp",
+        "inputs",
+        "outputs",
+        "fee",
+        "proof",
+        "signature",
+        "pubkey",
+    )
+
+    def __init__(
+        self,
+        idx: Optional[int],
+        ver: Optional[int],
+        timestamp,
+        inputs: Tuple[CompactInput, ...],
+        outputs: Tuple[CompactOutput, ...],
+        fee: Optional[int],
+        proof: bytes,
+        signature: bytes,
+        pubkey: bytes,
+    ):
+        self.idx = idx
+        self.ver = ver
+        self.timestamp = timestamp
+        self.inputs = inputs
+        self.outputs = outputs
+        self.fee = fee
+        self.proof = proof
+        self.signature = signature
+        self.pubkey = pubkey
+
+    @classmethod
+    def from_transaction(cls, tx: Transaction):
+        return cls(
+            tx.idx,
+            tx.ver,
+            tx.timestamp,
+            tuple(CompactInput.from_input(inp) for inp in tx.inputs),
+            tuple(CompactOutput.from_output(out) for out in tx.outputs),
+            None if tx.fee is None else int(tx.fee),
+            bytes.fromhex(tx.proof) if tx.proof else b"",
+            bytes.fromhex(str(tx.signature)) if tx.signature else b"",
+            bytes.fromhex(str(tx.pubkey)) if tx.pubkey else b"",
+        )
+
+    def to_transaction(self) -> Transaction:
+        return Transaction(
+            idx=self.idx,
+            ver=self.ver,
+            timestamp=self.timestamp,
+            inputs=[inp.to_input() for inp in self.inputs],
+            outputs=[out.to_output() for out in self.outputs],
+            fee=None if self.fee is None else Amount(self.fee),
+            proof=self.proof.hex() or None,
+            signature=self.signature.hex() or None,
+            pubkey=self.pubkey.hex() or None,
+        )
+
+    @property
+    def total_output(self) -> int:
+        return sum(out.amount for out in self.outputs)
+
+    def __repr__(self):
+        return f"CompactTransaction({self.proof.hex()})"
+
+
+class _Blobs:
+    """Variable length byte strings packed into one bytearray with offsets"""
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array("I", [0])
+
+    def append(self, value: bytes):
+        self.data += value
+        self.offsets.append(len(self.data))
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self.data[self.offsets[i] : self.offsets[i + 1]])
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+
+class TransactionBatch:
+    """Struct-of-arrays storage for many transactions
+
+    Every field is a column. Inputs and outputs of all transactions share their
+    columns, `in_start[i]:in_start[i + 1]` are the inputs of transaction `i`.
+    Transactions are read back as CompactTransaction or Transaction objects.
+    """
+
+    def __init__(self, txs: Iterable[Transaction] = ()):
+        self.idx = array("q")
+        self.ver = array("q")
+        self.timestamps = array("d")
+        self.int_timestamps = bytearray()  # 1 where the timestamp was an int
+        self.fees = array("q")
+        self.proofs = bytearray()  # 32 bytes per transaction
+        self.signatures = _Blobs()
+        self.pubkeys = _Blobs()
+
+        self.in_start = array("I", [0])
+        self.in_hashes = _Blobs()
+        self.in_output_ids = array("I")
+
+        self.out_start = array("I", [0])
+        self.out_recipients = _Blobs()
+        self.out_amounts = array("q")
+
+        self._positions = None  # proof -> position, built on first lookup
+        self.extend(txs)
+
+    @classmethod
+    def from_block(cls, block):
+        return cls(block.transactions)
+
+    def __len__(self):
+        return len(self.fees)
+
+    def append(self, tx: Transaction):
+        if tx.proof is None:
+            tx.hash()
+        self.idx.append(NO_IDX if tx.idx is None else tx.idx)
+        self.ver.append(NO_IDX if tx.ver is None else tx.ver)
+        self.timestamps.append(tx.timestamp)
+        self.int_timestamps.append(isinstance(tx.timestamp, int))
+        self.fees.append(NO_IDX if tx.fee is None else int(tx.fee))
+        self.proofs += bytes.fromhex(tx.proof)
+        self.signatures.append(bytes.fromhex(str(tx.signature)) if tx.signature else b"")
+        self.pubkeys.append(bytes.fromhex(str(tx.pubkey)) if tx.pubkey else b"")
+
+        for inp in tx.inputs:
+            self.in_hashes.append(hash_to_bytes(inp.tx_hash))
+            self.in_output_ids.append(inp.output_id)
+        self.in_start.append(len(self.in_output_ids))
+
+        for out in tx.outputs:
+            self.out_recipients.append(str(out.recipient).encode())
+            self.out_amounts.append(int(out.amount))
+        self.out_start.append(len(self.out_amounts))
+
+        if self._positions is not None:
+            self._positions[tx.proof] = len(self) - 1
+
+    def extend(self, txs: Iterable[Transaction]):
+        for tx in txs:
+            self.append(tx)
+
+    def proof(self, i: int) -> str:
+        return self.proofs[i * HASH_SIZE : (i + 1) * HASH_SIZE].hex()
+
+    def position(self, proof: str) -> int:
+        """Position of the transaction with hash `proof`, -1 if it isn't here"""
+        if self._positions is None:
+            self._positions = {self.proof(i): i for i in range(len(self))}
+        return self._positions.get(proof, -1)
+
+    def __contains__(self, proof: str):
+        return self.position(proof) >= 0
+
+    def inputs(self, i: int) -> Iterator[Tuple[bytes, int]]:
+        """Raw (tx hash, output index) inputs of transaction `i`"""
+        for n in range(self.in_start[i], self.in_start[i + 1]):
+            yield self.in_hashes[n], self.in_output_ids[n]
+
+    def outputs(self, i: int) -> Iterator[Tuple[str, int]]:
+        """(recipient, base units) outputs of transaction `i`"""
+        for n in range(self.out_start[i], self.out_start[i + 1]):
+            yield self.out_recipients[n].decode(), self.out_amounts[n]
+
+    def total_output(self, i: int) -> int:
+        return sum(self.out_amounts[self.out_start[i] : self.out_start[i + 1]])
+
+    def total_fees(self) -> int:
+        return sum(fee for fee in self.fees if fee != NO_IDX)
+
+    def __getitem__(self, i: int) -> CompactTransaction:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("transaction batch index out of range")
+        timestamp = self.timestamps[i]
+        return CompactTransaction(
+            None if self.idx[i] == NO_IDX else self.idx[i],
+            None if self.ver[i] == NO_IDX else self.ver[i],
+            int(timestamp) if self.int_timestamps[i] else timestamp,
+            tuple(CompactInput(h, n) for h, n in self.inputs(i)),
+            tuple(CompactOutput(r, a) for r, a in self.outputs(i)),
+            None if self.fees[i] == NO_IDX else self.fees[i],
+            bytes(self.proofs[i * HASH_SIZE : (i + 1) * HASH_SIZE]),
+            self.signatures[i],
+            self.pubkeys[i],
+        )
+
+    def __iter__(self) -> Iterator[CompactTransaction]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def transactions(self) -> List[Transaction]:
+        return [tx.to_transaction() for tx in self]
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the columns"""
+        arrays = (
+            self.idx,
+            self.ver,
+            self.timestamps,
+            self.fees,
+            self.in_start,
+            self.in_output_ids,
+            self.out_start,
+            self.out_amounts,
+        )
+        blobs = (self.signatures, self.pubkeys, self.in_hashes, self.out_recipients)
+        return (
+            sum(a.itemsize * len(a) for a in arrays)
+            + sum(b.nbytes for b in blobs)
+            + len(self.proofs)
+            + len(self.int_timestamps)
+        )
+
+
+if __name__ == "__main__":
+    import os
+    import tracemalloc
+
+    from keys import KeyPair
+
+    COUNT = 20000
+    kp = KeyPair.new()
+    tx = Transaction(idx=0, ver=1, fee=Amount.from_coins("0.001"))
+    tx.add_input(Input(os.urandom(32).hex(), 0))
+    tx.add_output(Output("0x14f8031bf94c03f75577b39c0a2wpx", Amount.from_coins("12.5")))
+    tx.sign(kp)
+    signature, pubkey = tx.signature, tx.pubkey
+
+    def make_txs():
+        txs = []
+        for n in range(COUNT):
+            tx = Transaction(idx=n, ver=1, fee=Amount.from_coins("0.001"))
+            tx.add_input(Input(os.urandom(32).hex(), n % 4))
+            tx.add_output(
+                Output("0x14f8031bf94c03f75577b39c0a2wpx", Amount.from_coins("12.5"))
+            )
+            tx.add_output(
+                Output("0x5c3e9c1c8729d151e76267c7f02dpp", Amount.from_coins("7.25"))
+            )
+            tx.proof = os.urandom(32).hex()
+            tx.signature, tx.pubkey = signature, pubkey
+            txs.append(tx)
+        return txs
+
+    def measure(build):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = build()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return held, used
+
+    txs, tx_bytes = measure(make_txs)
+    compact, compact_bytes = measure(
+        lambda: [CompactTransaction.from_transaction(tx) for tx in txs]
+    )
+    batch, batch_bytes = measure(lambda: TransactionBatch(txs))
+
+    assert len(batch) == COUNT and batch.proof(7) == txs[7].proof
+    assert batch.position(txs[9].proof) == 9
+    assert batch[3].to_transaction().hash_payload() == txs[3].hash_payload()
+    assert batch.total_output(0) == Amount.from_coins("19.75")
+    assert compact[5].outputs == batch[5].outputs
+    unpriced = Transaction(idx=0, ver=1)
+    assert TransactionBatch([unpriced])[0].to_transaction().fee is None
+    assert CompactTransaction.from_transaction(unpriced).to_transaction().fee is None
+
+    print(f"bytes per transaction ({COUNT} transactions)")
+    print(f"  Transaction:        {tx_bytes / COUNT:8.0f}")
+    print(f"  CompactTransaction: {compact_bytes / COUNT:8.0f}")
+    print(f"  TransactionBatch:   {batch_bytes / COUNT:8.0f}")
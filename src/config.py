@@ -10,3 +10,4 @@ class Config:
     DEFAULT_WALLET_FP = Path(__file__).parent.parent / "wallet.der"
     MAGIC = "\xDapper\x00".encode("utf-8")  # We intercept the traffic if it starts with these bytes
     TESTNET = True
+    DIFFICULTY = 20  # leading zero bits of every block header hash
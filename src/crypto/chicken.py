@@ -1,4 +1,6 @@
+import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # set up logger
 logging.basicConfig(
@@ -19,6 +21,13 @@ except ImportError:
 
     USING_CRYPTODOME = False
 
+DIGEST_SIZE = 32
+# hashlib only releases the GIL while hashing a single input of at least this
+# many bytes, smaller payloads are hashed one at a time on any number of threads
+HASHLIB_GIL_MINSIZE = 2048
+# bytes in payloads of that size below which starting the threads costs more than
+# hashing them in parallel saves
+THREADED_MIN_BYTES = 2**20
 
 if USING_CRYPTODOME:
 
@@ -40,6 +49,115 @@ else:
         return sha3_256(blake2s(data).digest()).digest()
 
 
+def chicken_hasher(prefix: bytes = b""):
+    """Precompute the chicken hash state for a fixed prefix
+
+    Useful when many payloads share the same leading bytes (i.e. a block header
+    where only the nonce changes). hashlib is always used here since its BLAKE2s
+    objects can be copied, the digests are identical to `chicken_hash`.
+
+    Args:
+        prefix (bytes)
+            The bytes-like data every hashed payload starts with
+
+    Returns:
+        function taking the remaining bytes and returning the bytes-like hash
+        of `prefix + data`
+    """
+    midstate = hashlib.blake2s(prefix)
+    sha3_256_ = hashlib.sha3_256
+
+    def hasher(data: bytes):
+        h = midstate.copy()
+        h.update(data)
+        return sha3_256_(h.digest()).digest()
+
+    return hasher
+
+
+def _hash_chunk(payloads):
+    blake2s_, sha3_256_ = hashlib.blake2s, hashlib.sha3_256
+    return [sha3_256_(blake2s_(p).digest()).digest() for p in payloads]
+
+
+def _split_for_threads(payloads, threads):
+    """Split `payloads` into per-thread chunks, or return None when not worth it"""
+    if threads < 2 or len(payloads) < 2:
+        return None
+    unlocked = sum(len(p) for p in payloads if len(p) >= HASHLIB_GIL_MINSIZE)
+    if unlocked < THREADED_MIN_BYTES:
+        return None
+    size = -(-len(payloads) // threads)
+    return [payloads[i : i + size] for i in range(0, len(payloads), size)]
+
+
+def chicken_hash_many(payloads, threads: int = 0):
+    """Hash many payloads with the chicken algorithm chain
+
+    Avoids the per-call overhead of `chicken_hash` when hashing lots of small
+    payloads back-to-back. hashlib is always used since it is faster than
+    pycryptodomex for small inputs, the digests are identical.
+
+    Args:
+        payloads (iterable of bytes)
+            The bytes-like data to be hashed
+        threads (int)
+            Fan out to this many threads when enough of the input is in
+            payloads large enough for hashlib to release the GIL on
+
+    Returns:
+        list of bytes-like hashes, in the same order as `payloads`
+    """
+    if not isinstance(payloads, (list, tuple)):
+        payloads = list(payloads)
+
+    chunks = _split_for_threads(payloads, threads)
+    if chunks is None:
+        return _hash_chunk(payloads)
+
+    digests = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for chunk in pool.map(_hash_chunk, chunks):
+            digests.extend(chunk)
+    return digests
+
+
+def chicken_hash_into(payloads, out, threads: int = 0):
+    """Hash many payloads, writing the digests back-to-back into `out`
+
+    Args:
+        payloads (iterable of bytes)
+            The bytes-like data to be hashed
+        out (bytearray or writable memoryview)
+            Preallocated buffer of at least `DIGEST_SIZE * len(payloads)` bytes
+        threads (int)
+            See `chicken_hash_many`
+
+    Returns:
+        int number of digests written
+    """
+    if not isinstance(payloads, (list, tuple)):
+        payloads = list(payloads)
+
+    view = memoryview(out)
+    if len(view) < DIGEST_SIZE * len(payloads):
+        raise ValueError(
+            f"buffer of {len(view)} bytes can't hold {len(payloads)} digests"
+        )
+
+    if threads > 1:
+        digests = chicken_hash_many(payloads, threads)
+    else:
+        blake2s_, sha3_256_ = hashlib.blake2s, hashlib.sha3_256
+        digests = (sha3_256_(blake2s_(p).digest()).digest() for p in payloads)
+
+    pos = 0
+    for digest in digests:
+        view[pos : pos + DIGEST_SIZE] = digest
+        pos += DIGEST_SIZE
+    return pos // DIGEST_SIZE
+
+
 if __name__ == "__main__":
     # test stuff
     from binascii import hexlify
@@ -63,4 +181,10 @@ if __name__ == "__main__":
     finally:
         logging.debug(proof_hex)
 
+    payloads = [data] * 3
+    assert chicken_hash_many(payloads) == [proof] * 3
+    out = bytearray(DIGEST_SIZE * 3)
+    chicken_hash_into(payloads, out)
+    assert bytes(out) == proof * 3
+
     logging.info("Tests done!")
@@ -0,0 +1,91 @@
+"""ChickenTicket hierarchical deterministic key derivation
+
+Every child keypair of a master seed is derived from the seed and the child's
+index (see `KeyPair.derive`), so a wallet can be restored from its seed alone.
+Computing each child's public key is a point multiplication, so large batches
+are derived on a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Tuple
+
+from address import Address
+from keys import KeyPair, PrivKey, PubKey
+
+CHUNK_SIZE = 256  # children derived per worker task
+INLINE_MAX = 64  # batches this small are derived in-process
+GAP_LIMIT = 20  # unused addresses in a row before a scan stops
+
+
+def _derive_chunk(seed: bytes, start: int, count: int) -> List[Tuple[bytes, bytes]]:
+    """Raw (private key, public key) pairs of children [start, start + count)"""
+    keys = []
+    for index in range(start, start + count):
+        kp = KeyPair.derive(seed, index)
+        keys.append((kp.signing_key.to_string(), kp.verifying_key.to_string()))
+    return keys
+
+
+def derive_keypairs(
+    seed: bytes, start: int, count: int, workers: int = None
+) -> List[KeyPair]:
+    """Derive the child keypairs [start, start + count) of a master seed"""
+    workers = workers or os.cpu_count() or 1
+    if count <= INLINE_MAX or workers == 1:
+        raw = _derive_chunk(seed, start, count)
+    else:
+        starts = range(start, start + count, CHUNK_SIZE)
+        counts = [min(CHUNK_SIZE, start + count - s) for s in starts]
+        raw = []
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for chunk in pool.map(_derive_chunk, [seed] * len(counts), starts, counts):
+                raw.extend(chunk)
+
+    # the signing keys are parsed lazily, only when a key is used to sign
+    return [KeyPair(PubKey(pub), PrivKey(priv)) for priv, pub in raw]
+
+
+def derive_addresses(
+    seed: bytes, start: int, count: int, workers: int = None
+) -> List[Tuple[Address, KeyPair]]:
+    """Derive the child (address, keypair) pairs [start, start + count)"""
+    return [(Address.new(kp), kp) for kp in derive_keypairs(seed, start, count, workers)]
+
+
+def scan_addresses(
+    seed: bytes,
+    is_used: Callable[[Address], bool],
+    gap_limit: int = GAP_LIMIT,
+    workers: int = None,
+) -> List[Tuple[Address, KeyPair]]:
+    """Find the used addresses of a master seed
+
+    Derives addresses in batches of `gap_limit` until `gap_limit` addresses in a
+    row are unused. Returns every (address, keypair) up to the last used one.
+    """
+    found = []
+    last_used = -1
+    start = 0
+    while start - last_used <= gap_limit:
+        batch = derive_addresses(seed, start, gap_limit, workers)
+        for i, pair in enumerate(batch):
+            if is_used(pair[0]):
+                last_used = start + i
+        found.extend(batch)
+        start += gap_limit
+    return found[: last_used + 1]
+
+
+if __name__ == "__main__":
+    import time
+
+    seed = os.urandom(32)
+    began = time.perf_counter()
+    pairs = derive_addresses(seed, 0, 2000)
+    elapsed = time.perf_counter() - began
+    print(f"derived {len(pairs)} addresses in {elapsed:.2f}s")
+
+    assert str(pairs[5][0]) == str(Address.new(KeyPair.derive(seed, 5)))
+    used = {str(pairs[i][0]) for i in (0, 3, 30)}
+    found = scan_addresses(seed, lambda a: str(a) in used)
+    assert len(found) == 31
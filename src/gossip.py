@@ -0,0 +1,359 @@
+"""ChickenTicket inventory gossip
+
+New blocks and transactions are relayed over `network.ConnectionPooler` frames
+by hash first:
+
+    inv      hashes a peer has, sent in batches
+    getdata  hashes a peer wants, answered with `block` and `tx` frames, the
+             object's hash followed by the serialized object
+    notfound hashes of a getdata the peer doesn't have anymore
+
+An object is fetched from only one of the peers that announce it, and only if
+it wasn't seen before, objects nobody was asked for are dropped. Seen hashes
+are kept in a bounded LRU, every peer also gets a smaller one of the hashes
+it's known to have so nothing is announced back to where it came from.
+Transaction announcements trickle out in batches every `trickle_interval`
+seconds, blocks are announced right away.
+"""
+import asyncio
+import json
+import random
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from block import Block
+from miner import check_proof_of_work
+from network import ConnectionPooler, Peer
+from peers import MALFORMED_MESSAGE
+from serialization import (
+    Reader,
+    SerializationException,
+    decode_block,
+    decode_transaction,
+    encode_block,
+    encode_transaction,
+    write_varint,
+)
+
+INV_TX = 1
+INV_BLOCK = 2
+INV_ITEM = struct.Struct(">B32s")  # kind, hash
+OBJECT_COMMANDS = {INV_TX: "tx", INV_BLOCK: "block"}
+
+MAX_INV_ITEMS = 1000  # per inv, getdata or notfound frame
+MAX_SEEN = 100_000  # hashes remembered as seen
+MAX_PEER_KNOWN = 10_000  # hashes remembered per peer
+TRICKLE_INTERVAL = 0.5  # seconds between transaction announcement batches
+GETDATA_TIMEOUT = 10  # seconds before an object is asked from another peer
+UNSOLICITED_OBJECT = 10  # misbehavior points for an object that wasn't asked for
+
+InvItem = Tuple[int, bytes]  # kind, hash
+
+# (kind, hash) -> serialized object or None
+GetObject = Callable[[int, bytes], Optional[bytes]]
+# (peer, kind, hash, payload) -> whether the object is new, valid and has `hash`
+AcceptObject = Callable[[Peer, int, bytes, memoryview], Union[bool, Awaitable]]
+
+
+class GossipException(Exception):
+    """Base class for gossip related exceptions"""
+
+
+class SeenSet:
+    """Set of hashes that forgets the least recently added ones past `maxsize`"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item) -> bool:
+        """Add an item, returns False if it was already in the set"""
+        if item in self._items:
+            self._items.move_to_end(item)
+            return False
+        self._items[item] = None
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+        return True
+
+
+def encode_inv(items: List[InvItem]) -> bytes:
+    out = bytearray()
+    write_varint(out, len(items))
+    for kind, h in items:
+        out += INV_ITEM.pack(kind, h)
+    return bytes(out)
+
+
+def decode_inv(data) -> List[InvItem]:
+    reader = Reader(data)
+    count = reader.varint()
+    if count > MAX_INV_ITEMS:
+        raise GossipException(f"{count} inventory items is over the limit")
+    if len(data) != reader.pos + count * INV_ITEM.size:
+        raise GossipException("inventory length doesn't match its count")
+    return [reader.unpack(INV_ITEM) for _ in range(count)]
+
+
+class Gossip:
+    def __init__(
+        self,
+        pooler: ConnectionPooler,
+        get_object: GetObject,
+        accept_object: AcceptObject,
+        trickle_interval: float = TRICKLE_INTERVAL,
+        getdata_timeout: float = GETDATA_TIMEOUT,
+    ):
+        self.pooler = pooler
+        self.peer_manager = pooler.peer_manager
+        self.get_object = get_object
+        self.accept_object = accept_object
+        self.trickle_interval = trickle_interval
+        self.getdata_timeout = getdata_timeout
+
+        self.seen = SeenSet(MAX_SEEN)  # items this node has
+        self.known: Dict[Peer, SeenSet] = {}  # items each peer has
+        self.queued: Dict[Peer, List[InvItem]] = {}  # announcements to trickle
+        self.requested: Dict[InvItem, Tuple[Peer, float]] = {}  # item -> peer, since
+        self._task: Optional[asyncio.Task] = None
+
+        pooler.add_handler("inv", self.on_inv)
+        pooler.add_handler("getdata", self.on_getdata)
+        pooler.add_handler("notfound", self.on_notfound)
+        for kind, command in OBJECT_COMMANDS.items():
+            pooler.add_handler(command, self._object_handler(kind))
+
+    def _known(self, peer: Peer) -> SeenSet:
+        known = self.known.get(peer)
+        if known is None:
+            known = self.known[peer] = SeenSet(MAX_PEER_KNOWN)
+        return known
+
+    def start(self):
+        """Start trickling announcements, call from the event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._trickle())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def announce(self, kind: int, h: bytes, source: Peer = None):
+        """Announce an object this node has to every peer but `source`"""
+        item = (kind, bytes(h))
+        self.seen.add(item)
+        if source is not None:
+            self._known(source).add(item)
+        for peer in list(self.pooler.peers):
+            if item not in self._known(peer):
+                self.queued.setdefault(peer, []).append(item)
+        if kind == INV_BLOCK:
+            await self.flush()
+
+    async def flush(self):
+        """Send every peer the announcements queued for it, the fastest first"""
+        queued, self.queued = self.queued, {}
+        for peer in self.peer_manager.rank(queued):
+            items = queued[peer]
+            if peer not in self.pooler.peers:
+                continue
+            known = self._known(peer)
+            items = [item for item in items if known.add(item)]
+            for i in range(0, len(items), MAX_INV_ITEMS):
+                await self._send(peer, "inv", items[i : i + MAX_INV_ITEMS])
+
+    async def _trickle(self):
+        while True:
+            # jitter so announcements don't reveal which peer they came from first
+            await asyncio.sleep(self.trickle_interval * random.uniform(0.5, 1.5))
+            self._forget_disconnected()
+            self._expire_requests()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[Gossip] trickle failed ({type(e).__name__}: {e})")
+
+    def _forget_disconnected(self):
+        for peer in list(self.known):
+            if peer not in self.pooler.peers:
+                del self.known[peer]
+                self.queued.pop(peer, None)
+
+    def _expire_requests(self):
+        # rejected and lost objects, asked again from the next peer to announce
+        now = time.monotonic()
+        for item, (_, since) in list(self.requested.items()):
+            if now - since >= self.getdata_timeout:
+                del self.requested[item]
+
+    async def _send(self, peer: Peer, command: str, items: List[InvItem]):
+        try:
+            await self.pooler.write_peer(peer, command, encode_inv(items))
+        except (ValueError, RuntimeError, ConnectionError) as e:
+            print(f"[Gossip] can't send {command} to {peer} ({e})")
+
+    def _decode_inv(self, peer: Peer, payload: memoryview) -> List[InvItem]:
+        try:
+            return decode_inv(payload)
+        except (GossipException, SerializationException, struct.error) as e:
+            self.peer_manager.misbehaving(peer, MALFORMED_MESSAGE, str(e))
+            return []
+
+    async def on_inv(self, peer: Peer, payload: memoryview):
+        if self.peer_manager.is_banned(peer):
+            return
+        now = time.monotonic()
+        known = self._known(peer)
+        wanted = []
+        for item in self._decode_inv(peer, payload):
+            known.add(item)
+            if item in self.seen:
+                continue
+            request = self.requested.get(item)
+            if request is not None and now - request[1] < self.getdata_timeout:
+                continue  # another peer is sending it
+            self.requested[item] = (peer, now)
+            wanted.append(item)
+        if wanted:
+            await self._send(peer, "getdata", wanted)
+
+    async def on_getdata(self, peer: Peer, payload: memoryview):
+        missing = []
+        for kind, h in self._decode_inv(peer, payload):
+            data = self.get_object(kind, h) if kind in OBJECT_COMMANDS else None
+            if data is None:
+                missing.append((kind, h))
+                continue
+            await self.pooler.write_peer(peer, OBJECT_COMMANDS[kind], h + data)
+        if missing:
+            await self._send(peer, "notfound", missing)
+
+    async def on_notfound(self, peer: Peer, payload: memoryview):
+        for item in self._decode_inv(peer, payload):
+            request = self.requested.get(item)
+            if request is not None and request[0] == peer:
+                del self.requested[item]  # the next announcer is asked instead
+
+    def _object_handler(self, kind: int):
+        async def handler(peer: Peer, payload: memoryview):
+            h = bytes(payload[:32])
+            request = self.requested.get((kind, h))
+            if len(h) < 32 or request is None or request[0] != peer:
+                command = OBJECT_COMMANDS[kind]
+                self.peer_manager.misbehaving(
+                    peer, UNSOLICITED_OBJECT, f"unsolicited {command} {h.hex()}"
+                )
+                return
+            del self.requested[(kind, h)]
+            elapsed = time.monotonic() - request[1]
+            self.peer_manager.record(peer, elapsed)
+            self.peer_manager.record_transfer(peer, len(payload), elapsed)
+
+            accepted = self.accept_object(peer, kind, h, payload[32:])
+            if asyncio.iscoroutine(accepted):
+                accepted = await accepted
+            if accepted:
+                await self.announce(kind, h, source=peer)
+
+        return handler
+
+
+class NodeInventory:
+    """`get_object` and `accept_object` callbacks for an HTTPNode
+
+    Blocks are only accepted once the node is synced and only on top of its tip,
+    side chains are left to the next `sync_chain`. Objects are checked and added
+    on the default executor, one at a time.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self._lock = threading.Lock()
+
+    def get_object(self, kind: int, h: bytes) -> Optional[bytes]:
+        if kind == INV_TX:
+            tx = self.node.mempool.get(h.hex())
+            return encode_transaction(tx) if tx is not None else None
+        if kind == INV_BLOCK:
+            tip = self.node.tip
+            if tip is not None and tip.proof == h.hex():
+                return encode_block(tip)
+            data = self.node.store.get_block_by_hash(h)
+            if data is None:
+                return None
+            return encode_block(Block.from_dict(json.loads(data)))
+        return None
+
+    async def accept_object(self, peer: Peer, kind: int, h: bytes, payload):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._accept, kind, h, payload)
+        except Exception as e:
+            command = OBJECT_COMMANDS[kind]
+            print(f"[Gossip] rejected {command} from {peer}:", type(e), str(e))
+        return False
+
+    def _accept(self, kind: int, h: bytes, payload) -> bool:
+        with self._lock:
+            if kind == INV_TX:
+                return self._accept_tx(h, payload)
+            return self._accept_block(h, payload)
+
+    def _accept_tx(self, h: bytes, payload) -> bool:
+        node = self.node
+        tx = decode_transaction(payload)
+        tx_hash = tx.hash()  # recomputed, not the claimed one
+        if tx_hash != h.hex():
+            raise GossipException(f"transaction {tx_hash} was sent as {h.hex()}")
+        if tx_hash in node.mempool:
+            return False
+        # the UTXO set is current, unlike the batched chain index, and a
+        # confirmed transaction's inputs are spent already
+        for inp in tx.inputs:
+            if node.utxos.get(inp.tx_hash, inp.output_id) is None and not (
+                _pooled_output(node.mempool, inp.tx_hash, inp.output_id)
+            ):
+                raise GossipException(
+                    f"{inp.tx_hash}:{inp.output_id} is missing or already spent"
+                )
+        node.mempool.add(tx)
+        return True
+
+    def _accept_block(self, h: bytes, payload) -> bool:
+        node = self.node
+        if not node.is_synced:
+            return False
+        block = decode_block(payload)
+        if block.proof != h.hex():
+            raise GossipException(f"block {block.proof} was sent as {h.hex()}")
+        if h in node.store:
+            return False
+        height = node.store.height
+        if block.idx != height + 1 or (
+            height >= 0 and block.previous_proof != node.store.get_hash(height).hex()
+        ):
+            raise GossipException(f"block {block.idx} doesn't extend the tip")
+        difficulty = node.config.DIFFICULTY
+        if not check_proof_of_work(block.header, difficulty):
+            raise GossipException(
+                f"block {block.idx} doesn't meet difficulty {difficulty}"
+            )
+        block.validate(node.mempool.verifier, node.utxos)
+        node.add_block(block)
+        return True
+
+
+def _pooled_output(mempool, tx_hash: str, output_id: int) -> bool:
+    """Whether an unconfirmed transaction in the mempool has the output"""
+    tx = mempool.get(tx_hash)
+    return tx is not None and 0 <= output_id < len(tx.outputs)
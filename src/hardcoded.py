@@ -1,3 +1,4 @@
+from amount import Amount
 from block import Block
 from transaction import Input, Output, Transaction, TXVersion
 from utils.time_tools import get_timestamp
@@ -8,7 +9,7 @@ def generate_genesis_tx(genesis_wallet):
 
     i = Input("n0hash", 0)  # the block hash from which funds are located, and txid
     o = Output(
-        genesis_wallet.addresses[0][0], 1000000000
+        genesis_wallet.addresses[0][0], Amount.from_coins(1000000000)
     )  # address to send funds and amount
 
     tx = Transaction(
@@ -1,27 +1,45 @@
+import asyncio
 import json
-import random as rand
+import threading
+import time
 from pathlib import Path
-from typing import List
+from typing import Iterator, List
 
 import requests as r
-from flask import Flask, Response, jsonify, make_response, request, session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import hardcoded
-from block import Block
+from asynchttp import AsyncHTTPServer, HTTPException, Request, Response
+from block import Block, BlockHeader
+from blockstore import BlockStore
+from chainindex import ChainIndex
 from config import Config
+from gossip import Gossip, NodeInventory
+from mempool import Mempool
+from network import P2PConnector, Peer
+from peers import KeepAlive, PeerManager
+from quorum import DEADLINE, QUORUM, query_heights, query_quorum, quorum_size
+from serialization import (
+    HEADER_RECORD_SIZE,
+    decode_header_records,
+    encode_header_record,
+)
+from sync import ChainSync, SyncException, download_headers, window_bytes
+from utxo import UTXOSet
 
 SRC_PATH = Path(__file__).parent
+MAX_BLOCKS_PER_REQUEST = 1000  # blocks streamed by one `get_blocks` request
+MAX_HEADERS_PER_REQUEST = 2000  # header records sent by one `get_headers` request
+STREAM_CHUNK_SIZE = 64 * 2**10  # bytes of blocks sent per chunk
 
-
-class EndpointAction:
-    def __init__(self, action, mimetype="application/json"):
-        self.action = action
-        self.response = Response(status=200, headers={}, mimetype=mimetype)
-
-    def __call__(self, *args):
-        action_result = self.action()
-        self.response.data = action_result
-        return self.response
+CONNECT_TIMEOUT = 3.05  # seconds
+READ_TIMEOUT = 10
+RETRIES = 3
+BACKOFF_FACTOR = 0.25  # retries wait 0.25s, 0.5s, 1s, ...
+POOL_SIZE = 8  # keep-alive connections per peer
+LATENCY_SMOOTHING = 0.2  # weight of the newest request in `HTTPPeer.latency`
+P2P_PORT_OFFSET = 1  # nodes listen for gossip frames on their HTTP port + 1
 
 
 class StatusError(Exception):
@@ -29,30 +47,104 @@ class StatusError(Exception):
 
 
 class HTTPPeer:
-    def __init___(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        retries: int = RETRIES,
+        pool_size: int = POOL_SIZE,
+        manager: PeerManager = None,
+    ):
         self.host = host
-        self.port = port
+        self.port = int(port)
+        self.timeout = timeout  # (connect, read) seconds
+        self.manager = manager  # node wide peer health, if any
 
         self.connected = False
 
-    def send_request(self, endpoint, **kwargs):
+        # keep-alive connections to the peer, idempotent GETs are retried on
+        # connection errors and 502/503/504 with exponential backoff
+        self.session = r.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=BACKOFF_FACTOR,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            raise_on_status=False,
+        )
+        self.session.mount(
+            "http://",
+            HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=pool_size,
+                pool_block=True,
+                max_retries=retry,
+            ),
+        )
+
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.latency = None  # moving average of request seconds
+        self.last_latency = None
+
+    def __eq__(self, other):
+        return isinstance(other, HTTPPeer) and (self.host, self.port) == (
+            other.host,
+            other.port,
+        )
+
+    def __hash__(self):
+        return hash((self.host, self.port))
+
+    def __repr__(self):
+        return f"HTTPPeer({self.host}:{self.port})"
+
+    def url(self, endpoint):
+        return f"http://{self.host}:{self.port}/api/{endpoint}"
+
+    def _record(self, elapsed: float, ok: bool):
+        if self.manager is not None:
+            self.manager.record(self, elapsed, ok)
+        with self._stats_lock:
+            self.requests += 1
+            if not ok:
+                self.failures += 1
+                return
+            self.last_latency = elapsed
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency += LATENCY_SMOOTHING * (elapsed - self.latency)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "failures": self.failures,
+                "latency": self.latency,
+                "last_latency": self.last_latency,
+            }
+
+    def send_request(self, endpoint, **params):
+        """GET `/api/<endpoint>` with query `params`, returns the decoded JSON"""
+        began = time.perf_counter()
         try:
-            query = None
-            if len(kwargs) > 0:
-                query = "?"
-                for k, v in kwargs.items():
-                    query += f"{k}={v},"
-                query = query[:-1]  # remove trailing comma
-            resp = r.get(
-                f"http://{self.host}:{self.port}/api/{endpoint}{query if query is not None else ''}",
-                timeout=10,
+            resp = self.session.get(
+                self.url(endpoint), params=params, timeout=self.timeout
             )
             if resp.status_code != 200:
-                raise StatusError
-            else:
-                return resp.json()
-        except:
+                raise StatusError(f"{self} {endpoint} returned {resp.status_code}")
+            data = resp.json()
+        except Exception:
+            self._record(time.perf_counter() - began, False)
             raise
+        self._record(time.perf_counter() - began, True)
+        return data
+
+    def close(self):
+        self.session.close()
 
     def connect(self, listen):
         try:
@@ -71,20 +163,54 @@ class HTTPPeer:
     def get_block(self, height):
         return self.send_request("get_block", h=height)
 
+    def get_headers(self, start: int, count: int = MAX_HEADERS_PER_REQUEST):
+        """(BlockHeader, block proof) pairs of up to `count` blocks from `start`"""
+        began = time.perf_counter()
+        try:
+            resp = self.session.get(
+                self.url("get_headers"),
+                params={"from": start, "count": count},
+                timeout=self.timeout,
+            )
+            if resp.status_code != 200:
+                raise StatusError(f"{self} get_headers returned {resp.status_code}")
+            headers = decode_header_records(resp.content)
+        except Exception:
+            self._record(time.perf_counter() - began, False)
+            raise
+        self._record(time.perf_counter() - began, True)
+        return headers
 
-class FlaskAppWrapper:
-    def __init__(self, host, port, name=__name__):
-        self.host = host
-        self.port = port
-
-        self._name = name
-        self.app = Flask(self._name)
-
-    def run(self, **kwargs):
-        self.app.run(host=self.host, port=self.port, **kwargs)
+    def iter_blocks(
+        self, start: int, count: int = MAX_BLOCKS_PER_REQUEST
+    ) -> Iterator[dict]:
+        """Stream up to `count` blocks from height `start` in one request
 
-    def add_endpoint(self, endpoint=None, endpoint_name=None, handler=None):
-        self.app.add_url_rule(endpoint, endpoint_name, EndpointAction(handler))
+        Yields block dicts as they arrive, stops early at the peer's tip.
+        """
+        began = time.perf_counter()
+        try:
+            resp = self.session.get(
+                self.url("get_blocks"),
+                params={"from": start, "count": count},
+                stream=True,
+                timeout=self.timeout,
+            )
+        except Exception:
+            self._record(time.perf_counter() - began, False)
+            raise
+        # latency to the response head, the body streams for a while
+        self._record(time.perf_counter() - began, resp.status_code == 200)
+        received = 0
+        with resp:
+            if resp.status_code != 200:
+                raise StatusError(f"{self} get_blocks returned {resp.status_code}")
+            for line in resp.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                if line:
+                    received += len(line)
+                    yield json.loads(line)
+        if self.manager is not None:
+            self.manager.record_transfer(self, received, time.perf_counter() - began)
 
 
 def index(node):
@@ -106,37 +232,87 @@ class HTTPNode:
         peers_list: List = [],
         wallet=None,
         config=Config,
-        connect_cb=None
+        connect_cb=None,
+        chain_dir: Path = SRC_PATH.parent / "chain",
+        p2p_port: int = None,
     ):
         self.host = host
         self.port = port
+        self.p2p_port = port + P2P_PORT_OFFSET if p2p_port is None else p2p_port
         self.peers_list = peers_list
         self.wallet = wallet
         self.config = config
         self.connect_cb = connect_cb  # callback to call when connections have changed
 
-        self.app = FlaskAppWrapper(self.host, self.port)
-
-        self.chain: List[Block] = []
+        self.app = AsyncHTTPServer(self.host, self.port)
+
+        self.store = BlockStore(chain_dir)  # serialized blocks by height and hash
+        # tx and address lookups
+        self.index = ChainIndex(Path(chain_dir) / "index.sqlite")
+        self.utxos = UTXOSet(Path(chain_dir) / "utxo.sqlite")  # unspent outputs
+        self.mempool = Mempool()  # unconfirmed transactions
+        self.peer_manager = PeerManager()  # health of each peer, for peer selection
+        self.tip: Block = None  # last block added by this node
+        # packed header records of heights [0, n), filled as they are requested
+        self._header_records = bytearray()
+        self._header_lock = threading.Lock()
         self.peers: List[HTTPPeer] = []
         self.is_synced = False  # run `node.sync_chain()`
         self.synced_height = 0  # current height that has been synced
+        # sync and gossip both add blocks on top of the tip
+        self._block_lock = threading.Lock()
+
+        # blocks and transactions are relayed over framed P2P connections
+        self.p2p = P2PConnector(
+            self.host,
+            self.p2p_port,
+            lambda peer, command, payload: None,  # unknown commands are dropped
+            use_random_ports=False,
+            peer_port=0,  # any free local port
+            peer_manager=self.peer_manager,
+        )
+        self.inventory = NodeInventory(self)
+        self.gossip = Gossip(
+            self.p2p.pooler, self.inventory.get_object, self.inventory.accept_object
+        )
+        # pings, drops dead peers and reconnects outbound ones with backoff
+        self.keepalive = KeepAlive(self.p2p.pooler, self.peer_manager)
+        self._p2p_thread: threading.Thread = None
+        self._p2p_ready = threading.Event()  # the task can be cancelled, or it ended
+        self._p2p_loop: asyncio.AbstractEventLoop = None
+        self._p2p_task: asyncio.Task = None
 
     def setup(self):
         # setup node endpoints
         self.app.add_endpoint(
-            endpoint="/", endpoint_name="index", handler=lambda: index(self)
+            endpoint="/",
+            endpoint_name="index",
+            handler=lambda request: index(self),
+            blocking=False,
         )
         self.app.add_endpoint(
             endpoint="/api/get_height",
             endpoint_name="get_height",
             handler=self.get_height,
+            blocking=False,
         )
         self.app.add_endpoint(
             endpoint="/api/get_block",
             endpoint_name="get_block",
             handler=self.get_block,
         )
+        self.app.add_endpoint(
+            endpoint="/api/get_blocks",
+            endpoint_name="get_blocks",
+            handler=self.get_blocks,
+            mimetype="application/x-ndjson",
+        )
+        self.app.add_endpoint(
+            endpoint="/api/get_headers",
+            endpoint_name="get_headers",
+            handler=self.get_headers,
+            mimetype="application/octet-stream",
+        )
         self.app.add_endpoint(
             endpoint="/api/connect",
             endpoint_name="connect",
@@ -154,8 +330,7 @@ class HTTPNode:
 
             print(host, port)
             print(f"Attempting connection to {host}:{port}")
-            p = HTTPPeer()
-            p.host, p.port = host, int(port)
+            p = HTTPPeer(host, int(port), manager=self.peer_manager)
 
             try:
                 connected = p.connect(self.port)
@@ -171,9 +346,11 @@ class HTTPNode:
         #self.connect_cb(len(self.peers))
 
         # Load chain
-        chain_fp = SRC_PATH.parent / "chain/blockchain.json"
-        print("Loading blockchain.json")
-        if not chain_fp.exists():
+        print(f"Loaded {len(self.store)} blocks from {self.store.path}")
+        self.synced_height = max(self.store.height, 0)
+        self.index.sync(self.store)  # catch up on blocks stored before a crash
+        self.utxos.sync(self.store)
+        if len(self.store) == 0:
             # create chain if it doesn't exist
 
             # check with peers first to find the most commonly accepted genesis and start from there
@@ -183,17 +360,42 @@ class HTTPNode:
                 # generate from genesis
                 tx = hardcoded.generate_genesis_tx(self.wallet)
                 block = hardcoded.generate_genesis_block(tx)
-                self.chain.append(block)
+                self.add_block(block)
 
         return self
 
-    def connect(self):
+    def add_block(self, block: Block):
+        """Persist a block on top of the chain"""
+        with self._block_lock:
+            return self._add_block(block)
+
+    def _add_block(self, block: Block):
+        height = self.store.height + 1
+        self.utxos.apply_block(block, height)  # raises if it spends missing coins
+        try:
+            self.store.append(bytes.fromhex(block.proof), block.json().encode())
+        except Exception:
+            # the chainstate must not run ahead of the stored chain
+            self.utxos.undo_block(block, height)
+            raise
+        self.utxos.flush_if_full()
+        # once stored the block stays, an index that fails here catches up from
+        # the store with `index.sync` on the next start
+        self.index.connect_block(block.to_dict(), height)
+        self.mempool.remove_for_block(block)
+        with self._header_lock:
+            if len(self._header_records) == height * HEADER_RECORD_SIZE:
+                self._header_records += encode_header_record(block.header, block.proof)
+        self.tip = block
+        self.synced_height = height
+        return height
+
+    def connect(self, request: Request):
         print(f"Callback: {self.connect_cb}")
         host, port = request.remote_addr, request.args.get("listen")
         print(f"Received connect signal: {host}:{port}")
         try:
-            p = HTTPPeer()
-            p.host, p.port = host, int(port)
+            p = HTTPPeer(host, int(port), manager=self.peer_manager)
             if p in self.peers:
                 return json.dumps({"connected": "already"})
             
@@ -208,97 +410,188 @@ class HTTPNode:
             connected = False
         return json.dumps({"connected": connected})
 
-    def get_height(self):
+    def get_height(self, request: Request):
         """Endpoint `get_height`"""
         return json.dumps(
             {"height": self.synced_height}
-        )  # last block from in-memory chain
+        )  # last block in the block store
+
+    def get_block(self, request: Request):
+        """Endpoint `get_block`, the block at height `h`"""
+        h = request.args.get("h", type=int)
+        if h is None:
+            raise HTTPException(400, "missing height `h`")
+        if not 0 <= h <= self.store.height:
+            return json.dumps({"block": None})
+        # blocks are stored serialized, send them as they are
+        return Response(bytes(self.store.get_block(h)))
+
+    def get_blocks(self, request: Request):
+        """Endpoint `get_blocks`, stream `count` blocks from height `from`
+
+        The blocks are sent as newline delimited JSON, read from the block store
+        as the response is written.
+        """
+        start = request.args.get("from", type=int)
+        count = request.args.get("count", MAX_BLOCKS_PER_REQUEST, type=int)
+        if start is None or start < 0 or count is None or count < 0:
+            raise HTTPException(400, "expected `from` and `count` heights")
+        end = min(start + min(count, MAX_BLOCKS_PER_REQUEST), self.store.height + 1)
+        return Response(
+            stream=self._stream_blocks(start, end), mimetype="application/x-ndjson"
+        )
 
-    def get_block(self):
-        try:
-            h = int(request.args.get("h"))
-            print(f"Getting block at height {h}")
-            print(f"Current height: {len(self.chain) - 1}")
-            print(self.chain)
-            
-            if h > self.synced_height:
-                return json.dumps({"block": None})
+    def header_records(self, start: int, end: int) -> bytes:
+        """Packed header records of heights [start, end)"""
+        size = HEADER_RECORD_SIZE
+        with self._header_lock:
+            for h in range(len(self._header_records) // size, end):
+                data = json.loads(bytes(self.store.get_block(h)))
+                header = BlockHeader.from_dict(data["header"])
+                self._header_records += encode_header_record(header, data["hash"])
+            return bytes(self._header_records[start * size : end * size])
+
+    def get_headers(self, request: Request):
+        """Endpoint `get_headers`, packed header records of `count` blocks from `from`"""
+        start = request.args.get("from", type=int)
+        count = request.args.get("count", MAX_HEADERS_PER_REQUEST, type=int)
+        if start is None or start < 0 or count is None or count < 0:
+            raise HTTPException(400, "expected `from` and `count` heights")
+        end = min(start + min(count, MAX_HEADERS_PER_REQUEST), self.store.height + 1)
+        return Response(
+            self.header_records(start, end) if start < end else b"",
+            mimetype="application/octet-stream",
+        )
 
+    def _stream_blocks(self, start: int, end: int) -> Iterator[bytes]:
+        chunk = bytearray()
+        for h in range(start, end):
+            chunk += self.store.get_block(h)
+            chunk += b"\n"
+            if len(chunk) >= STREAM_CHUNK_SIZE:
+                yield bytes(chunk)
+                chunk.clear()
+        if chunk:
+            yield bytes(chunk)
+
+    def choose_peers_at_height(self, height, quorum=QUORUM, deadline=DEADLINE):
+        """Choose peers that agree on a block at given height
+
+        All available peers are asked at once, see `quorum.query_quorum`.
+        """
+        print(f"CHOOSE: {height}")
+        peers = self.peer_manager.rank(self.peers)
+        result = query_quorum(peers, height, quorum, deadline)
+        if result.slow:
+            print(f"CHOOSE: {len(result.slow)} peers missed the deadline")
+        return result
+
+    def sync_chain(self, progress_cb=print):
+        """Download the chain agreed on by most peers, from all of them at once"""
+        peers = self.peer_manager.rank(self.peers)  # banned and backed off skipped
+        heights = list(query_heights(peers).values())  # asked at once, see `quorum`
+        needed = quorum_size(len(peers))
+        if len(heights) < needed:
+            print(f"SYNC: {len(heights)} of {len(peers)} peers answered, no quorum")
+            return self.synced_height
+        # highest height enough peers have reached for a quorum to be possible
+        height = sorted(heights, reverse=True)[needed - 1]
+        print(f"SYNC: getting height {height}")
+
+        # choose chain from peer(s) with most common block proof, fastest first
+        chosen = self.choose_peers_at_height(height)
+        if not chosen.reached:
+            # a plurality or the fastest peer alone doesn't pick the chain
+            print(
+                f"SYNC: no quorum at {height}, "
+                f"{chosen.count} of {len(peers)} peers agree on {chosen.proof}"
+            )
+            return self.synced_height
+        tip_proof = chosen.proof
+        peers = self.peer_manager.rank(chosen.peers, window_bytes())
+        start = self.store.height + 1
+        if height >= start:
+            # headers first, a bad fork is rejected before any body is downloaded
+            previous = self.store.get_hash(start - 1).hex() if start > 0 else None
             try:
-                return json.dumps(self.chain[h].json())
-            except Exception as e:
-                print(
-                    f"Failed to send `get_block` response for height {h}"
-                    + "\n"
-                    + f"{type(e)} {str(e)}"
+                headers = download_headers(
+                    peers, start, height, tip_proof, previous, self.config.DIFFICULTY
                 )
-                return json.dumps({"status": 500})
+                ChainSync(
+                    self,
+                    peers,
+                    height,
+                    progress_cb=progress_cb,
+                    headers=headers,
+                    peer_manager=self.peer_manager,
+                ).run()
+            except SyncException as e:
+                # bad or unreachable peers, blocks added so far are kept
+                print(f"SYNC: failed at {self.synced_height}:", str(e))
+                return self.synced_height
+        self.is_synced = True
+        return self.synced_height
+
+    async def _run_p2p(self):
+        self._p2p_loop = asyncio.get_running_loop()
+        self._p2p_task = asyncio.current_task()
+        self._p2p_ready.set()
+        self.gossip.start()
+        self.keepalive.start()
+        try:
+            for p in self.peers:
+                await self.keepalive.connect(Peer(p.host, p.port + P2P_PORT_OFFSET))
+            await self.p2p.setup()
+        finally:
+            self.gossip.stop()
+            self.keepalive.stop()
+            await self.p2p.pooler.close()
+
+    def _serve_p2p(self):
+        try:
+            asyncio.run(self._run_p2p())
+        except asyncio.CancelledError:
+            pass  # stopped by `stop_p2p`
         except Exception as e:
-            print("Failed to send get_block", type(e), str(e))
-            return json.dumps({"status": 500})
+            print("P2P stopped:", type(e), str(e))
+        finally:
+            self._p2p_ready.set()
 
-    def choose_peers_at_height(self, height):
-        """Choose peers that agree on a block at given height"""
-        # get block proof at (h) from peers and compare
-        print(f"CHOOSE: {height}")
+    def start_p2p(self):
+        """Relay blocks and transactions with gossip on a thread of its own"""
+        if self._p2p_thread is None:
+            self._p2p_thread = threading.Thread(
+                target=self._serve_p2p, name="p2p", daemon=True
+            )
+            self._p2p_thread.start()
 
-        proofs = []
-        for p in self.peers:
-            block = json.loads(p.get_block(height))
-            print("GOT", block)
-            proofs.append([json.loads(p.get_block(height))["hash"], p])
-
-        # itemize count of unique block proofs at height (x)
-        proof_count = {}
-        for p, c in proofs:  # proof, client (peer)
-            if proof_count.get(p) is not None:
-                proof_count[p]["peers"].append(c)
-                proof_count[p]["count"] += 1
-            else:
-                proof_count[p] = {"count": 1, "peers": [c]}
-
-        return proof_count
-
-    def sync_chain(self):
-        # using peers, update chain
-        synced = False
-
-        while True:
-            # get current height from random peer (x)
-            # get block proof at (x) from chosen peer
-
-            p = rand.choice(self.peers)
-            height = p.get_height()["height"]  # GET peer `get_height`
-            print(f"SYNC: getting height {height}")
-
-            # get dict of proofs and peers that agree on proof @ height
-            proof_count = self.choose_peers_at_height(height)
-            print(f"proof_count: {proof_count}")
-
-            # choose chain from peer(s) with most common block proof
-            chosen = None
-            for proof in proof_count:
-                print(proof)
-                if chosen is None:
-                    chosen = proof_count[proof]
-                elif proof_count[proof]["count"] > chosen:
-                    chosen = proof_count[proof]
-
-            print(chosen)
-
-            # iterate over peers and gather chain
-            while not synced:
-                p = rand.choice(chosen["peers"])
-                try:
-                    data = p.get_block(self.synced_height + 1)
-                    if data.get("block") is None:
-                        # received a null block indicating the end of the chain
-                        synced = True
-                        break
-                    block = Block.from_dict(data)
-                except IndexError:  # height limit reached
-                    synced = True
-            break
+    def stop_p2p(self):
+        """Stop relaying, waits for objects being checked and added"""
+        if self._p2p_thread is None:
+            return
+        self._p2p_ready.wait()
+        try:
+            self._p2p_loop.call_soon_threadsafe(self._p2p_task.cancel)
+        except (AttributeError, RuntimeError):
+            pass  # it ended on its own
+        self._p2p_thread.join()
+        self._p2p_thread = None
 
     def run(self):
-        self.app.run(use_reloader=False, threaded=True)
+        self.start_p2p()
+        try:
+            self.app.run()
+        finally:
+            self.stop_p2p()
+            # handlers and block streams still running read the store
+            self.app.executor.shutdown(wait=True)
+            self.close()
+
+    def close(self):
+        """Stop relaying, flush the chainstate and close the chain files"""
+        self.stop_p2p()
+        self.utxos.close()
+        self.index.close()
+        self.store.close()
+        for p in self.peers:
+            p.close()
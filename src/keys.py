@@ -1,11 +1,70 @@
-from dataclasses import dataclass
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
 
 import ecdsa
+from ecdsa.ellipticcurve import PointJacobi
 from ecdsa.util import randrange_from_seed__trytryagain
 
 from config import Config
 
 CURVE = Config.CURVE
+VK_CACHE_SIZE = 4096  # parsed verifying keys kept process wide
+HOT_KEY_USES = 8  # verifications before a cached key gets precomputation tables
+
+_vk_cache = OrderedDict()  # pubkey bytes -> [VerifyingKey, uses]
+_vk_cache_lock = threading.Lock()
+
+
+def precompute_verifying_key(vk: ecdsa.VerifyingKey) -> ecdsa.VerifyingKey:
+    """Get a copy of `vk` with point multiplication tables precomputed
+
+    Speeds up every later verification with the key, but costs about as much
+    as a handful of verifications up front.
+    """
+    # python-ecdsa can't precompute points parsed with from_string, they lack
+    # the curve order, so rebuild the point with it
+    point = vk.pubkey.point
+    point = PointJacobi(CURVE.curve, point.x(), point.y(), 1, CURVE.order, generator=True)
+    vk = ecdsa.VerifyingKey.from_public_point(point, curve=CURVE)
+    vk.precompute()
+    return vk
+
+
+def get_verifying_key(pubkey: bytes) -> ecdsa.VerifyingKey:
+    """Parsed VerifyingKey for raw `pubkey` bytes from a process wide LRU
+
+    Keys used for `HOT_KEY_USES` lookups are replaced by a precomputed copy.
+    """
+    with _vk_cache_lock:
+        entry = _vk_cache.get(pubkey)
+        if entry is not None:
+            _vk_cache.move_to_end(pubkey)
+            entry[1] += 1
+            if entry[1] != HOT_KEY_USES:
+                return entry[0]
+
+    if entry is None:
+        vk = ecdsa.VerifyingKey.from_string(pubkey, curve=CURVE)
+    else:
+        vk = precompute_verifying_key(entry[0])
+    cache_verifying_key(pubkey, vk, entry[1] if entry is not None else 1)
+    return vk
+
+
+def cache_verifying_key(pubkey: bytes, vk: ecdsa.VerifyingKey, uses: int = 1):
+    with _vk_cache_lock:
+        _vk_cache[pubkey] = [vk, uses]
+        _vk_cache.move_to_end(pubkey)
+        while len(_vk_cache) > VK_CACHE_SIZE:
+            _vk_cache.popitem(last=False)
+
+
+def child_seed(seed: bytes, index: int) -> bytes:
+    """Seed of the child key `index` of a master seed"""
+    if not 0 <= index < 2**32:
+        raise ValueError(f"child index {index} out of range")
+    return seed + index.to_bytes(4, "big")
 
 
 @dataclass
@@ -34,6 +93,14 @@ class PrivKey:
 class KeyPair:
     pub: PubKey
     priv: PrivKey
+    # parsed keys, kept so signing doesn't parse the hex key every time
+    _sk: ecdsa.SigningKey = field(default=None, repr=False, compare=False)
+    _vk: ecdsa.VerifyingKey = field(default=None, repr=False, compare=False)
+
+    @classmethod
+    def _from_signing_key(cls, sk):
+        vk = sk.get_verifying_key()
+        return cls(PubKey(vk.to_string()), PrivKey(sk.to_string()), sk, vk)
 
     @classmethod
     def new(cls):
@@ -43,30 +110,50 @@ class KeyPair:
             raise Exception("Can not use KeyPair.new() on existing KeyPair")
 
         sk = ecdsa.SigningKey.generate(curve=CURVE)
-        priv = PrivKey(sk.to_string())
-
-        vk = sk.get_verifying_key()
-        pub = PubKey(vk.to_string())
-        return cls(pub, priv)
+        return cls._from_signing_key(sk)
 
     @classmethod
     def from_privkey_str(cls, priv):
         sk = ecdsa.SigningKey.from_string(bytes.fromhex(priv), curve=CURVE)
-        priv = PrivKey(sk.to_string())
-
-        vk = sk.get_verifying_key()
-        pub = PubKey(vk.to_string())
-        return cls(pub, priv)
+        return cls._from_signing_key(sk)
 
     @classmethod
     def from_seed(cls, seed):
         secexp = randrange_from_seed__trytryagain(seed, CURVE.order)
         sk = ecdsa.SigningKey.from_secret_exponent(secexp, curve=CURVE)
-        priv = PrivKey(sk.to_string())
+        return cls._from_signing_key(sk)
 
-        vk = sk.get_verifying_key()
-        pub = PubKey(vk.to_string())
-        return cls(pub, priv)
+    @classmethod
+    def derive(cls, seed: bytes, index: int):
+        """Deterministically derive the child keypair `index` of a master seed"""
+        return cls.from_seed(child_seed(seed, index))
+
+    @property
+    def signing_key(self) -> ecdsa.SigningKey:
+        if self._sk is None:
+            self._sk = ecdsa.SigningKey.from_string(
+                bytes.fromhex(str(self.priv)), curve=CURVE
+            )
+        return self._sk
+
+    @property
+    def verifying_key(self) -> ecdsa.VerifyingKey:
+        if self._vk is None:
+            if self._sk is not None:
+                self._vk = self._sk.get_verifying_key()
+            else:
+                self._vk = get_verifying_key(bytes.fromhex(str(self.pub)))
+        return self._vk
+
+    def precompute(self):
+        """Precompute point multiplication tables for a hot key
+
+        Verifications against this key, including the ones through the process
+        wide verifying key cache, get faster.
+        """
+        self._vk = precompute_verifying_key(self.verifying_key)
+        cache_verifying_key(bytes.fromhex(str(self.pub)), self._vk, HOT_KEY_USES)
+        return self
 
     def __str__(self):
         # BEWARE MALICIOUS USE
@@ -80,6 +167,6 @@ class KeyPair:
         if not data:
             raise Exception("Can not sign data. Data is invalid")
 
-        sk = ecdsa.SigningKey.from_string(bytes.fromhex(str(self.priv)), curve=CURVE)
-        sig = sk.sign(bytes(str(self), encoding="utf-8")).hex()
-        return sig
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self.signing_key.sign(data).hex()
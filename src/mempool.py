@@ -0,0 +1,197 @@
+"""ChickenTicket transaction memory pool
+
+Unconfirmed transactions are indexed by hash and by fee rate (base units of fee
+per byte of the serialized transaction). A conflict index maps every outpoint
+spent by a pooled transaction to that transaction, so double spends are rejected
+up front. When the pool grows past its memory cap the lowest fee rate
+transactions are evicted first.
+"""
+import heapq
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from sigverify import SignatureVerifier
+from transaction import Transaction
+
+try:
+    import ujson as json
+
+    USING_UJSON = True
+except ImportError:
+    import json
+
+    USING_UJSON = False
+
+MAX_SIZE = 64 * 2**20  # bytes of serialized transactions
+
+
+class MempoolException(Exception):
+    """Base class for mempool related exceptions"""
+
+
+@dataclass(order=True)
+class MempoolEntry:
+    fee_rate: float
+    tx_hash: str
+    tx: Transaction = field(compare=False, repr=False)
+    size: int = field(compare=False)
+
+
+class Mempool:
+    def __init__(self, max_size: int = MAX_SIZE, verifier: SignatureVerifier = None):
+        self.max_size = max_size
+        self.verifier = verifier or SignatureVerifier()  # pool starts on first batch
+        self.size = 0  # bytes of serialized transactions in the pool
+
+        self.entries: Dict[str, MempoolEntry] = {}  # tx hash -> entry
+        self.spends: Dict[Tuple[str, int], str] = {}  # outpoint -> spending tx hash
+        # min-heap by fee rate, entries of removed txs are skipped when popped
+        self._by_fee_rate: List[MempoolEntry] = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tx_hash: str):
+        return tx_hash in self.entries
+
+    def get(self, tx_hash: str):
+        entry = self.entries.get(tx_hash)
+        return entry.tx if entry is not None else None
+
+    def conflicts(self, tx: Transaction) -> List[str]:
+        """Hashes of pooled transactions spending an input of `tx`"""
+        hashes = []
+        for inp in tx.inputs:
+            tx_hash = self.spends.get((inp.tx_hash, inp.output_id))
+            if tx_hash is not None and tx_hash not in hashes:
+                hashes.append(tx_hash)
+        return hashes
+
+    def add(self, tx: Transaction, verify: bool = True) -> bool:
+        """Add a transaction to the pool
+
+        Returns False if it was evicted right away because its fee rate is the
+        lowest in a full pool. Raises MempoolException for invalid signatures,
+        duplicates and double spends of a pooled transaction's inputs.
+        """
+        if tx.proof is None:
+            tx.hash()
+        if verify and not tx.verify():
+            raise MempoolException(f"transaction {tx.proof} has an invalid signature")
+        if tx.proof in self.entries:
+            raise MempoolException(f"transaction {tx.proof} is already in the mempool")
+
+        conflicts = self.conflicts(tx)
+        if conflicts:
+            raise MempoolException(
+                f"transaction {tx.proof} conflicts with {', '.join(conflicts)}"
+            )
+
+        size = len(tx.json().encode())
+        fee = tx.fee if tx.fee is not None else 0
+        entry = MempoolEntry(fee / size, tx.proof, tx, size)
+
+        self.entries[tx.proof] = entry
+        for inp in tx.inputs:
+            self.spends[(inp.tx_hash, inp.output_id)] = tx.proof
+        heapq.heappush(self._by_fee_rate, entry)
+        self.size += size
+
+        self._evict()
+        return tx.proof in self.entries
+
+    def add_many(self, txs: List[Transaction]) -> List[str]:
+        """Verify a batch of transactions in parallel and add the valid ones
+
+        Returns the hashes of the transactions that were rejected
+        """
+        rejected = []
+        for tx, ok in zip(txs, self.verifier.verify_transactions(txs)):
+            try:
+                if not ok:
+                    raise MempoolException("invalid signature")
+                self.add(tx, verify=False)
+            except MempoolException:
+                rejected.append(tx.proof or tx.hash())
+        return rejected
+
+    def remove(self, tx_hash: str):
+        """Remove a transaction, returns it or None if it isn't pooled"""
+        entry = self.entries.pop(tx_hash, None)
+        if entry is None:
+            return None
+        for inp in entry.tx.inputs:
+            outpoint = (inp.tx_hash, inp.output_id)
+            if self.spends.get(outpoint) == tx_hash:
+                del self.spends[outpoint]
+        self.size -= entry.size
+        # the heap entry is dropped lazily
+        if len(self._by_fee_rate) > 2 * len(self.entries) + 64:
+            self._compact()
+        return entry.tx
+
+    def _compact(self):
+        self._by_fee_rate = list(self.entries.values())
+        heapq.heapify(self._by_fee_rate)
+
+    def _evict(self):
+        """Evict the lowest fee rate transactions until under the memory cap"""
+        while self.size > self.max_size and self._by_fee_rate:
+            entry = heapq.heappop(self._by_fee_rate)
+            if self.entries.get(entry.tx_hash) is entry:
+                self.remove(entry.tx_hash)
+
+    def remove_for_block(self, block):
+        """Remove the transactions of a connected block and their conflicts"""
+        removed = []
+        for tx in block.transactions:
+            if self.remove(tx.proof) is not None:
+                removed.append(tx.proof)
+            for tx_hash in self.conflicts(tx):
+                # spends an outpoint the block already spent
+                self.remove(tx_hash)
+                removed.append(tx_hash)
+        return removed
+
+    def select(self, max_size: int) -> List[Transaction]:
+        """Highest fee rate transactions fitting in `max_size` bytes"""
+        txs, size = [], 0
+        for entry in sorted(self.entries.values(), reverse=True):
+            if size + entry.size > max_size:
+                continue
+            txs.append(entry.tx)
+            size += entry.size
+        return txs
+
+    def to_dict(self):
+        return {"size": self.size, "txs": list(self.entries)}
+
+    def json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    def __str__(self):
+        return self.json()
+
+
+if __name__ == "__main__":
+    from transaction import Input, Output
+
+    def make_tx(n, fee, spends):
+        tx = Transaction(idx=n, ver=1, timestamp=n, fee=fee)
+        tx.add_input(Input(spends, 0))
+        tx.add_output(Output("0x0", 1))
+        tx.hash()
+        return tx
+
+    txs = [make_tx(n, n + 1, f"{n:064x}") for n in range(10)]
+    pool = Mempool(max_size=sum(len(tx.json()) for tx in txs[:5]))
+    for tx in txs:
+        pool.add(tx, verify=False)
+    assert len(pool) <= 5 and txs[-1].proof in pool and txs[0].proof not in pool
+
+    try:
+        pool.add(make_tx(100, 1000, f"{9:064x}"), verify=False)  # double spend
+    except MempoolException:
+        pass
+    assert pool.select(10**9)[0] is txs[-1]
+    print(pool)
@@ -0,0 +1,174 @@
+"""ChickenTicket proof-of-work miner"""
+import multiprocessing as mp
+import os
+import queue
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from block import Block, BlockHeader
+from crypto.chicken import chicken_hasher
+
+MAX_NONCE = 2**64 - 1
+REPORT_INTERVAL = 2**14  # attempts between cancellation checks and hashrate reports
+
+
+class MinerException(Exception):
+    """Base class for miner related exceptions"""
+
+
+@dataclass
+class MiningResult:
+    nonce: int
+    proof: str  # header hash that met the target
+    hashes: int  # total attempts across all workers
+    elapsed: float
+
+    @property
+    def hashrate(self):
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+
+def difficulty_to_target(difficulty: int) -> int:
+    """Convert a difficulty (required leading zero bits) to a 256 bit target"""
+    if not 0 <= difficulty <= 256:
+        raise MinerException(f"invalid difficulty {difficulty}")
+    return 1 << (256 - difficulty)
+
+
+def meets_target(digest: bytes, target: int) -> bool:
+    return int.from_bytes(digest, "big") < target
+
+
+def check_proof_of_work(header: BlockHeader, difficulty: int) -> bool:
+    """Check that a header's hash satisfies `difficulty`"""
+    return meets_target(header.hash(), difficulty_to_target(difficulty))
+
+
+def _mine_worker(worker_id, prefix, suffix, target, start, stop, cancel, results):
+    """Search nonces in [start, stop) until one meets `target` or `cancel` is set"""
+    hasher = chicken_hasher(prefix)
+    from_bytes = int.from_bytes
+    hashes = 0
+    began = time.perf_counter()
+
+    nonce = start
+    while nonce < stop and not cancel.is_set():
+        end = min(nonce + REPORT_INTERVAL, stop)
+        for n in range(nonce, end):
+            digest = hasher(b"%d" % n + suffix)
+            if from_bytes(digest, "big") < target:
+                hashes += n - nonce + 1
+                results.put(("found", worker_id, n, digest, hashes))
+                return
+        hashes += end - nonce
+        nonce = end
+        results.put(("stats", worker_id, hashes, time.perf_counter() - began))
+
+    results.put(("done", worker_id, hashes))
+
+
+class Miner:
+    """Searches the nonce space of a block header across a pool of processes.
+
+    The nonce space is split into one contiguous range per worker. Each worker
+    hashes a precomputed header prefix so only the nonce and the bytes following
+    it are encoded per attempt. All workers are stopped as soon as one finds a
+    solution, or when `cancel()` is called (i.e. a new tip arrived).
+    """
+
+    def __init__(
+        self, workers: int = None, stats_cb: Callable[[int, float], None] = None
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.stats_cb = stats_cb  # called with (worker_id, hashes/sec)
+        self.hashrates: Dict[int, float] = {}  # latest hashes/sec per worker
+        self._cancel = None
+
+    @property
+    def hashrate(self):
+        return sum(self.hashrates.values())
+
+    def cancel(self):
+        """Stop all workers of the running search"""
+        if self._cancel is not None:
+            self._cancel.set()
+
+    def mine(self, block: Block, timeout: float = None) -> Optional[MiningResult]:
+        """Find a nonce for `block` meeting its difficulty
+
+        Sets `block.nonce` and returns a MiningResult on success. Returns None if
+        the search was cancelled, timed out or exhausted the nonce space.
+        """
+        prefix, suffix = block.header.nonce_template()
+        target = difficulty_to_target(block.difficulty)
+
+        ctx = mp.get_context()
+        self._cancel = cancel = ctx.Event()
+        results = ctx.Queue()
+        self.hashrates = {}
+
+        span = (MAX_NONCE + 1) // self.workers
+        procs = []
+        for i in range(self.workers):
+            stop = MAX_NONCE + 1 if i == self.workers - 1 else (i + 1) * span
+            p = ctx.Process(
+                target=_mine_worker,
+                args=(i, prefix, suffix, target, i * span, stop, cancel, results),
+                daemon=True,
+            )
+            p.start()
+            procs.append(p)
+
+        began = time.perf_counter()
+        hashes = {}
+        running = self.workers
+        result = None
+        try:
+            while running and not cancel.is_set():
+                if timeout is not None and time.perf_counter() - began > timeout:
+                    break
+                try:
+                    msg = results.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                kind, worker_id = msg[0], msg[1]
+                if kind == "stats":
+                    hashes[worker_id], elapsed = msg[2], msg[3]
+                    self.hashrates[worker_id] = msg[2] / elapsed if elapsed else 0.0
+                    if self.stats_cb is not None:
+                        self.stats_cb(worker_id, self.hashrates[worker_id])
+                elif kind == "found":
+                    nonce, digest = msg[2], msg[3]
+                    hashes[worker_id] = msg[4]
+                    block.nonce = nonce
+                    result = MiningResult(
+                        nonce, digest.hex(), 0, time.perf_counter() - began
+                    )
+                    break
+                elif kind == "done":
+                    hashes[worker_id] = msg[2]
+                    running -= 1
+        finally:
+            cancel.set()
+            for p in procs:
+                p.join(timeout=1)
+                if p.is_alive():
+                    p.terminate()
+            self._cancel = None
+
+        if result is not None:
+            result.hashes = sum(hashes.values())
+        return result
+
+
+if __name__ == "__main__":
+    # test mining a low difficulty block
+    block = Block(idx=0, ver=1, nonce=0)
+    block.difficulty = 16
+
+    miner = Miner(stats_cb=lambda w, hps: print(f"worker {w}: {hps:,.0f} H/s"))
+    res = miner.mine(block)
+    print(res, f"{res.hashrate:,.0f} H/s")
+    assert check_proof_of_work(block.header, block.difficulty)
@@ -5,6 +5,10 @@
 
 __all__ = (
     "MAGIC_BYTES_LEN",
+    "MAX_PAYLOAD_SIZE",
+    "FramingException",
+    "encode_frame",
+    "FrameReader",
     "Peer",
     "Connection",
     "ConnectionPooler",
@@ -12,16 +16,152 @@ __all__ = (
 )
 
 import asyncio
+import struct
 from asyncio import StreamReader, StreamWriter
 from dataclasses import dataclass
 from functools import partial
 from random import randrange
-from typing import Any, Callable, Mapping, Union
+from typing import Any, Awaitable, Callable, Dict, Mapping, Set, Tuple, Union
 
 from config import Config
+from crypto.chicken import chicken_hash
+from peers import BAN_SCORE, PeerManager
 
 MAGIC_BYTES_LEN = len(Config.MAGIC)
 
+# Every message is a frame: magic, command (ascii, NUL padded), payload length,
+# checksum (first 4 bytes of the payload's chicken hash), then the payload.
+FRAME_HEADER = struct.Struct(f">{MAGIC_BYTES_LEN}s12sI4s")
+COMMAND_SIZE = 12
+CHECKSUM_SIZE = 4
+MAX_PAYLOAD_SIZE = 4 * 2**20  # larger frames are refused without reading them
+READ_CHUNK_SIZE = 64 * 2**10
+INITIAL_BUFFER_SIZE = 16 * 2**10  # enough for most frames, grown for larger ones
+WRITE_BUFFER_HIGH = 2**20  # pending bytes before `drain()` waits for the peer
+CLOSE_TIMEOUT = 5  # seconds `ConnectionPooler.close` waits for polls to stop
+
+
+class FramingException(Exception):
+    """
+    Raised when a peer sends a malformed frame.
+    """
+
+
+def checksum(payload) -> bytes:
+    return chicken_hash(payload)[:CHECKSUM_SIZE]
+
+
+def encode_frame(command: str, payload: bytes = b"") -> bytes:
+    """
+    Frame header for `payload`, send the payload right after it.
+    """
+    name = command.encode("ascii")
+    if len(name) > COMMAND_SIZE:
+        raise ValueError(f"command {command!r} is longer than {COMMAND_SIZE} bytes")
+
+    if len(payload) > MAX_PAYLOAD_SIZE:
+        raise ValueError(f"payload of {len(payload)} bytes is over the size limit")
+
+    return FRAME_HEADER.pack(Config.MAGIC, name, len(payload), checksum(payload))
+
+
+class FrameReader:
+    """
+    Reads frames from a stream into a reused buffer.
+
+    The buffer starts small and only grows, up to the largest allowed frame,
+    when a frame header declares a larger payload. It shrinks back once such a
+    frame has been read, so idle connections stay cheap.
+
+    Payloads are returned as memoryviews into that buffer, so they are only
+    valid until the next `read_frame` call. Copy them with `bytes()` to keep
+    them around.
+    """
+
+    def __init__(self, reader: StreamReader, max_payload_size: int = MAX_PAYLOAD_SIZE):
+        self.reader = reader
+        self.max_payload_size = max_payload_size
+        self.initial_size = min(INITIAL_BUFFER_SIZE, FRAME_HEADER.size + max_payload_size)
+        self.buffer = bytearray(self.initial_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # first unread byte
+        self.end = 0  # end of the buffered bytes
+
+    def _allocate(self, size: int):
+        """
+        Replace the buffer with a new one of `size` bytes, keeping the unread bytes.
+
+        A new bytearray is made rather than resizing the old one, payload views
+        handed out earlier keep the old buffer alive.
+        """
+        unread = self.end - self.start
+        buffer = bytearray(size)
+        buffer[:unread] = self.view[self.start : self.end]
+        self.start, self.end = 0, unread
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    async def _fill(self, size: int):
+        """
+        Buffer at least `size` unread bytes.
+        """
+        if size > len(self.buffer):
+            # double so a stream of growing frames isn't copied each time
+            limit = FRAME_HEADER.size + self.max_payload_size
+            self._allocate(min(max(size, 2 * len(self.buffer)), limit))
+
+        elif self.start + size > len(self.buffer):
+            # move the unread tail to the front
+            unread = self.end - self.start
+            self.view[:unread] = self.view[self.start : self.end]
+            self.start, self.end = 0, unread
+
+        while self.end - self.start < size:
+            chunk = await self.reader.read(
+                min(READ_CHUNK_SIZE, len(self.buffer) - self.end)
+            )
+
+            if not chunk:
+                raise asyncio.IncompleteReadError(
+                    bytes(self.view[self.start : self.end]), size
+                )
+
+            self.view[self.end : self.end + len(chunk)] = chunk
+            self.end += len(chunk)
+
+    async def read_frame(self) -> Tuple[str, memoryview]:
+        """
+        Read the next frame, returns (command, payload).
+        """
+        await self._fill(FRAME_HEADER.size)
+        magic, name, length, check = FRAME_HEADER.unpack_from(self.buffer, self.start)
+
+        if magic != Config.MAGIC:
+            raise FramingException(f"bad magic {magic!r}")
+
+        if length > self.max_payload_size:
+            raise FramingException(f"payload of {length} bytes is over the size limit")
+
+        await self._fill(FRAME_HEADER.size + length)
+        offset = self.start + FRAME_HEADER.size
+        payload = self.view[offset : offset + length]
+
+        if checksum(payload) != check:
+            raise FramingException("bad checksum")
+
+        self.start = offset + length
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_size:
+                self._allocate(self.initial_size)  # `payload` keeps the large one
+
+        try:
+            command = name.rstrip(b"\x00").decode("ascii")
+        except UnicodeDecodeError:
+            raise FramingException(f"bad command {name!r}")
+
+        return command, payload
+
 
 @dataclass
 class Peer:
@@ -46,8 +186,14 @@ class Connection:
     reader: StreamReader
     writer: StreamWriter
 
+    def __post_init__(self):
+        self.frames = FrameReader(self.reader)
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
 
-PeerCallback = Callable[[Peer, bytes], Any]
+
+# (peer, command, payload), the payload is only valid until the callback returns
+PeerCallback = Callable[[Peer, str, memoryview], Any]
+FrameHandler = Callable[[Peer, memoryview], Awaitable[Any]]
 
 
 class ConnectionPooler:
@@ -62,9 +208,11 @@ class ConnectionPooler:
         max_peers: int = 0,
         use_random_ports: bool = True,
         peer_port: int = 8080,
+        peer_manager: PeerManager = None,
     ):
         self.recv_callback = recv_callback
         self.max_peers = max(max_peers, 0)
+        self.peer_manager = peer_manager or PeerManager()  # health of each peer
 
         if use_random_ports:
             self.port_callback = partial(randrange, 2000, 65535)
@@ -73,6 +221,15 @@ class ConnectionPooler:
             self.port_callback = lambda: peer_port
 
         self.peers: Mapping[Peer, Connection] = {}
+        self.handlers: Dict[str, FrameHandler] = {}
+        self._polls: Set[asyncio.Task] = set()
+
+    def add_handler(self, command: str, handler: FrameHandler):
+        """
+        Routes frames with `command` to `handler(peer, payload)` instead of the
+        receive callback.
+        """
+        self.handlers[command] = handler
 
     def check_peers(self) -> bool:
         """
@@ -83,7 +240,10 @@ class ConnectionPooler:
 
         return len(self.peers) < self.max_peers
 
-    async def write_peer(self, peer: Peer, data: bytes):
+    async def write_peer(self, peer: Peer, command: str, data: bytes = b""):
+        """
+        Sends one frame, waits while the peer is behind on reading.
+        """
         if peer not in self.peers:
             raise ValueError(f"Failed writing, {peer} not a connected peer")
 
@@ -92,7 +252,7 @@ class ConnectionPooler:
         if conn.closed:
             raise RuntimeError(f"Failed writing, {conn} for {peer} is closed")
 
-        conn.writer.write(data)
+        conn.writer.writelines((encode_frame(command, data), data))
         await conn.writer.drain()
 
     async def add_peer(self, peer: Peer):
@@ -120,8 +280,9 @@ class ConnectionPooler:
         """
         Initiates a connection to a peer.
         """
+        port = self.port_callback()
         peer_info = await asyncio.open_connection(
-            peer.addr, peer.port, local_addr=("127.0.0.1", self.port_callback())
+            peer.addr, peer.port, local_addr=("0.0.0.0", port) if port else None
         )
 
         return Connection(False, *peer_info)
@@ -134,7 +295,7 @@ class ConnectionPooler:
         self.peers[peer].writer.close()
 
         try:
-            await self.peers[peer].wait_closed()
+            await self.peers[peer].writer.wait_closed()
 
         except:
             pass
@@ -152,10 +313,30 @@ class ConnectionPooler:
         else:
             raise ValueError(f"{peer} has an open connection, cannot close")
 
+    async def close(self):
+        """
+        Closes every connection, waits for their polls to stop.
+        """
+        for connection in list(self.peers.values()):
+            connection.writer.close()
+
+        if self._polls:
+            await asyncio.wait(list(self._polls), timeout=CLOSE_TIMEOUT)
+
     async def start_poll(self, peer: Peer):
         """
         Contiously polls a peer connection.
         """
+        task = asyncio.current_task()
+        self._polls.add(task)
+
+        try:
+            await self._poll(peer)
+
+        finally:
+            self._polls.discard(task)
+
+    async def _poll(self, peer: Peer):
         if peer not in self.peers:
             raise ValueError(f"{peer} is not a recognized peer")
 
@@ -163,29 +344,44 @@ class ConnectionPooler:
 
         while not connection.closed:
             try:
-                print(f"[Poll] Polling {peer}")
-                data = await connection.reader.read()
+                command, payload = await connection.frames.read_frame()
 
-            except Exception as e:
-                print(f"[Error] ({type(e).__name__}: {e}")
-                exit()
+            except asyncio.IncompleteReadError:
+                print(f"{peer} closed the connection")
+                await self.close_peer_connection(peer)
+                return
 
-            except asyncio.ConnectionError:
-                print(f"{peer} errored while reading, closing connection")
+            except FramingException as e:
+                print(f"{peer} sent a malformed frame ({e}), closing connection")
+                self.peer_manager.misbehaving(peer, BAN_SCORE, f"malformed frame ({e})")
                 await self.close_peer_connection(peer)
                 return
 
-            if not data:
-                print(f"{peer} sent empty data while reading, closing connection")
+            except (ConnectionError, OSError) as e:
+                print(f"{peer} errored while reading ({e}), closing connection")
                 await self.close_peer_connection(peer)
                 return
 
-            if data[:MAGIC_BYTES_LEN] == Config.MAGIC:
-                await self._dispatch_internal(peer, data[MAGIC_BYTES_LEN:])
+            # the next frame isn't read until this one is handled, a slow
+            # handler fills the socket buffers and holds the sender back
+            try:
+                with payload:
+                    await self._dispatch(peer, command, payload)
+
+            except Exception as e:
+                print(f"[Error] {command} from {peer} ({type(e).__name__}: {e})")
 
-            else:
-                print(f"[Recvd] {peer} {data!r}")
-                await self.recv_callback(peer, data)
+    async def _dispatch(self, peer: Peer, command: str, payload: memoryview):
+        handler = self.handlers.get(command)
+
+        if handler is not None:
+            await handler(peer, payload)
+            return
+
+        result = self.recv_callback(peer, command, payload)
+
+        if asyncio.iscoroutine(result):
+            await result
 
     async def recv_connect(self, reader: StreamReader, writer: StreamWriter):
         """
@@ -194,9 +390,14 @@ class ConnectionPooler:
         """
         details = writer.get_extra_info("peername")
 
-        peer = Peer(*details)
+        peer = Peer(*details[:2])
         print(f"Recieved connection from {peer}")
 
+        if self.peer_manager.is_banned(peer):
+            writer.close()
+            print(f"Refused connection from banned {peer}")
+            return
+
         if not self.check_peers():
             try:
                 writer.close()
@@ -212,9 +413,6 @@ class ConnectionPooler:
 
         await self.start_poll(peer)
 
-    async def _dispatch_internal(self, peer: Peer, data: bytes):
-        print(f"[Internal] {peer} {data!r}")
-
 
 class P2PConnector:
     """
@@ -241,14 +439,14 @@ class P2PConnector:
         for peer in self.pooler.peers:
             yield peer
 
-    async def send_to_peer(self, peer: Peer, data: Union[str, bytes]):
+    async def send_to_peer(self, peer: Peer, command: str, data: Union[str, bytes] = b""):
         if isinstance(data, str):
             data = bytes(data, encoding="utf-8")
 
-        else:
+        elif not isinstance(data, (bytes, bytearray, memoryview)):
             raise TypeError(f"data can be bytes or str, not {type(data)}")
 
-        await self.pooler.write_peer(peer, data)
+        await self.pooler.write_peer(peer, command, data)
 
     async def add_peer(self, addr: str, port: int):
         peer = Peer(addr, port)
@@ -0,0 +1,283 @@
+"""ChickenTicket peer health and selection
+
+`PeerManager` keeps the health of every peer it hears about: round trip time,
+throughput, failure rate and a misbehavior score. Peers are ranked by the time
+a request to them is expected to take, so sync and relay go to fast, reliable
+peers first. Peers that keep failing are skipped for an exponentially growing
+backoff, peers that misbehave are banned by host.
+
+`KeepAlive` pings the peers of a `network.ConnectionPooler`, measuring their
+round trip time, drops peers that stop answering and reconnects to outbound
+peers with backoff.
+
+Peers are any hashable objects with a `host` or `addr`, i.e. `HTTPPeer` and
+`network.Peer`.
+"""
+import asyncio
+import os
+import random
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from network import ConnectionPooler, Peer
+
+RTT_SMOOTHING = 0.2  # weight of the newest sample in the moving averages
+THROUGHPUT_SMOOTHING = 0.3
+FAILURE_SMOOTHING = 0.1
+UNKNOWN_RTT = 1.0  # seconds assumed for peers that weren't measured yet
+MAX_FAILURE_RATE = 0.95
+
+DEAD_FAILURES = 3  # failures in a row before a peer is backed off
+BACKOFF_BASE = 1.0  # seconds, doubles with every further failure
+BACKOFF_MAX = 600.0
+
+BAN_SCORE = 100  # misbehavior points before a peer is banned
+BAN_TIME = 24 * 3600
+MALFORMED_MESSAGE = 20  # points for a message that doesn't decode
+INVALID_OBJECT = BAN_SCORE  # points for an invalid block
+
+PING_INTERVAL = 30  # seconds between pings
+PING_TIMEOUT = 20  # seconds to answer a ping
+PING = struct.Struct(">8s")  # nonce
+
+
+@dataclass
+class PeerStats:
+    rtt: Optional[float] = None  # moving average of request seconds
+    throughput: Optional[float] = None  # moving average of bytes per second
+    failure_rate: float = 0.0  # moving average of failed requests
+    requests: int = 0
+    failures: int = 0
+    failures_in_row: int = 0
+    misbehavior: int = 0
+    last_seen: Optional[float] = None  # monotonic time of the last success
+    retry_at: float = 0.0  # not used before this monotonic time
+
+    def expected_time(self, nbytes: int = 0) -> float:
+        """Seconds a request for `nbytes` is expected to take, retries included"""
+        seconds = self.rtt if self.rtt is not None else UNKNOWN_RTT
+        if nbytes and self.throughput:
+            seconds += nbytes / self.throughput
+        return seconds / (1 - min(self.failure_rate, MAX_FAILURE_RATE))
+
+
+def _host(peer) -> Optional[str]:
+    return getattr(peer, "host", None) or getattr(peer, "addr", None)
+
+
+class PeerManager:
+    def __init__(self, ban_time: float = BAN_TIME):
+        self.ban_time = ban_time
+        self._lock = threading.Lock()  # HTTP peers are used from many threads
+        self._stats: Dict[object, PeerStats] = {}
+        self._banned: Dict[str, float] = {}  # host -> banned until (monotonic)
+
+    def stats(self, peer) -> PeerStats:
+        with self._lock:
+            return self._get(peer)
+
+    def _get(self, peer) -> PeerStats:
+        stats = self._stats.get(peer)
+        if stats is None:
+            stats = self._stats[peer] = PeerStats()
+        return stats
+
+    def record(self, peer, elapsed: Optional[float], ok: bool = True):
+        """Record a request that took `elapsed` seconds, or failed"""
+        now = time.monotonic()
+        with self._lock:
+            stats = self._get(peer)
+            stats.requests += 1
+            stats.failure_rate += FAILURE_SMOOTHING * ((not ok) - stats.failure_rate)
+            if not ok:
+                stats.failures += 1
+                stats.failures_in_row += 1
+                if stats.failures_in_row >= DEAD_FAILURES:
+                    backoff = BACKOFF_BASE * 2 ** (stats.failures_in_row - DEAD_FAILURES)
+                    backoff = min(backoff, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+                    stats.retry_at = now + backoff
+                return
+            stats.failures_in_row = 0
+            stats.retry_at = 0.0
+            stats.last_seen = now
+            if elapsed is not None:
+                if stats.rtt is None:
+                    stats.rtt = elapsed
+                else:
+                    stats.rtt += RTT_SMOOTHING * (elapsed - stats.rtt)
+
+    def record_transfer(self, peer, nbytes: int, elapsed: float):
+        """Record `nbytes` of payload received in `elapsed` seconds"""
+        if nbytes <= 0 or elapsed <= 0:
+            return
+        rate = nbytes / elapsed
+        with self._lock:
+            stats = self._get(peer)
+            if stats.throughput is None:
+                stats.throughput = rate
+            else:
+                stats.throughput += THROUGHPUT_SMOOTHING * (rate - stats.throughput)
+
+    def misbehaving(self, peer, points: int, reason: str = ""):
+        """Add misbehavior points, bans the peer's host past BAN_SCORE"""
+        with self._lock:
+            stats = self._get(peer)
+            stats.misbehavior += points
+            if stats.misbehavior < BAN_SCORE:
+                return
+            self._banned[_host(peer)] = time.monotonic() + self.ban_time
+        print(f"Banning {peer}: {reason}")
+
+    def is_banned(self, peer) -> bool:
+        with self._lock:
+            until = self._banned.get(_host(peer))
+            if until is None:
+                return False
+            if until <= time.monotonic():
+                del self._banned[_host(peer)]
+                return False
+            return True
+
+    def is_dead(self, peer) -> bool:
+        """Whether the peer failed DEAD_FAILURES times in a row"""
+        with self._lock:
+            stats = self._stats.get(peer)
+            return stats is not None and stats.failures_in_row >= DEAD_FAILURES
+
+    def available(self, peer) -> bool:
+        """Not banned and not backed off"""
+        if self.is_banned(peer):
+            return False
+        with self._lock:
+            stats = self._stats.get(peer)
+            return stats is None or stats.retry_at <= time.monotonic()
+
+    def score(self, peer, nbytes: int = 0) -> float:
+        """Expected seconds for a request to the peer, lower is better"""
+        with self._lock:
+            stats = self._stats.get(peer)
+            return (stats or PeerStats()).expected_time(nbytes)
+
+    def rank(self, peers: Iterable, nbytes: int = 0) -> List:
+        """Available peers, the fastest first"""
+        return sorted(
+            (peer for peer in peers if self.available(peer)),
+            key=lambda peer: self.score(peer, nbytes),
+        )
+
+    def forget(self, peer):
+        with self._lock:
+            self._stats.pop(peer, None)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                str(peer): {
+                    "rtt": stats.rtt,
+                    "throughput": stats.throughput,
+                    "failure_rate": stats.failure_rate,
+                    "misbehavior": stats.misbehavior,
+                }
+                for peer, stats in self._stats.items()
+            }
+
+
+class KeepAlive:
+    def __init__(
+        self,
+        pooler: "ConnectionPooler",
+        manager: PeerManager,
+        ping_interval: float = PING_INTERVAL,
+        ping_timeout: float = PING_TIMEOUT,
+    ):
+        self.pooler = pooler
+        self.manager = manager
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.outbound: Set["Peer"] = set()  # peers to stay connected to
+        self._connecting: Set["Peer"] = set()  # connections being opened
+        self._pings: Dict["Peer", Tuple[bytes, float]] = {}  # nonce, sent at
+        self._task: Optional[asyncio.Task] = None
+
+        pooler.add_handler("ping", self.on_ping)
+        pooler.add_handler("pong", self.on_pong)
+
+    def start(self):
+        """Start pinging, call from the event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def connect(self, peer: "Peer") -> bool:
+        """Connect to a peer and reconnect whenever it drops"""
+        self.outbound.add(peer)
+        if peer in self.pooler.peers:
+            return True
+        if peer in self._connecting or not self.manager.available(peer):
+            return False
+        self._connecting.add(peer)
+        began = time.perf_counter()
+        try:
+            await self.pooler.add_peer(peer)
+        except (ConnectionError, OSError, RuntimeError) as e:
+            print(f"Failed to connect to {peer} ({e})")
+            self.manager.record(peer, None, ok=False)
+            return False
+        finally:
+            self._connecting.discard(peer)
+        self.manager.record(peer, time.perf_counter() - began)
+        return True
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"[KeepAlive] check failed ({type(e).__name__}: {e})")
+            await asyncio.sleep(self.ping_interval)
+
+    async def check(self):
+        """Ping connected peers, drop dead ones and reconnect outbound ones"""
+        now = time.monotonic()
+        for peer in list(self.pooler.peers):
+            ping = self._pings.get(peer)
+            if ping is not None and now - ping[1] > self.ping_timeout:
+                del self._pings[peer]
+                self.manager.record(peer, None, ok=False)
+            if self.manager.is_dead(peer) or self.manager.is_banned(peer):
+                print(f"[KeepAlive] dropping {peer}")
+                self._pings.pop(peer, None)
+                await self.pooler.close_peer_connection(peer)
+                continue
+            if peer not in self._pings:
+                await self.ping(peer)
+
+        for peer in self.outbound - set(self.pooler.peers):
+            await self.connect(peer)
+
+    async def ping(self, peer: "Peer"):
+        nonce = os.urandom(PING.size)
+        self._pings[peer] = (nonce, time.monotonic())
+        try:
+            await self.pooler.write_peer(peer, "ping", PING.pack(nonce))
+        except (ValueError, RuntimeError, ConnectionError):
+            self._pings.pop(peer, None)
+            self.manager.record(peer, None, ok=False)
+
+    async def on_ping(self, peer: "Peer", payload: memoryview):
+        await self.pooler.write_peer(peer, "pong", bytes(payload))
+
+    async def on_pong(self, peer: "Peer", payload: memoryview):
+        ping = self._pings.get(peer)
+        if ping is None or ping[0] != payload:
+            return  # late or unsolicited
+        del self._pings[peer]
+        self.manager.record(peer, time.monotonic() - ping[1])
@@ -0,0 +1,120 @@
+"""ChickenTicket peer quorum queries
+
+Asks every peer for the block proof at a height at once and returns as soon as
+enough of them agree, peers that haven't answered by the deadline are left out.
+The proof comes from a single header record, not the whole block. Chain heights
+are collected the same way before a sync picks the height to agree on.
+"""
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+QUORUM = 0.5  # fraction of peers that must agree, more than this
+DEADLINE = 5  # seconds to wait for answers
+
+
+@dataclass
+class QuorumResult:
+    height: int
+    proof: Optional[str]  # proof most peers agree on, None if nobody answered
+    peers: List  # peers that sent `proof`
+    latencies: Dict = field(default_factory=dict)  # peer -> seconds to answer
+    proofs: Dict[str, List] = field(default_factory=dict)  # every proof -> peers
+    failed: List = field(default_factory=list)  # errors and peers behind
+    slow: List = field(default_factory=list)  # no answer by the deadline
+    reached: bool = False  # whether `proof` has a quorum
+
+    @property
+    def count(self):
+        return len(self.peers)
+
+
+def quorum_size(peers: int, quorum: float = QUORUM) -> int:
+    """Peers that must agree out of `peers`"""
+    return int(peers * quorum) + 1
+
+
+def _ask(peer, height: int, answers: queue.Queue):
+    began = time.perf_counter()
+    try:
+        headers = peer.get_headers(height, 1)
+    except Exception as e:
+        answers.put((peer, e, None))
+        return
+    proof = headers[0][1] if headers else None
+    answers.put((peer, proof, time.perf_counter() - began))
+
+
+def _ask_height(peer, answers: queue.Queue):
+    try:
+        answers.put((peer, peer.get_height()["height"]))
+    except Exception as e:
+        answers.put((peer, e))
+
+
+def query_heights(peers: List, deadline: float = DEADLINE) -> Dict:
+    """Ask `peers` for their chain height concurrently
+
+    Returns peer -> height of the peers that answered by the deadline, a dead
+    peer costs at most `deadline` seconds instead of its request's retries.
+    """
+    answers = queue.Queue()
+    for peer in peers:
+        threading.Thread(target=_ask_height, args=(peer, answers), daemon=True).start()
+
+    heights = {}
+    end = time.monotonic() + deadline
+    for _ in peers:
+        try:
+            peer, height = answers.get(timeout=max(0, end - time.monotonic()))
+        except queue.Empty:
+            break
+        if isinstance(height, Exception):
+            print(f"Failed to get height from {peer}:", type(height), str(height))
+            continue
+        heights[peer] = height
+    return heights
+
+
+def query_quorum(
+    peers: List, height: int, quorum: float = QUORUM, deadline: float = DEADLINE
+) -> QuorumResult:
+    """Ask `peers` for the block proof at `height` concurrently
+
+    Returns once more than `quorum` of the peers agree on a proof, when every
+    peer answered, or at the deadline, whichever comes first. Requests still
+    running then are left to time out on their own.
+    """
+    result = QuorumResult(height, None, [])
+    needed = quorum_size(len(peers), quorum)
+
+    answers = queue.Queue()
+    for peer in peers:
+        threading.Thread(target=_ask, args=(peer, height, answers), daemon=True).start()
+
+    waiting = list(peers)
+    end = time.monotonic() + deadline
+    while waiting and not result.reached:
+        try:
+            peer, proof, elapsed = answers.get(timeout=max(0, end - time.monotonic()))
+        except queue.Empty:
+            break
+        waiting.remove(peer)
+        if isinstance(proof, Exception):
+            print(f"Quorum query to {peer} failed:", type(proof), str(proof))
+            result.failed.append(peer)
+            continue
+        if proof is None:
+            result.failed.append(peer)
+            continue
+        result.latencies[peer] = elapsed
+        agreeing = result.proofs.setdefault(proof, [])
+        agreeing.append(peer)
+        if len(agreeing) > len(result.peers):
+            result.proof, result.peers = proof, agreeing
+        result.reached = len(result.peers) >= needed
+
+    result.slow = waiting
+    return result
@@ -0,0 +1,489 @@
+"""ChickenTicket canonical binary serialization
+
+A compact, versioned alternative to the JSON encoding of `to_dict()`. Fields are
+fixed width where possible, hashes, signatures and public keys are stored as raw
+bytes instead of hex, and optional fields are marked in a flags byte. Encoding is
+canonical, the same object always encodes to the same bytes, and decoding then
+re-encoding round-trips exactly (including the JSON hashes of the objects).
+
+Every top level message starts with FORMAT_VERSION.
+"""
+import struct
+from typing import Dict, List, Tuple
+
+from amount import Amount, to_amount
+from block import Block, BlockException, BlockHeader
+from transaction import Input, Output, Transaction
+
+FORMAT_VERSION = 2
+
+U8 = struct.Struct(">B")
+U32 = struct.Struct(">I")
+F64 = struct.Struct(">d")
+U64 = struct.Struct(">Q")
+AMOUNT = struct.Struct(">Q")  # base units
+INPUT = struct.Struct(">32sI")  # tx hash, output index
+INPUT_ITEM = struct.Struct(">B32sI")  # kind, tx hash, output index
+# flags, version, previous proof, merkle root, timestamp, nonce
+HEADER = struct.Struct(">BI32s32sQQ")
+HEADER_RECORD_SIZE = HEADER.size + 32  # header, block proof
+
+# transaction flags
+TX_IDX = 1 << 0
+TX_VER = 1 << 1
+TX_FEE = 1 << 2
+TX_PROOF = 1 << 3
+TX_SIG = 1 << 4
+TX_PUB = 1 << 5
+TX_FLOAT_TIME = 1 << 6
+
+# header flags
+HDR_VER = 1 << 0
+HDR_PREV = 1 << 1
+HDR_MERKLE = 1 << 2
+HDR_NONCE = 1 << 3
+
+# block flags
+BLK_IDX = 1 << 0
+BLK_REWARD = 1 << 1
+BLK_PROOF = 1 << 2
+BLK_DIFFICULTY = 1 << 3
+
+# input kinds
+INPUT_HASH = 0  # references a transaction hash
+INPUT_RAW = 1  # any other reference, i.e. the genesis input
+
+# index, version and timestamp of a transaction, by the flags that pick them
+TX_FIXED: Dict[int, struct.Struct] = {
+    flags: struct.Struct(
+        ">"
+        + ("I" if flags & TX_IDX else "")
+        + ("B" if flags & TX_VER else "")
+        + ("d" if flags & TX_FLOAT_TIME else "Q")
+    )
+    for flags in range(TX_FLOAT_TIME << 1)
+    if not flags & ~(TX_IDX | TX_VER | TX_FLOAT_TIME)
+}
+TX_FIXED_FLAGS = TX_IDX | TX_VER | TX_FLOAT_TIME
+
+
+class SerializationException(Exception):
+    """Base class for serialization related exceptions"""
+
+
+class Reader:
+    """Reads fields from a buffer without copying it"""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def unpack(self, fmt: struct.Struct):
+        values = fmt.unpack_from(self.view, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def read(self, n: int) -> memoryview:
+        if self.pos + n > len(self.view):
+            raise SerializationException("unexpected end of data")
+        data = self.view[self.pos : self.pos + n]
+        self.pos += n
+        return data
+
+    def varint(self) -> int:
+        result, self.pos = read_varint(self.view, self.pos)
+        return result
+
+    def varbytes(self) -> memoryview:
+        return self.read(self.varint())
+
+    def version(self):
+        (version,) = self.unpack(U8)
+        if version != FORMAT_VERSION:
+            raise SerializationException(f"unsupported format version {version}")
+
+
+def read_varint(view: memoryview, pos: int) -> Tuple[int, int]:
+    """Varint at `pos`, returns it and the position after it"""
+    result = shift = 0
+    while True:
+        if pos >= len(view):
+            raise SerializationException("unexpected end of data")
+        byte = view[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _read_slice(view: memoryview, pos: int, n: int) -> memoryview:
+    if pos + n > len(view):
+        raise SerializationException("unexpected end of data")
+    return view[pos : pos + n]
+
+
+def write_varint(out: bytearray, n: int):
+    if n < 0:
+        raise SerializationException(f"can't encode negative varint {n}")
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def write_varbytes(out: bytearray, data: bytes):
+    write_varint(out, len(data))
+    out += data
+
+
+def _hash_bytes(h, name="hash") -> bytes:
+    try:
+        raw = bytes.fromhex(h)
+    except (TypeError, ValueError):
+        raw = b""
+    if len(raw) != 32:
+        raise SerializationException(f"{name} {h!r} is not a 32 byte hex hash")
+    return raw
+
+
+def _hex_bytes(h, name) -> bytes:
+    try:
+        return bytes.fromhex(str(h))
+    except ValueError:
+        raise SerializationException(f"{name} {h!r} is not hex")
+
+
+def encode_amount(out: bytearray, amount):
+    out += AMOUNT.pack(to_amount(amount))
+
+
+def decode_amount(reader: Reader) -> Amount:
+    return Amount(reader.unpack(AMOUNT)[0])
+
+
+def encode_input(out: bytearray, inp: Input):
+    try:
+        raw = _hash_bytes(inp.tx_hash)
+    except SerializationException:
+        out += U8.pack(INPUT_RAW)
+        write_varbytes(out, str(inp.tx_hash).encode())
+        out += U32.pack(inp.output_id)
+    else:
+        out += U8.pack(INPUT_HASH)
+        out += INPUT.pack(raw, inp.output_id)
+
+
+def decode_input(reader: Reader) -> Input:
+    (kind,) = reader.unpack(U8)
+    if kind == INPUT_HASH:
+        tx_hash, output_id = reader.unpack(INPUT)
+        return Input(tx_hash.hex(), output_id)
+    elif kind == INPUT_RAW:
+        tx_hash = bytes(reader.varbytes()).decode()
+        (output_id,) = reader.unpack(U32)
+        return Input(tx_hash, output_id)
+    raise SerializationException(f"unknown input kind {kind}")
+
+
+def encode_output(out: bytearray, output: Output):
+    write_varbytes(out, str(output.recipient).encode())
+    encode_amount(out, output.amount)
+
+
+def decode_output(reader: Reader) -> Output:
+    recipient = bytes(reader.varbytes()).decode()
+    return Output(recipient, decode_amount(reader))
+
+
+def _write_transaction(out: bytearray, tx: Transaction):
+    flags = 0
+    flags |= TX_IDX if tx.idx is not None else 0
+    flags |= TX_VER if tx.ver is not None else 0
+    flags |= TX_FEE if tx.fee is not None else 0
+    flags |= TX_PROOF if tx.proof is not None else 0
+    flags |= TX_SIG if tx.signature is not None else 0
+    flags |= TX_PUB if tx.pubkey is not None else 0
+    flags |= TX_FLOAT_TIME if isinstance(tx.timestamp, float) else 0
+
+    out += U8.pack(flags)
+    if flags & TX_IDX:
+        out += U32.pack(tx.idx)
+    if flags & TX_VER:
+        out += U8.pack(tx.ver)
+    out += (F64 if flags & TX_FLOAT_TIME else U64).pack(tx.timestamp)
+
+    write_varint(out, len(tx.inputs))
+    for inp in tx.inputs:
+        encode_input(out, inp)
+    write_varint(out, len(tx.outputs))
+    for output in tx.outputs:
+        encode_output(out, output)
+
+    if flags & TX_FEE:
+        encode_amount(out, tx.fee)
+    if flags & TX_PROOF:
+        out += _hash_bytes(tx.proof, "transaction hash")
+    if flags & TX_SIG:
+        write_varbytes(out, _hex_bytes(tx.signature, "signature"))
+    if flags & TX_PUB:
+        write_varbytes(out, _hex_bytes(tx.pubkey, "pubkey"))
+
+
+def _read_transaction(reader: Reader) -> Transaction:
+    # hot path of decode_block: fields are unpacked straight from the view with
+    # the precompiled structs and the Transaction built without __setattr__
+    view, pos = reader.view, reader.pos
+    (flags,) = U8.unpack_from(view, pos)
+    fixed = TX_FIXED[flags & TX_FIXED_FLAGS]
+    values = fixed.unpack_from(view, pos + 1)
+    pos += 1 + fixed.size
+    idx = values[0] if flags & TX_IDX else None
+    ver = values[-2] if flags & TX_VER else None
+    timestamp = values[-1]
+
+    count, pos = read_varint(view, pos)
+    inputs = []
+    for _ in range(count):
+        if pos >= len(view):
+            raise SerializationException("unexpected end of data")
+        kind = view[pos]
+        if kind == INPUT_HASH:
+            _, tx_hash, output_id = INPUT_ITEM.unpack_from(view, pos)
+            inputs.append((tx_hash.hex(), output_id))
+            pos += INPUT_ITEM.size
+        elif kind == INPUT_RAW:
+            n, pos = read_varint(view, pos + 1)
+            tx_hash = str(_read_slice(view, pos, n), "utf-8")
+            (output_id,) = U32.unpack_from(view, pos + n)
+            inputs.append((tx_hash, output_id))
+            pos += n + U32.size
+        else:
+            raise SerializationException(f"unknown input kind {kind}")
+
+    count, pos = read_varint(view, pos)
+    outputs = []
+    for _ in range(count):
+        n, pos = read_varint(view, pos)
+        recipient = str(_read_slice(view, pos, n), "utf-8")
+        (units,) = AMOUNT.unpack_from(view, pos + n)
+        outputs.append((recipient, Amount(units)))
+        pos += n + AMOUNT.size
+
+    fee = proof = signature = pubkey = None
+    if flags & TX_FEE:
+        fee = Amount(AMOUNT.unpack_from(view, pos)[0])
+        pos += AMOUNT.size
+    if flags & TX_PROOF:
+        proof = _read_slice(view, pos, 32).hex()
+        pos += 32
+    if flags & TX_SIG:
+        n, pos = read_varint(view, pos)
+        signature = _read_slice(view, pos, n).hex()
+        pos += n
+    if flags & TX_PUB:
+        n, pos = read_varint(view, pos)
+        pubkey = _read_slice(view, pos, n).hex()
+        pos += n
+
+    reader.pos = pos
+    return Transaction.from_fields(
+        idx, ver, timestamp, inputs, outputs, fee, proof, signature, pubkey
+    )
+
+
+def encode_transaction(tx: Transaction) -> bytes:
+    out = bytearray(U8.pack(FORMAT_VERSION))
+    _write_transaction(out, tx)
+    return bytes(out)
+
+
+def decode_transaction(data) -> Transaction:
+    reader = Reader(data)
+    reader.version()
+    return _read_transaction(reader)
+
+
+def encode_header(header: BlockHeader) -> bytes:
+    """Fixed width (HEADER.size bytes) encoding of a block header"""
+    flags = 0
+    flags |= HDR_VER if header.version is not None else 0
+    flags |= HDR_PREV if header.previous_proof is not None else 0
+    flags |= HDR_MERKLE if header.merkle_root is not None else 0
+    flags |= HDR_NONCE if header.nonce is not None else 0
+    return HEADER.pack(
+        flags,
+        header.version or 0,
+        _hash_bytes(header.previous_proof, "previous proof") if flags & HDR_PREV else b"",
+        _hash_bytes(header.merkle_root, "merkle root") if flags & HDR_MERKLE else b"",
+        header.timestamp,
+        header.nonce or 0,
+    )
+
+
+def decode_header(data) -> BlockHeader:
+    flags, version, prev, merkle, timestamp, nonce = HEADER.unpack_from(data)
+    return BlockHeader(
+        version if flags & HDR_VER else None,
+        prev.hex() if flags & HDR_PREV else None,
+        merkle.hex() if flags & HDR_MERKLE else None,
+        timestamp,
+        nonce if flags & HDR_NONCE else None,
+    )
+
+
+def encode_header_record(header: BlockHeader, proof: str) -> bytes:
+    """A header followed by the proof of its block, HEADER_RECORD_SIZE bytes
+
+    Blocks link to the proof of the previous block, not to its header, so a
+    header chain is sent as these records.
+    """
+    return encode_header(header) + _hash_bytes(proof, "block proof")
+
+
+def decode_header_records(data) -> List[Tuple[BlockHeader, str]]:
+    """(header, block proof) pairs of packed header records"""
+    view = memoryview(data)
+    if len(view) % HEADER_RECORD_SIZE:
+        raise SerializationException("header records are truncated")
+    return [
+        (
+            decode_header(view[pos : pos + HEADER.size]),
+            view[pos + HEADER.size : pos + HEADER_RECORD_SIZE].hex(),
+        )
+        for pos in range(0, len(view), HEADER_RECORD_SIZE)
+    ]
+
+
+def encode_block(block: Block) -> bytes:
+    """Encode a block, its `last_block` reference is not part of the encoding"""
+    flags = 0
+    flags |= BLK_IDX if block.idx is not None else 0
+    flags |= BLK_REWARD if block.reward is not None else 0
+    flags |= BLK_PROOF if block.proof is not None else 0
+    flags |= BLK_DIFFICULTY if block.difficulty is not None else 0
+
+    out = bytearray(U8.pack(FORMAT_VERSION))
+    out += U8.pack(flags)
+    if flags & BLK_IDX:
+        out += U32.pack(block.idx)
+    out += encode_header(block.header)
+    if flags & BLK_REWARD:
+        encode_amount(out, block.reward)
+    if flags & BLK_DIFFICULTY:
+        out += U32.pack(block.difficulty)
+    if flags & BLK_PROOF:
+        out += _hash_bytes(block.proof, "block proof")
+
+    write_varint(out, len(block.transactions))
+    for tx in block.transactions:
+        tx_out = bytearray()
+        _write_transaction(tx_out, tx)
+        write_varbytes(out, tx_out)
+    return bytes(out)
+
+
+def decode_block(data) -> Block:
+    """Decode a block, its merkle root is taken as encoded
+
+    The transactions aren't hashed into a merkle tree here, `Block.validate`
+    checks the root like it checks the block proof.
+    """
+    reader = Reader(data)
+    reader.version()
+    (flags,) = reader.unpack(U8)
+    idx = reader.unpack(U32)[0] if flags & BLK_IDX else None
+    header = decode_header(reader.read(HEADER.size))
+
+    block = Block(
+        idx=idx,
+        ver=header.version,
+        timestamp=header.timestamp,
+        nonce=header.nonce,
+        previous_proof=header.previous_proof,
+    )
+    block.reward = decode_amount(reader) if flags & BLK_REWARD else None
+    block.difficulty = reader.unpack(U32)[0] if flags & BLK_DIFFICULTY else None
+    block.proof = bytes(reader.read(32)).hex() if flags & BLK_PROOF else None
+
+    txs = []
+    for _ in range(reader.varint()):
+        end = reader.varint() + reader.pos
+        txs.append(_read_transaction(reader))
+        if reader.pos != end:
+            raise SerializationException("transaction length doesn't match its encoding")
+    try:
+        block.load_transactions(txs, header.merkle_root)
+    except BlockException as e:
+        raise SerializationException(str(e))
+    return block
+
+
+if __name__ == "__main__":
+    import time
+
+    from keys import KeyPair
+
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
+    kp = KeyPair.new()
+    block = Block(idx=1, ver=1, nonce=1234)
+    block.previous_proof = "ab" * 32
+    txs = []
+    for n in range(500):
+        tx = Transaction(idx=n, ver=1, fee=Amount.from_coins("0.001"))
+        tx.add_input(Input(f"{n:064x}", n % 3))
+        tx.add_output(
+            Output("0x14f8031bf94c03f75577b39c0a2wpx", Amount.from_coins("12.5"))
+        )
+        tx.add_output(
+            Output("0x5c3e9c1c8729d151e76267c7f02dpp", Amount.from_coins("7.25"))
+        )
+        tx.sign(kp)
+        txs.append(tx)
+    block.add_transactions(txs)
+    block.hash()
+
+    decoded = decode_block(encode_block(block))
+    assert decoded.json() == block.json()
+    assert decoded.hash() == block.proof
+    assert encode_block(decoded) == encode_block(block)
+    decoded.validate()  # checks the merkle root decode_block took as encoded
+    decoded.add_transaction(Transaction(idx=500, ver=1))
+    assert decoded.header.merkle_root != block.header.merkle_root
+
+    def bench(fn, n=20):
+        began = time.perf_counter()
+        for _ in range(n):
+            result = fn()
+        return (time.perf_counter() - began) / n, result
+
+    # uncached JSON encodings, block.json() reuses the transactions' cached json
+    json_time, json_data = bench(
+        lambda: json.dumps(block.to_dict(), sort_keys=True).encode()
+    )
+    bin_time, bin_data = bench(lambda: encode_block(block))
+    # both build the Block, Block.from_dict also rebuilds the merkle tree
+    json_load, _ = bench(lambda: Block.from_dict(json.loads(json_data)))
+    bin_load, _ = bench(lambda: decode_block(bin_data))
+    tx_json, _ = bench(lambda: [json.dumps(tx.to_dict(), sort_keys=True) for tx in txs])
+    tx_bin, _ = bench(lambda: [encode_transaction(tx) for tx in txs])
+    tx_jsons = [json.dumps(tx.to_dict(), sort_keys=True) for tx in txs]
+    tx_blobs = [encode_transaction(tx) for tx in txs]
+    tx_json_load, _ = bench(
+        lambda: [Transaction.from_dict(json.loads(data)) for data in tx_jsons]
+    )
+    tx_bin_load, _ = bench(lambda: [decode_transaction(data) for data in tx_blobs])
+
+    print(f"block of {len(txs)} txs")
+    print(f"  size:   json {len(json_data):>8} B   binary {len(bin_data):>8} B")
+    print(f"  encode: json {json_time * 1000:8.2f} ms  binary {bin_time * 1000:8.2f} ms")
+    print(f"  decode: json {json_load * 1000:8.2f} ms  binary {bin_load * 1000:8.2f} ms")
+    print(f"  txs:    json {tx_json * 1000:8.2f} ms  binary {tx_bin * 1000:8.2f} ms")
+    print(
+        f"  txs decode: json {tx_json_load * 1000:4.2f} ms  "
+        f"binary {tx_bin_load * 1000:4.2f} ms"
+    )
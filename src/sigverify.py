@@ -0,0 +1,117 @@
+"""ChickenTicket signature verification
+
+python-ecdsa verification is pure Python and takes milliseconds per signature,
+so batches of (message, signature, pubkey) triples are sent to a process pool
+in chunks and verified on every core.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Tuple
+
+import ecdsa
+
+from keys import get_verifying_key
+
+CHUNK_SIZE = 32  # triples sent to a worker at once
+INLINE_MAX = 8  # batches this small are verified in-process
+
+Triple = Tuple[bytes, bytes, bytes]  # message, signature, pubkey
+
+
+def verify_signature(message: bytes, signature: bytes, pubkey: bytes) -> bool:
+    """Check a raw signature of `message` against a raw public key"""
+    try:
+        return get_verifying_key(pubkey).verify(signature, message)
+    except (ecdsa.BadSignatureError, ecdsa.MalformedPointError, AssertionError):
+        return False
+
+
+def _verify_chunk(triples: List[Triple]) -> List[bool]:
+    return [verify_signature(*t) for t in triples]
+
+
+def tx_triple(tx) -> Triple:
+    """(message, signature, pubkey) of a signed Transaction"""
+    if tx.signature is None or tx.pubkey is None:
+        return b"", b"", b""  # fails verification
+    return (
+        tx.signing_payload(),
+        bytes.fromhex(str(tx.signature)),
+        bytes.fromhex(str(tx.pubkey)),
+    )
+
+
+class SignatureVerifier:
+    """Verifies batches of signatures on a persistent process pool"""
+
+    def __init__(self, workers: int = None, chunk_size: int = CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def verify(self, triples: Iterable[Triple]) -> List[bool]:
+        """Verify (message, signature, pubkey) triples, results are in order"""
+        triples = list(triples)
+        if len(triples) <= INLINE_MAX or self.workers == 1:
+            return _verify_chunk(triples)
+
+        chunks = [
+            triples[i : i + self.chunk_size]
+            for i in range(0, len(triples), self.chunk_size)
+        ]
+        results = []
+        for chunk in self.pool.map(_verify_chunk, chunks):
+            results.extend(chunk)
+        return results
+
+    def verify_transactions(self, txs) -> List[bool]:
+        """Verify the signatures of many transactions, results are in order"""
+        triples = []
+        for tx in txs:
+            try:
+                triples.append(tx_triple(tx))
+            except ValueError:  # malformed hex
+                triples.append((b"", b"", b""))
+        return self.verify(triples)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import time
+
+    from keys import KeyPair
+
+    kp = KeyPair.new()
+    sk = kp.signing_key
+    pub = bytes.fromhex(str(kp.pub))
+    triples = [(b"msg %d" % i, sk.sign(b"msg %d" % i), pub) for i in range(256)]
+    triples[3] = (b"tampered", triples[3][1], pub)
+
+    began = time.perf_counter()
+    expected = _verify_chunk(triples)
+    single = time.perf_counter() - began
+
+    with SignatureVerifier() as verifier:
+        verifier.verify(triples[: INLINE_MAX + 1])  # start the workers
+        began = time.perf_counter()
+        assert verifier.verify(triples) == expected
+        pooled = time.perf_counter() - began
+
+    assert expected.count(False) == 1 and not expected[3]
+    print(f"single core: {single:.3f}s, {verifier.workers} workers: {pooled:.3f}s")
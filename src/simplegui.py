@@ -95,7 +95,7 @@ class App:
         self.node.setup()
         self.node_thread = threading.Thread(
             target=lambda: self.node.run(), daemon=True
-        )  # flask thread
+        )  # node server thread
         self.node_thread.start()
 
         self.show_main_window()
@@ -118,6 +118,9 @@ class App:
 
         print("Closing!")
         self.main_window.close()
+        self.node.app.stop()
+        # the node flushes its chainstate on the way out
+        self.node_thread.join(timeout=10)
         sys.exit(0)
 
     def connections_changed(self, nconns):
@@ -0,0 +1,348 @@
+"""ChickenTicket parallel chain sync
+
+The missing height range is split into windows of blocks. Every peer gets a
+download thread that takes the lowest pending window and streams it with
+`HTTPPeer.iter_blocks`, so all peers download at once. Downloaded windows land in
+a reorder buffer and are validated and added to the node strictly in height
+order. The buffer is bounded: peers don't run more than `max_ahead` blocks past
+the next height to add. Windows that take longer than `stall_timeout` are handed
+to another peer, whichever copy arrives first is used. A peer that sends an
+invalid block is dropped and the rest of its window is downloaded again.
+
+With a `PeerManager`, a peer that runs out of windows also takes over the
+window holding back the chain when every peer on it is a lot slower, so one
+slow peer doesn't set the pace. Invalid blocks get their sender banned.
+
+Sync is headers first: `download_headers` fetches the compact header chain up to
+the agreed tip and checks that it links and that every header hash meets the
+difficulty, then every downloaded body must match its header and block proof. A
+bad fork is rejected after a few kilobytes.
+"""
+import heapq
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from block import Block, BlockHeader
+from miner import check_proof_of_work
+from peers import INVALID_OBJECT, PeerManager
+from sigverify import SignatureVerifier
+
+WINDOW_SIZE = 128  # blocks per download window
+MAX_AHEAD_WINDOWS = 16  # windows downloaded past the next height to add
+STALL_TIMEOUT = 30  # seconds before a window is given to another peer
+MAX_PEER_FAILURES = 3  # failed windows before a peer is dropped
+HEADERS_PER_REQUEST = 2000
+BLOCK_SIZE_ESTIMATE = 2 * 2**10  # bytes, to weigh peer throughput against latency
+SLOW_PEER_FACTOR = 2  # how much slower peers must be to lose the next window
+
+HeaderChain = Dict[int, Tuple[BlockHeader, str]]  # height -> (header, block proof)
+
+
+class SyncException(Exception):
+    """Base class for chain sync related exceptions"""
+
+
+@dataclass
+class SyncProgress:
+    height: int  # last height added
+    target: int
+    blocks: int  # blocks added by this sync
+    elapsed: float
+    peers: int  # peers still downloading
+
+    @property
+    def rate(self) -> float:
+        """Blocks added per second"""
+        return self.blocks / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"SYNC: {self.height}/{self.target} "
+            f"({self.rate:.1f} blocks/s, {self.peers} peers)"
+        )
+
+
+def download_headers(
+    peers: List,
+    start: int,
+    target: int,
+    tip_proof: str,
+    previous_proof: Optional[str] = None,
+    difficulty: int = 0,
+    batch: int = HEADERS_PER_REQUEST,
+) -> HeaderChain:
+    """Download and check the header chain of heights [start, target]
+
+    Every header must name the proof of the block before it, starting from
+    `previous_proof` (the proof at `start - 1`), and the chain must end at
+    `tip_proof`. Every header but the genesis one must hash below the target of
+    `difficulty`. Peers that send a broken chain are skipped.
+    """
+    for peer in peers:
+        chain: HeaderChain = {}
+        prev = previous_proof
+        height = start
+        try:
+            while height <= target:
+                records = peer.get_headers(height, min(batch, target + 1 - height))
+                if not records:
+                    raise SyncException(f"{peer} has no headers at {height}")
+                for header, proof in records:
+                    if height > 0 and header.previous_proof != prev:
+                        raise SyncException(f"{peer} header {height} doesn't link")
+                    # the genesis block is built in, not mined
+                    if height > 0 and not check_proof_of_work(header, difficulty):
+                        raise SyncException(
+                            f"{peer} header {height} doesn't meet difficulty {difficulty}"
+                        )
+                    chain[height] = (header, proof)
+                    prev = proof
+                    height += 1
+            if prev != tip_proof:
+                raise SyncException(f"{peer} headers don't lead to {tip_proof}")
+        except Exception as e:
+            print("SYNC: header download failed:", type(e), str(e))
+            continue
+        return chain
+    raise SyncException(f"no peer sent a valid header chain to {tip_proof}")
+
+
+def window_bytes(window_size: int = WINDOW_SIZE) -> int:
+    """Estimated size of a download window, for `PeerManager.rank`"""
+    return window_size * BLOCK_SIZE_ESTIMATE
+
+
+@dataclass(eq=False)
+class _Window:
+    start: int
+    count: int
+    peer: object = None
+    started: float = 0.0
+
+
+class ChainSync:
+    def __init__(
+        self,
+        node,
+        peers: List,
+        target: int,
+        window_size: int = WINDOW_SIZE,
+        max_ahead_windows: int = MAX_AHEAD_WINDOWS,
+        stall_timeout: float = STALL_TIMEOUT,
+        progress_cb: Callable[[SyncProgress], None] = print,
+        headers: HeaderChain = None,
+        peer_manager: PeerManager = None,
+    ):
+        self.node = node
+        self.peer_manager = peer_manager
+        self.headers = headers  # checked header chain the bodies must match
+        self.peers = list(peers)
+        self.target = target  # height to sync to
+        self.window_size = window_size
+        self.max_ahead = window_size * max_ahead_windows
+        self.stall_timeout = stall_timeout
+        self.progress_cb = progress_cb
+
+        self.next_height = node.store.height + 1  # next height to add
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[int, int]] = []  # heap of (start, count)
+        self._in_flight: Dict[int, List[_Window]] = {}  # start -> assignments
+        # start -> (peer, downloaded blocks)
+        self._buffer: Dict[int, Tuple[object, List[Block]]] = {}
+        self._failures: Dict[int, int] = {}  # id(peer) -> failed windows
+        self._banned = set()  # id(peer) of peers that sent invalid blocks
+        self._active = 0  # download threads running
+        self._done = False
+
+        for start in range(self.next_height, target + 1, window_size):
+            heapq.heappush(self._pending, (start, min(window_size, target + 1 - start)))
+
+    def _next_window(self, peer) -> Optional[_Window]:
+        """Lowest pending window within the reorder bound, waits for one"""
+        with self._cond:
+            while not self._done and id(peer) not in self._banned:
+                if (
+                    self._pending
+                    and self._pending[0][0] < self.next_height + self.max_ahead
+                ):
+                    start, count = heapq.heappop(self._pending)
+                    if start in self._buffer or start < self.next_height:
+                        continue  # a stalled copy already arrived
+                    window = _Window(start, count, peer, time.monotonic())
+                    self._in_flight.setdefault(start, []).append(window)
+                    return window
+                window = self._steal(peer)
+                if window is not None:
+                    return window
+                self._cond.wait(1)
+            return None
+
+    def _steal(self, peer) -> Optional[_Window]:
+        """Copy of the window at the next height if `peer` is a lot faster"""
+        assignments = self._in_flight.get(self.next_height)
+        if self.peer_manager is None or not assignments:
+            return None
+        now = time.monotonic()
+        nbytes = window_bytes(assignments[0].count)
+        score = self.peer_manager.score(peer, nbytes)
+        # only once `peer` would have downloaded the window already
+        if any(w.peer is peer or now - w.started < score for w in assignments):
+            return None
+        if all(
+            self.peer_manager.score(w.peer, nbytes) > score * SLOW_PEER_FACTOR
+            for w in assignments
+        ):
+            window = _Window(self.next_height, assignments[0].count, peer, now)
+            assignments.append(window)
+            return window
+        return None
+
+    def _download(self, peer):
+        try:
+            while True:
+                window = self._next_window(peer)
+                if window is None:
+                    return
+                try:
+                    blocks = [
+                        Block.from_dict(data)
+                        for data in peer.iter_blocks(window.start, window.count)
+                    ]
+                    if not blocks:
+                        raise SyncException(f"peer has no blocks at {window.start}")
+                except Exception as e:
+                    print(f"SYNC: window {window.start} failed:", type(e), str(e))
+                    self._finish(window, None)
+                    if self._fail(peer):
+                        return
+                    continue
+                self._finish(window, blocks)
+                if id(peer) in self._banned:
+                    return
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def _fail(self, peer) -> bool:
+        """Count a failed window, True if the peer should stop downloading"""
+        with self._cond:
+            failures = self._failures.get(id(peer), 0) + 1
+            self._failures[id(peer)] = failures
+            return failures >= MAX_PEER_FAILURES
+
+    def _finish(self, window: _Window, blocks: Optional[List[Block]]):
+        with self._cond:
+            assignments = self._in_flight.get(window.start, [])
+            if window in assignments:
+                assignments.remove(window)
+            delivered = window.start in self._buffer or window.start < self.next_height
+            if blocks and not delivered:
+                self._buffer[window.start] = (window.peer, blocks)
+                self._in_flight.pop(window.start, None)
+                if len(blocks) < window.count:
+                    # the peer stopped short, fetch the rest separately
+                    heapq.heappush(
+                        self._pending,
+                        (window.start + len(blocks), window.count - len(blocks)),
+                    )
+            elif not delivered and not assignments:
+                heapq.heappush(self._pending, (window.start, window.count))
+            self._cond.notify_all()
+
+    def _reassign_stalled(self):
+        now = time.monotonic()
+        for start, assignments in self._in_flight.items():
+            if assignments and all(
+                now - w.started > self.stall_timeout for w in assignments
+            ):
+                # the slow peer keeps going, the first copy to arrive wins
+                if (start, assignments[0].count) not in self._pending:
+                    heapq.heappush(self._pending, (start, assignments[0].count))
+                    for w in assignments:
+                        w.started = now
+        self._cond.notify_all()
+
+    def _tip_proof(self) -> str:
+        tip = self.node.tip
+        if tip is not None and tip.idx == self.next_height - 1:
+            return tip.proof
+        return self.node.store.get_hash(self.next_height - 1).hex()
+
+    def _add_blocks(self, peer, blocks: List[Block], verifier: SignatureVerifier):
+        """Validate and add a window in order, returns the number of blocks added
+
+        On an invalid block the peer is dropped and the rest of the window is
+        queued for download again.
+        """
+        for n, block in enumerate(blocks):
+            height = self.next_height
+            try:
+                if block.idx != height:
+                    raise SyncException(f"expected block {height}, got {block.idx}")
+                if height > 0 and block.previous_proof != self._tip_proof():
+                    raise SyncException(f"block {height} doesn't extend the chain")
+                if self.headers is not None:
+                    header, proof = self.headers[height]
+                    if block.proof != proof or block.header != header:
+                        raise SyncException(f"block {height} doesn't match its header")
+                block.validate(verifier, self.node.utxos)
+                self.node.add_block(block)
+            except Exception as e:
+                print(f"SYNC: dropping peer, invalid block {height}:", type(e), str(e))
+                if self.peer_manager is not None:
+                    self.peer_manager.misbehaving(
+                        peer, INVALID_OBJECT, f"invalid block {height}"
+                    )
+                with self._cond:
+                    self._banned.add(id(peer))
+                    heapq.heappush(self._pending, (height, len(blocks) - n))
+                    self._cond.notify_all()
+                return n
+            self.next_height = height + 1
+        return len(blocks)
+
+    def run(self) -> int:
+        """Download and add every block up to the target, returns the height"""
+        began = time.monotonic()
+        added = 0
+        threads = [
+            threading.Thread(target=self._download, args=(peer,), daemon=True)
+            for peer in self.peers
+        ]
+        self._active = len(threads)
+        for thread in threads:
+            thread.start()
+
+        try:
+            with SignatureVerifier() as verifier:
+                while self.next_height <= self.target:
+                    with self._cond:
+                        entry = self._buffer.pop(self.next_height, None)
+                        if entry is None:
+                            if self._active == 0:
+                                raise SyncException(
+                                    f"no peers left to sync from at {self.next_height}"
+                                )
+                            self._reassign_stalled()
+                            self._cond.wait(1)
+                            continue
+                    added += self._add_blocks(*entry, verifier)
+                    with self._cond:
+                        self._cond.notify_all()  # the reorder bound moved
+                    self.progress_cb(
+                        SyncProgress(
+                            self.next_height - 1,
+                            self.target,
+                            added,
+                            time.monotonic() - began,
+                            self._active,
+                        )
+                    )
+        finally:
+            with self._cond:
+                self._done = True
+                self._cond.notify_all()
+        return self.next_height - 1
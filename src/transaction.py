@@ -1,13 +1,14 @@
 import time
 from dataclasses import dataclass
-from decimal import Decimal
 from typing import List
 
 import ecdsa
 
 from address import Address
-from crypto.chicken import chicken_hash
+from amount import Amount, to_amount
+from crypto.chicken import chicken_hash, chicken_hash_many
 from keys import CURVE, KeyPair
+from sigverify import tx_triple, verify_signature
 
 try:
     import ujson as json
@@ -18,6 +19,77 @@ except ImportError:
 
     USING_UJSON = False
 
+# fields that aren't part of the hash payload, changing them keeps the hash
+UNHASHED_FIELDS = ("proof", "signature", "pubkey")
+
+
+class _TrackedList(list):
+    """List of inputs or outputs that invalidates its transaction's caches"""
+
+    def __init__(self, owner, items=()):
+        super().__init__(items)
+        self.owner = owner
+        for item in self:
+            item._owner = owner
+
+    def __reduce__(self):
+        return _TrackedList, (self.owner, list(self))
+
+    def _changed(self):
+        for item in self:
+            item._owner = self.owner
+        self.owner._invalidate()
+
+
+def _tracked(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self._changed()
+        return result
+
+    wrapper.__name__ = name
+    return wrapper
+
+
+for _name in (
+    "append",
+    "extend",
+    "insert",
+    "pop",
+    "remove",
+    "clear",
+    "sort",
+    "reverse",
+    "__setitem__",
+    "__delitem__",
+    "__iadd__",
+    "__imul__",
+):
+    setattr(_TrackedList, _name, _tracked(_name))
+
+
+def _decoded_list(owner, cls, names, rows) -> _TrackedList:
+    """Items of `cls` with the fields `names` set from `rows`, skipping __init__"""
+    items = _TrackedList.__new__(_TrackedList)
+    for row in rows:
+        item = object.__new__(cls)
+        item.__dict__.update(zip(names, row), _owner=owner)
+        list.append(items, item)
+    items.owner = owner
+    return items
+
+
+class _Tracked:
+    """Mixin notifying the owning transaction when a field changes"""
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        owner = self.__dict__.get("_owner")
+        if owner is not None and name != "_owner":
+            owner._invalidate()
+
 
 @dataclass
 class TXVersion:
@@ -27,7 +99,7 @@ class TXVersion:
 
 
 @dataclass
-class Input:
+class Input(_Tracked):
     tx_hash: str
     output_id: int
 
@@ -39,9 +111,14 @@ class Input:
 
 
 @dataclass
-class Output:
+class Output(_Tracked):
     recipient: Address  # address the amount is to be sent to
-    amount: Decimal
+    amount: Amount  # base units, see Amount.from_coins for coins
+
+    def __setattr__(self, name, value):
+        if name == "amount":
+            value = to_amount(value)
+        super().__setattr__(name, value)
 
     def __str__(self):
         return json.dumps(self.to_dict(), sort_keys=True)
@@ -56,12 +133,14 @@ class Transaction:
     timestamp: int
     inputs: List[Input]  # tx_hash, output_id
     outputs: List[Output]  # recipient, amount
-    fee: Decimal
+    fee: Amount
     proof: bytes
     signature: bytes
     pubkey: bytes
 
     def __init__(self, **kwargs):
+        # serializations and the hash, dropped when a field they cover changes
+        object.__setattr__(self, "_cache", {})
         self.idx = kwargs.get("idx")
         self.ver = kwargs.get("ver") or kwargs.get("version")
         self.timestamp = kwargs.get("timestamp") or time.time()
@@ -72,6 +151,30 @@ class Transaction:
         self.signature = kwargs.get("signature")
         self.pubkey = kwargs.get("pubkey")
 
+    def __setattr__(self, name, value):
+        if name in ("inputs", "outputs"):
+            value = _TrackedList(self, value)
+        else:
+            if name == "fee" and value is not None:
+                value = to_amount(value)
+            if self.__dict__.get(name, self) is value:
+                return
+        object.__setattr__(self, name, value)
+        self._invalidate(name)
+
+    def _invalidate(self, name=None):
+        """Drop the cached serializations covering the field `name` (None: all)"""
+        cache = self._cache
+        if not cache:
+            return
+        cache.pop("json", None)
+        cache.pop("fragment", None)
+        if name != "signature":
+            cache.pop("signing", None)
+        if name not in UNHASHED_FIELDS:
+            cache.pop("payload", None)
+            cache.pop("hash", None)
+
     def to_dict(self):
         data = {
             "idx": self.idx,
@@ -86,18 +189,84 @@ class Transaction:
         }
         return data
 
+    @classmethod
+    def from_fields(
+        cls, idx, ver, timestamp, inputs, outputs, fee, proof, signature, pubkey
+    ):
+        """Build a transaction from decoded fields, skipping `__setattr__`
+
+        `inputs` are (tx hash, output index) and `outputs` (recipient, Amount)
+        pairs. Decoders use this, the fields must already have their final types.
+        """
+        tx = object.__new__(cls)
+        ins = _decoded_list(tx, Input, ("tx_hash", "output_id"), inputs)
+        outs = _decoded_list(tx, Output, ("recipient", "amount"), outputs)
+        tx.__dict__.update(
+            _cache={},
+            idx=idx,
+            ver=ver,
+            timestamp=timestamp,
+            inputs=ins,
+            outputs=outs,
+            fee=fee,
+            proof=proof,
+            signature=signature,
+            pubkey=pubkey,
+        )
+        return tx
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """Rebuild a transaction from its `to_dict()` form"""
+        fee, pubkey = data.get("fee"), data.get("pub")
+        return cls(
+            idx=data.get("idx"),
+            ver=data.get("ver"),
+            timestamp=data.get("time"),
+            inputs=[Input(i["tx"], i["idx"]) for i in data.get("in") or []],
+            outputs=[
+                Output(o["recipient"], Amount(int(o["amount"])))
+                for o in data.get("out") or []
+            ],
+            # `to_dict()` stringifies missing values
+            fee=Amount(int(fee)) if fee not in (None, "None") else None,
+            proof=data.get("hash"),
+            signature=data.get("sig"),
+            pubkey=pubkey if pubkey != "None" else None,
+        )
+
     def json(self):
-        return json.dumps(self.to_dict(), sort_keys=True)
+        cached = self._cache.get("json")
+        if cached is None:
+            cached = self._cache["json"] = json.dumps(self.to_dict(), sort_keys=True)
+        return cached
+
+    def fragment(self):
+        """`to_dict()` serialized in field order, as embedded by `Block.hash`"""
+        cached = self._cache.get("fragment")
+        if cached is None:
+            cached = self._cache["fragment"] = json.dumps(self.to_dict())
+        return cached
 
     def __repr__(self):
         return self.json()
 
+    def hash_payload(self):
+        """The serialized bytes the transaction hash commits to"""
+        cached = self._cache.get("payload")
+        if cached is None:
+            data = self.to_dict()
+            del data["hash"]
+            del data["sig"]
+            del data["pub"]
+            cached = self._cache["payload"] = json.dumps(data, sort_keys=True).encode()
+        return cached
+
     def hash(self):
-        data = self.to_dict()
-        del data["hash"]
-        del data["sig"]
-        del data["pub"]
-        self.proof = chicken_hash(json.dumps(data, sort_keys=True).encode()).hex()
+        proof = self._cache.get("hash")
+        if proof is None:
+            proof = self._cache["hash"] = chicken_hash(self.hash_payload()).hex()
+        self.proof = proof
         return self.proof
 
     def add_input(self, input):
@@ -112,20 +281,48 @@ class Transaction:
             return
         self.outputs.append(output)
 
+    def signing_payload(self):
+        """The serialized bytes the signature commits to, everything but `sig`"""
+        cached = self._cache.get("signing")
+        if cached is None:
+            data = self.to_dict()
+            data["sig"] = None
+            cached = self._cache["signing"] = json.dumps(data, sort_keys=True).encode()
+        return cached
+
     def sign(self, key: KeyPair):
         if not hasattr(self, "proof") or self.proof is None:
             self.hash()
         if isinstance(key, KeyPair):
-            priv_key = key.priv
+            sk = key.signing_key  # parsed once per KeyPair
             self.pubkey = key.pub
-        elif isinstance(key, [bytes, str]):
-            priv_key = key
+        elif isinstance(key, (bytes, str)):
+            sk = ecdsa.SigningKey.from_string(bytes.fromhex(str(key)), curve=CURVE)
         else:
             raise TypeError(f"cannot sign transaction with key: {key}")
-        sk = ecdsa.SigningKey.from_string(bytes.fromhex(str(priv_key)), curve=CURVE)
-        self.signature = sk.sign(bytes(str(self), encoding="utf-8")).hex()
+        self.signature = sk.sign(self.signing_payload()).hex()
         return self.signature
 
+    def verify(self):
+        """Check the signature against the transaction's `pubkey`"""
+        try:
+            return verify_signature(*tx_triple(self))
+        except ValueError:  # malformed hex
+            return False
+
+
+def hash_transactions(txs: List[Transaction], threads: int = 0):
+    """Hash many transactions in one batch, setting each `tx.proof`
+
+    Returns the list of proofs in the same order as `txs`
+    """
+    digests = chicken_hash_many([tx.hash_payload() for tx in txs], threads)
+    proofs = []
+    for tx, digest in zip(txs, digests):
+        tx.proof = tx._cache["hash"] = digest.hex()
+        proofs.append(tx.proof)
+    return proofs
+
 
 if __name__ == "__main__":
     # test creating a transaction
@@ -133,14 +330,14 @@ if __name__ == "__main__":
     tx.idx = 0
     tx.ver = TXVersion.ver1
     tx.timestamp = int(time.time())
-    tx.fee = Decimal("1.0")
+    tx.fee = Amount.from_coins("1.0")
 
     # genesis input and output
     genesis = "genesis"
     ipt = Input(chicken_hash((genesis + "input").encode()).hex(), 0)
     tx.add_input(ipt)
 
-    opt = Output("0x0", Decimal("1.0"))
+    opt = Output("0x0", Amount.from_coins("1.0"))
     tx.add_output(opt)
 
     # test signing
@@ -149,6 +346,7 @@ if __name__ == "__main__":
     # Calling it explicitly is the preferred behavior, though.
     keys = KeyPair.new()
     tx.sign(keys)
+    assert tx.verify()
     # I'm attempting to make everything easily printable for not only
     # debugging purposes, but for message serialization purposes
     # as well
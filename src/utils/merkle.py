@@ -4,25 +4,58 @@ import binascii
 import hashlib
 import sys
 
+from crypto.chicken import chicken_hash, chicken_hash_many
+
+
+class ChickenHash:
+    """hashlib-like wrapper around `chicken_hash` for use as a tree hash function"""
+
+    digest_size = 32
+
+    def __init__(self, data=b""):
+        self._digest = chicken_hash(bytes(data))
+
+    def digest(self):
+        return self._digest
+
+    def hexdigest(self):
+        return self._digest.hex()
+
+
+def get_hash_function(hash_type):
+    """Get the hashlib-like constructor for a tree `hash_type`"""
+    if hash_type == "chicken":
+        return ChickenHash
+    elif hash_type in [
+        "sha256",
+        "md5",
+        "sha224",
+        "sha384",
+        "sha512",
+        "sha3_256",
+        "sha3_224",
+        "sha3_384",
+        "sha3_512",
+    ]:
+        return getattr(hashlib, hash_type)
+    else:
+        raise Exception("`hash_type` {} nor supported".format(hash_type))
+
 
 class MerkleTree:
-    def __init__(self, hash_type="sha256"):
-        hash_type = hash_type.lower()
-        if hash_type in [
-            "sha256",
-            "md5",
-            "sha224",
-            "sha384",
-            "sha512",
-            "sha3_256",
-            "sha3_224",
-            "sha3_384",
-            "sha3_512",
-        ]:
-            self.hash_function = getattr(hashlib, hash_type)
-        else:
-            raise Exception("`hash_type` {} nor supported".format(hash_type))
+    """Merkle tree over a list of leaves
 
+    With `incremental=True` the tree stays ready while leaves are added. Each
+    appended leaf only rehashes the right edge of the tree, updating the root
+    in O(log n) instead of rebuilding every level on the next `make_tree()`.
+    Roots and proofs are identical to those of a fully rebuilt tree.
+    """
+
+    def __init__(self, hash_type="sha256", incremental=False):
+        hash_type = hash_type.lower()
+        self.hash_function = get_hash_function(hash_type)
+        self.hash_type = hash_type
+        self.incremental = incremental
         self.reset_tree()
 
     @staticmethod
@@ -32,19 +65,61 @@ class MerkleTree:
     def reset_tree(self):
         self.leaves = list()
         self.levels = None
-        self.is_ready = False
+        self.is_ready = self.incremental
 
     def add_leaf(self, values, do_hash=False):
-        self.is_ready = False
         # check if single leaf
         if not isinstance(values, tuple) and not isinstance(values, list):
             values = [values]
-        for v in values:
-            if do_hash:
-                v = v.encode("utf-8")
-                v = self.hash_function(v).hexdigest()
-            v = bytearray.fromhex(v)
-            self.leaves.append(v)
+        if do_hash:
+            leaves = (
+                bytearray(d) for d in self._hash_many(v.encode("utf-8") for v in values)
+            )
+        else:
+            leaves = (bytearray.fromhex(v) for v in values)
+
+        if self.incremental and self.is_ready:
+            for leaf in leaves:
+                self._append_leaf(leaf)
+        else:
+            self.is_ready = False
+            self.leaves.extend(leaves)
+
+    def _append_leaf(self, leaf):
+        """Append a leaf to a ready tree, updating only the right edge"""
+        self.leaves.append(leaf)
+        if self.levels is None:
+            self.levels = [self.leaves]
+            return
+
+        # walk up from the leaves (the last level) while the level isn't the root,
+        # the node that changed on each level is always the last one
+        x = len(self.levels) - 1
+        while len(self.levels[x]) > 1:
+            level = self.levels[x]
+            index = len(level) - 1
+            if index % 2 == 1:
+                node = self.hash_function(level[index - 1] + level[index]).digest()
+            else:
+                node = level[index]  # odd end node is promoted as-is
+
+            if x == 0:
+                self.levels.insert(0, [node])  # tree grew a level, new root
+                break
+
+            parent = self.levels[x - 1]
+            if index // 2 == len(parent):
+                parent.append(node)
+            else:
+                parent[index // 2] = node
+            x -= 1
+
+    def _hash_many(self, payloads):
+        """Hash many leaf payloads in one call"""
+        if self.hash_type == "chicken":
+            return chicken_hash_many(payloads)
+        hash_function = self.hash_function
+        return [hash_function(p).digest() for p in payloads]
 
     def get_leaf(self, index):
         return self._to_hex(self.leaves[index])
@@ -90,6 +165,10 @@ class MerkleTree:
         else:
             return None
 
+    def pack(self):
+        """Get a PackedMerkleTree of the current leaves"""
+        return PackedMerkleTree(self.leaves, self.hash_type)
+
     def get_proof(self, index):
         if self.levels is None:
             return None
@@ -112,6 +191,10 @@ class MerkleTree:
                 index = int(index / 2.0)
             return proof
 
+    def validate_proofs(self, pairs, merkle_root):
+        """Batch validate (leaf, proof) pairs, see `validate_proofs`"""
+        return validate_proofs(pairs, merkle_root, self.hash_type)
+
     def validate_proof(self, proof, target_hash, merkle_root):
         merkle_root = bytearray.fromhex(merkle_root)
         target_hash = bytearray.fromhex(target_hash)
@@ -129,3 +212,189 @@ class MerkleTree:
                     sibling = bytearray.fromhex(p["right"])
                     proof_hash = self.hash_function(proof_hash + sibling).digest()
             return proof_hash == merkle_root
+
+
+PROOF_LEFT = b"\x00"  # sibling is a left node
+PROOF_RIGHT = b"\x01"  # sibling is a right node
+
+
+def _pack_proof(proof):
+    packed = bytearray()
+    for p in proof:
+        if "left" in p:
+            packed += PROOF_LEFT + bytes.fromhex(p["left"])
+        else:
+            packed += PROOF_RIGHT + bytes.fromhex(p["right"])
+    return bytes(packed)
+
+
+def validate_proofs(pairs, merkle_root, hash_type="sha256"):
+    """Validate many (leaf, proof) pairs against one merkle root
+
+    Leaves and the root are raw digests, proofs are binary proofs as returned
+    by `PackedMerkleTree.get_proofs` (dict proofs are converted). A proof is
+    valid if hashing the leaf with every one of its steps gives the root.
+
+    Every (node, rest of the proof) pair on the path of a valid proof is cached.
+    A later proof that reaches a cached node with the very same remaining steps
+    is known to reach the root, so the upper nodes shared between proofs are
+    only hashed once while every step of each proof is still checked.
+
+    Returns a list of the indexes of the pairs whose proof failed
+    """
+    hash_function = get_hash_function(hash_type.lower())
+    step = hash_function().digest_size + 1
+    if isinstance(merkle_root, str):
+        merkle_root = bytes.fromhex(merkle_root)
+
+    # (node, remaining proof steps) known to hash to the root
+    verified = {(bytes(merkle_root), b"")}
+    failed = []
+    for n, (leaf, proof) in enumerate(pairs):
+        if not isinstance(proof, (bytes, bytearray, memoryview)):
+            proof = _pack_proof(proof)
+        proof = bytes(proof)
+        node = bytes(leaf)
+
+        if len(proof) % step:
+            failed.append(n)
+            continue
+
+        path = []
+        i = 0
+        while (node, proof[i:]) not in verified:
+            if i == len(proof):
+                failed.append(n)  # all steps used without reaching the root
+                break
+            path.append((node, proof[i:]))
+            side, sibling = proof[i], proof[i + 1 : i + step]
+            if side == PROOF_LEFT[0]:
+                node = hash_function(sibling + node).digest()
+            elif side == PROOF_RIGHT[0]:
+                node = hash_function(node + sibling).digest()
+            else:
+                failed.append(n)  # malformed side byte
+                break
+            i += step
+        else:
+            verified.update(path)
+    return failed
+
+
+class PackedMerkleTree:
+    """Compact, read-only Merkle tree
+
+    Every level is stored back-to-back, leaves first, in one contiguous `bytes`
+    buffer with a fixed stride of the digest size, and nodes are addressed
+    through memoryviews instead of one `bytearray` object per node. Builds the
+    same tree as MerkleTree, odd end nodes are promoted to the next level.
+
+    Binary proofs are a sequence of `1 + stride` byte records, a side byte
+    (PROOF_LEFT or PROOF_RIGHT) followed by the sibling digest, from the leaf
+    level up.
+    """
+
+    def __init__(self, leaves, hash_type="sha256"):
+        self.hash_type = hash_type.lower()
+        self.hash_function = get_hash_function(self.hash_type)
+        self.stride = self.hash_function().digest_size
+
+        level = b"".join(leaves)
+        if len(level) % self.stride:
+            raise ValueError(f"leaves must be {self.stride} bytes each")
+
+        stride, hash_function = self.stride, self.hash_function
+        levels = [level]
+        self.level_counts = [len(level) // stride]
+        while self.level_counts[-1] > 1:
+            count = self.level_counts[-1]
+            view = memoryview(levels[-1])
+            pairs = (count // 2) * 2 * stride
+            nodes = [
+                hash_function(view[i : i + 2 * stride]).digest()
+                for i in range(0, pairs, 2 * stride)
+            ]
+            if count % 2 == 1:
+                nodes.append(view[pairs:])  # promote odd end node
+            levels.append(b"".join(nodes))
+            self.level_counts.append(len(nodes))
+
+        self.level_offsets = []
+        offset = 0
+        for level in levels:
+            self.level_offsets.append(offset)
+            offset += len(level)
+        self.buffer = b"".join(levels)
+        self._view = memoryview(self.buffer)
+
+    def get_leaf_count(self):
+        return self.level_counts[0]
+
+    def get_node(self, level, index):
+        """memoryview of node `index` on `level`, level 0 being the leaves"""
+        if not 0 <= index < self.level_counts[level]:
+            raise IndexError(f"no node {index} on level {level}")
+        start = self.level_offsets[level] + index * self.stride
+        return self._view[start : start + self.stride]
+
+    def get_leaf(self, index):
+        return self.get_node(0, index).hex()
+
+    @property
+    def root(self):
+        if self.level_counts[-1] == 0:
+            return None
+        return bytes(self.get_node(len(self.level_counts) - 1, 0))
+
+    def get_merkle_root(self):
+        root = self.root
+        return root.hex() if root is not None else None
+
+    def get_proofs(self, indices):
+        """Get binary proofs for many leaves in one pass over the levels"""
+        positions = list(indices)
+        for index in positions:
+            if not 0 <= index < self.level_counts[0]:
+                raise IndexError(f"no leaf {index}")
+
+        view, stride = self._view, self.stride
+        proofs = [bytearray() for _ in positions]
+        levels = zip(self.level_offsets[:-1], self.level_counts[:-1])
+        for offset, count in levels:
+            for j, index in enumerate(positions):
+                if index == count - 1 and count % 2 == 1:
+                    pass  # odd end node, no sibling on this level
+                elif index % 2:
+                    start = offset + (index - 1) * stride
+                    proofs[j] += PROOF_LEFT
+                    proofs[j] += view[start : start + stride]
+                else:
+                    start = offset + (index + 1) * stride
+                    proofs[j] += PROOF_RIGHT
+                    proofs[j] += view[start : start + stride]
+                positions[j] = index // 2
+        return [bytes(p) for p in proofs]
+
+    def get_proof(self, index):
+        """Get a proof in the same format as `MerkleTree.get_proof`"""
+        return self.proof_to_dicts(self.get_proofs([index])[0])
+
+    def proof_to_dicts(self, proof):
+        """Convert a binary proof to a list of {"left"|"right": hex} dicts"""
+        step = self.stride + 1
+        view = memoryview(proof)
+        dicts = []
+        for i in range(0, len(view), step):
+            sibling_pos = "left" if view[i : i + 1] == PROOF_LEFT else "right"
+            dicts.append({sibling_pos: view[i + 1 : i + step].hex()})
+        return dicts
+
+    def proof_from_dicts(self, proof):
+        """Convert a list of {"left"|"right": hex} dicts to a binary proof"""
+        return _pack_proof(proof)
+
+    def validate_proofs(self, pairs, merkle_root=None):
+        """Batch validate (leaf, proof) pairs, see `validate_proofs`"""
+        if merkle_root is None:
+            merkle_root = self.root
+        return validate_proofs(pairs, merkle_root, self.hash_type)
@@ -0,0 +1,384 @@
+"""ChickenTicket unspent transaction output set
+
+Tracks every unspent output, keyed by the compact 36 byte outpoint of the
+transaction hash and output index that an `Input(tx_hash, output_id)` refers to.
+Coins are read through an in-memory write-back cache over a SQLite store, and
+changes are flushed in one batch at block boundaries. Each applied block keeps
+undo data so it can be disconnected again on a reorg.
+"""
+import sqlite3
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from amount import Amount
+
+try:
+    import ujson as json
+
+    USING_UJSON = True
+except ImportError:
+    import json
+
+    USING_UJSON = False
+
+SRC_PATH = Path(__file__).parent
+DEFAULT_UTXO_FP = SRC_PATH.parent / "chain" / "utxo.sqlite"
+
+OUTPOINT = struct.Struct(">32sI")  # tx hash, output index
+COIN_HEADER = struct.Struct(">IQH")  # height, amount, recipient length
+UNDO_HEADER = struct.Struct(">36sH")  # outpoint, coin length
+
+CACHE_SIZE = 200000  # cached coins before flushing at a block boundary
+UNDO_DEPTH = 100  # blocks that can be disconnected
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS utxos (
+    outpoint BLOB PRIMARY KEY,
+    address TEXT NOT NULL,
+    coin BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS utxos_address ON utxos (address);
+CREATE TABLE IF NOT EXISTS undo (
+    height INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+"""
+
+
+class UTXOException(Exception):
+    """Base class for UTXO set related exceptions"""
+
+
+@dataclass
+class Coin:
+    recipient: str
+    amount: Amount  # base units
+    height: int  # height of the block that created it
+
+    def pack(self) -> bytes:
+        recipient = self.recipient.encode()
+        return COIN_HEADER.pack(self.height, self.amount, len(recipient)) + recipient
+
+    @classmethod
+    def unpack(cls, data: bytes):
+        height, amount, length = COIN_HEADER.unpack_from(data)
+        start = COIN_HEADER.size
+        recipient = bytes(data[start : start + length]).decode()
+        return cls(recipient, Amount(amount), height)
+
+
+def outpoint(tx_hash: str, output_id: int) -> bytes:
+    """Compact key of the output `output_id` of transaction `tx_hash`"""
+    return OUTPOINT.pack(bytes.fromhex(tx_hash), output_id)
+
+
+def _block_txs(block) -> Iterator[Tuple[str, List[Tuple[str, int]], List[Tuple]]]:
+    """(tx hash, inputs, outputs) of each tx of a Block or a block dict"""
+    if isinstance(block, dict):
+        for tx in block.get("txs") or []:
+            yield (
+                tx["hash"],
+                [(i["tx"], i["idx"]) for i in tx["in"]],
+                [(o["recipient"], Amount(int(o["amount"]))) for o in tx["out"]],
+            )
+    else:
+        for tx in block.transactions:
+            yield (
+                tx.proof,
+                [(i.tx_hash, i.output_id) for i in tx.inputs],
+                [(str(o.recipient), o.amount) for o in tx.outputs],
+            )
+
+
+class UTXOSet:
+    def __init__(
+        self,
+        path: Path = DEFAULT_UTXO_FP,
+        cache_size: int = CACHE_SIZE,
+        undo_depth: int = UNDO_DEPTH,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self.undo_depth = undo_depth
+
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        # outpoint -> packed coin, None for coins spent since the last flush
+        self._cache: Dict[bytes, Optional[bytes]] = {}
+        self._dirty = set()  # outpoints changed since the last flush
+        self._fresh = set()  # outpoints created since the last flush, not stored yet
+        self._undo: Dict[int, bytes] = {}  # undo data not flushed yet
+
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'height'").fetchone()
+        self.height = row[0] if row is not None else -1  # last applied height
+
+    def _fetch(self, key: bytes) -> Optional[bytes]:
+        if key in self._cache:
+            return self._cache[key]
+        row = self.conn.execute("SELECT coin FROM utxos WHERE outpoint = ?", (key,))
+        row = row.fetchone()
+        coin = row[0] if row is not None else None
+        if coin is not None:
+            self._cache[key] = coin
+        return coin
+
+    def _add(self, key: bytes, coin: bytes):
+        if self._fetch(key) is not None:
+            raise UTXOException(f"output {key.hex()} already exists")
+        if key not in self._dirty:
+            self._fresh.add(key)  # no stored row to overwrite
+        self._cache[key] = coin
+        self._dirty.add(key)
+
+    def _remove(self, key: bytes):
+        if key in self._fresh:
+            # created and spent between flushes, the store never sees it
+            self._fresh.discard(key)
+            self._dirty.discard(key)
+            del self._cache[key]
+        else:
+            self._cache[key] = None
+            self._dirty.add(key)
+
+    def get(self, tx_hash: str, output_id: int) -> Optional[Coin]:
+        coin = self._fetch(outpoint(tx_hash, output_id))
+        return Coin.unpack(coin) if coin is not None else None
+
+    def __contains__(self, key: Tuple[str, int]):
+        return self._fetch(outpoint(*key)) is not None
+
+    def apply_block(self, block, height: int = None):
+        """Spend the inputs and add the outputs of a Block (or block dict)
+
+        The first transaction is the coinbase, its inputs don't spend coins.
+        Nothing is changed if any input is missing or already spent.
+        """
+        height = self.height + 1 if height is None else height
+        if height != self.height + 1:
+            raise UTXOException(
+                f"can't apply block {height}, UTXO set is at {self.height}"
+            )
+
+        spent: List[Tuple[bytes, bytes]] = []
+        created: List[Optional[bytes]] = []  # created keys, None for each spend
+        try:
+            for n, (tx_hash, inputs, outputs) in enumerate(_block_txs(block)):
+                if n > 0:
+                    for spent_hash, output_id in inputs:
+                        key = outpoint(spent_hash, output_id)
+                        coin = self._fetch(key)
+                        if coin is None:
+                            raise UTXOException(
+                                f"{spent_hash}:{output_id} is missing or already spent"
+                            )
+                        self._remove(key)
+                        spent.append((key, coin))
+                        created.append(None)
+
+                for i, (recipient, amount) in enumerate(outputs):
+                    key = outpoint(tx_hash, i)
+                    self._add(key, Coin(recipient, amount, height).pack())
+                    created.append(key)
+        except Exception:
+            # roll back the partially applied block in reverse, so a coin
+            # created and spent in this block ends up removed
+            spends = reversed(spent)
+            for key in reversed(created):
+                if key is None:
+                    self._add(*next(spends))
+                else:
+                    self._remove(key)
+            raise
+
+        self._undo[height] = b"".join(
+            UNDO_HEADER.pack(key, len(coin)) + coin for key, coin in spent
+        )
+        self.height = height
+
+    def flush_if_full(self):
+        """Flush once more than `cache_size` coins are cached
+
+        Not done by `apply_block`, the owner calls it after the block is stored
+        so the flushed height never runs ahead of the block store.
+        """
+        if len(self._cache) > self.cache_size:
+            self.flush()
+
+    def undo_block(self, block, height: int = None):
+        """Disconnect the last applied block, restoring the coins it spent"""
+        height = self.height if height is None else height
+        if height != self.height:
+            raise UTXOException(f"can only undo the tip {self.height}, not {height}")
+
+        undo = self._undo.pop(height, None)
+        if undo is None:
+            row = self.conn.execute("SELECT data FROM undo WHERE height = ?", (height,))
+            row = row.fetchone()
+            if row is None:
+                raise UTXOException(f"no undo data for block {height}")
+            undo = row[0]
+            self.conn.execute("DELETE FROM undo WHERE height = ?", (height,))
+
+        spent = []
+        pos = 0
+        while pos < len(undo):
+            key, length = UNDO_HEADER.unpack_from(undo, pos)
+            pos += UNDO_HEADER.size
+            spent.append((key, bytes(undo[pos : pos + length])))
+            pos += length
+
+        # transaction by transaction from the last, its outputs are removed
+        # before its inputs come back, so coins created and spent in the block
+        # stay removed
+        txs = list(_block_txs(block))
+        for n in reversed(range(len(txs))):
+            tx_hash, inputs, outputs = txs[n]
+            for i in reversed(range(len(outputs))):
+                self._remove(outpoint(tx_hash, i))
+            if n > 0:
+                for _ in inputs:
+                    self._add(*spent.pop())
+
+        self.height = height - 1
+
+    def flush(self):
+        """Write every change since the last flush in one transaction"""
+        deleted, written = [], []
+        for key in self._dirty:
+            coin = self._cache[key]
+            if coin is None:
+                deleted.append((key,))
+            else:
+                written.append((key, Coin.unpack(coin).recipient, coin))
+        with self.conn:
+            self.conn.executemany("DELETE FROM utxos WHERE outpoint = ?", deleted)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO utxos VALUES (?, ?, ?)", written
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO undo VALUES (?, ?)", self._undo.items()
+            )
+            self.conn.execute(
+                "DELETE FROM undo WHERE height < ?", (self.height - self.undo_depth,)
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('height', ?)", (self.height,)
+            )
+        self._cache.clear()
+        self._dirty.clear()
+        self._fresh.clear()
+        self._undo.clear()
+
+    def coins(self, address: str) -> List[Tuple[str, int, Coin]]:
+        """Unspent (tx hash, output index, coin) paid to `address`"""
+        coins = []
+        for key, coin in self._address_coins(str(address)).items():
+            tx_hash, output_id = OUTPOINT.unpack(key)
+            coins.append((tx_hash.hex(), output_id, Coin.unpack(coin)))
+        return coins
+
+    def balance(self, address: str) -> Amount:
+        """Sum of the unspent outputs paid to `address`, in base units"""
+        coins = self._address_coins(str(address)).values()
+        return Amount(sum(COIN_HEADER.unpack_from(coin)[1] for coin in coins))
+
+    def _address_coins(self, address: str) -> Dict[bytes, bytes]:
+        """Stored coins of `address` with the unflushed changes laid over them"""
+        rows = self.conn.execute(
+            "SELECT outpoint, coin FROM utxos WHERE address = ?", (address,)
+        )
+        coins = dict(rows)
+        for key in self._dirty:
+            coin = self._cache[key]
+            if coin is None:
+                coins.pop(key, None)
+            elif Coin.unpack(coin).recipient == address:
+                coins[key] = coin
+        return coins
+
+    def sync(self, store):
+        """Apply blocks of a BlockStore past the applied height"""
+        for height in range(self.height + 1, len(store)):
+            self.apply_block(json.loads(bytes(store.get_block(height))), height)
+            self.flush_if_full()
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    import tempfile
+
+    a, b = "aa" * 32, "bb" * 32
+    genesis = {
+        "txs": [{"hash": a, "in": [], "out": [{"recipient": "0xA", "amount": "50"}]}]
+    }
+    spend = {
+        "txs": [
+            {"hash": "cc" * 32, "in": [], "out": [{"recipient": "0xA", "amount": "50"}]},
+            {
+                "hash": b,
+                "in": [{"tx": a, "idx": 0}],
+                "out": [
+                    {"recipient": "0xB", "amount": "20"},
+                    {"recipient": "0xA", "amount": "30"},
+                ],
+            },
+        ]
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        utxos = UTXOSet(Path(tmp) / "utxo.sqlite")
+        utxos.apply_block(genesis)
+        utxos.flush()
+        utxos.apply_block(spend)
+        assert utxos.get(a, 0) is None
+        assert utxos.balance("0xA") == 80
+
+        try:
+            utxos.apply_block(spend)  # double spend
+        except UTXOException:
+            pass
+        assert utxos.height == 1
+
+        utxos.undo_block(spend)
+        assert utxos.balance("0xA") == 50
+        assert utxos.balance("0xB") == 0
+
+        # an output created and spent in the same block
+        c, d = "cc" * 32, "dd" * 32
+        chained = {
+            "txs": [
+                {"hash": c, "in": [], "out": [{"recipient": "0xC", "amount": "10"}]},
+                {
+                    "hash": d,
+                    "in": [{"tx": c, "idx": 0}],
+                    "out": [{"recipient": "0xD", "amount": "10"}],
+                },
+                {"hash": "ee" * 32, "in": [{"tx": b, "idx": 0}], "out": []},
+            ]
+        }
+        try:
+            utxos.apply_block(chained)  # b:0 was undone
+        except UTXOException:
+            pass
+        assert utxos.get(c, 0) is None and utxos.get(d, 0) is None
+        chained["txs"].pop()
+        utxos.apply_block(chained)
+        utxos.undo_block(chained)
+        assert utxos.get(c, 0) is None and utxos.get(d, 0) is None
+        assert utxos.balance("0xA") == 50 and utxos.balance("0xC") == 0
+        utxos.close()
+        print("Tests done!")
@@ -3,6 +3,7 @@ from typing import List
 
 from keys import KeyPair
 from address import Address
+from derivation import GAP_LIMIT, derive_addresses, scan_addresses
 
 
 class WalletException(Exception):
@@ -60,6 +61,21 @@ class Wallet:
         self.addresses.append([address, kp])
         return address
 
+    def derive_addresses(self, seed: bytes, start: int, count: int, workers: int = None):
+        """Derive and add the child addresses [start, start + count) of a seed"""
+        pairs = derive_addresses(seed, start, count, workers)
+        self.addresses.extend([address, kp] for address, kp in pairs)
+        return [address for address, _ in pairs]
+
+    @classmethod
+    def from_seed(cls, seed: bytes, is_used, gap_limit: int = GAP_LIMIT):
+        """Restore a wallet's used addresses from its master seed
+        `is_used` is called with each derived Address"""
+        cls = cls()
+        for address, kp in scan_addresses(seed, is_used, gap_limit):
+            cls.addresses.append([address, kp])
+        return cls
+
     @classmethod
     def create_new(cls, kp: KeyPair = None):
         if kp is None: